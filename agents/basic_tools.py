@@ -31,6 +31,15 @@ available_tools = {
     "get_weather": get_weather,
 }
 
+# --- 工具执行配置 ---
+# executor: async / inline / thread / process，timeout 单位为秒
+# cache_ttl / deterministic: 结果缓存策略，未声明则不缓存
+# 未列出的工具使用 ToolRuntime 的默认值（同步函数放入线程池执行）
+tool_settings = {
+    "get_current_time": {"executor": "inline", "timeout": 1.0},
+    "get_weather": {"executor": "thread", "timeout": 10.0, "max_concurrency": 4, "cache_ttl": 600},
+}
+
 # --- 工具元数据 ---
 # 这是提供给LLM的“工具说明书”，格式需遵循LLM的要求
 tools_metadata = [
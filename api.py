@@ -1,24 +1,73 @@
 # api.py
+from core import startup   # 最先导入，作为冷启动计时的起点
 
 import uvicorn
 from fastapi import FastAPI, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import asyncio
-import shutil
-import tempfile
-import os
+from contextlib import asynccontextmanager
 
 # 导入我们的配置和核心处理器
-from core.config import settings
-from core.llm_handler import get_chat_response_stream
-from core.voice_handler import transcribe_audio_file, synthesize_speech_and_play
+with startup.timed("import_core"):
+    from core.config import settings
+    from core import metrics
+    from core.llm_cache import completion_cache
+    from core.llm_client import get_async_client, get_aux_client
+    from core.llm_handler import get_chat_response_stream, session_store, tool_runtime
+    from core.scheduler import ChatQueueFull, chat_scheduler
+    from core.sse import sse_stream
+    from core.transport import register_server_loop
+
+# 可选功能组：未启用的子系统不会被导入
+if settings.ENABLE_MEMORY:
+    with startup.timed("import_memory"):
+        from core.memory_manager import memory_manager, memory_write_queue
+if settings.ENABLE_VOICE:
+    with startup.timed("import_voice"):
+        from core.voice_handler import (
+            TranscriptionQueueFull, audio_cache, audio_media_type, synthesize_speech_bytes, transcription_pool
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动记忆写入队列，关闭时先写完积压的记忆再断开数据库"""
+    # 在线程中预先导入 openai 并创建客户端，避免首个 /chat 请求在事件循环上同步导入，卡住其他流
+    with startup.timed("warm_llm_client"):
+        await asyncio.to_thread(lambda: (get_async_client(), get_aux_client()))
+    if settings.ENABLE_MEMORY:
+        with startup.timed("ensure_schema"):
+            try:
+                await memory_manager.ensure_schema()
+            except Exception as e:
+                print(f"Failed to prepare the memory graph schema: {e}")
+        with startup.timed("load_entity_index"):
+            try:
+                await memory_manager.load_entity_index()
+            except Exception as e:
+                # 首次检索时会在后台重试；加载成功前用 LLM 抽取实体
+                print(f"Failed to load entity index from the memory graph, will retry: {e}")
+        memory_write_queue.start()
+    register_server_loop(asyncio.get_running_loop())
+    startup.mark("ready")
+    print(startup.summary())
+    yield
+    register_server_loop(None)
+    if settings.ENABLE_MEMORY:
+        await memory_write_queue.stop()
+        await memory_manager.close()
+    await session_store.close()
+    tool_runtime.shutdown()
+    completion_cache.close()
+
 
 # 初始化FastAPI应用
 app = FastAPI(
     title="My Jarvis AI Assistant API",
     description="API for a multi-modal AI assistant.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # --- API数据模型 ---
@@ -27,10 +76,13 @@ class ChatRequest(BaseModel):
     """聊天请求的数据模型"""
     message: str
     session_id: str = "default_session" # 用于支持多用户会话
+    timing: bool = False                 # 调试用：在 done 之前返回本次请求各阶段的耗时
 
 class TTSRequest(BaseModel):
     """文本转语音请求的数据模型"""
     text: str
+    output_format: str = "mp3_44100_128"   # ElevenLabs 输出格式，如 mp3_44100_128、pcm_16000、opus_48000_64
+    voice: str = settings.TTS_VOICE
 
 # --- API路由/端点 ---
 
@@ -39,52 +91,174 @@ async def read_root():
     """根端点，用于健康检查"""
     return {"status": "ok", "message": "Welcome to Jarvis API!"}
 
+@app.get("/startup")
+async def startup_report():
+    """冷启动报告：各阶段耗时、延迟初始化的客户端耗时，以及已加载的重量级依赖"""
+    return startup.report()
+
+if settings.ENABLE_MEMORY:
+    @app.get("/memory/stats")
+    async def memory_stats():
+        """记忆子系统的运行统计：邻域缓存命中率、写入队列深度等"""
+        return {
+            "neighborhood_cache": memory_manager.neighborhood_cache.snapshot(),
+            "entity_index": memory_manager.entity_index_snapshot(),
+            "write_queue": {**memory_write_queue.stats, "depth": memory_write_queue.depth},
+        }
+
+@app.get("/sessions/stats")
+async def sessions_stats():
+    """会话存储的统计：会话数、历史 token 总量、裁剪与淘汰次数"""
+    return await session_store.snapshot()
+
+@app.get("/llm/cache/stats")
+async def llm_cache_stats():
+    """LLM 补全缓存的命中率和磁盘占用"""
+    return completion_cache.snapshot()
+
+@app.get("/chat/stats")
+async def chat_stats():
+    """聊天调度器的排队深度、并发数，以及各 LLM 端点的延迟、错误率、限流与重试统计"""
+    stats = {"scheduler": chat_scheduler.snapshot()}
+    # 只在客户端已创建时读取，不为统计触发初始化
+    for name, getter in (("llm_chat", get_async_client), ("llm_aux", get_aux_client)):
+        if getter.cache_info().currsize:
+            stats[name] = getter().snapshot()
+    return stats
+
+@app.get("/tools/stats")
+async def tools_stats():
+    """工具结果缓存的命中统计"""
+    return tool_runtime.cache_report()
+
+
+def collect_runtime_metrics() -> list:
+    """抓取时读取各子系统已有的统计：缓存命中与队列深度"""
+    caches = {
+        "llm_completion": completion_cache.snapshot(),
+        "tool_result": tool_runtime.result_cache.snapshot(),
+    }
+    queues = {"chat_waiting": chat_scheduler.waiting}
+    if settings.ENABLE_MEMORY:
+        caches["memory_neighborhood"] = memory_manager.neighborhood_cache.snapshot()
+        queues["memory_write"] = memory_write_queue.depth
+    if settings.ENABLE_VOICE:
+        caches["tts_audio"] = audio_cache.snapshot()
+        queues["stt_waiting"] = transcription_pool.waiting
+    return [
+        ("jarvis_cache_hits_total", "counter", "Cache hits per cache.",
+         [({"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        ("jarvis_cache_misses_total", "counter", "Cache misses per cache.",
+         [({"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        ("jarvis_queue_depth", "gauge", "Items currently waiting in each background queue.",
+         [({"queue": name}, depth) for name, depth in queues.items()]),
+    ]
+
+
+metrics.registry.add_collector(collect_runtime_metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Prometheus 文本格式的指标：各阶段耗时直方图、token 与缓存计数、队列深度"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     """
-    处理聊天请求并以流式响应返回AI的回答。
+    处理聊天请求并以 SSE 流返回AI的回答。
+    事件类型：token / tool_start / tool_result / done / error，相邻的 token 会被合并下发；
+    请求中 timing=true 时在 done 之前追加一个 timing 事件。
+    同一会话的请求按顺序执行；排队已满时立即返回 503。
     """
     try:
-        # 调用LLM处理器获取一个异步生成器
-        response_generator = get_chat_response_stream(request.message, request.session_id)
-        # 使用StreamingResponse将生成器的内容流式传输给客户端
-        return StreamingResponse(response_generator, media_type="text/event-stream")
-    except Exception as e:
-        # 异常处理
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.post("/transcribe")
-async def transcribe_endpoint(file: UploadFile = File(...)):
-    """接收音频文件并返回转录文本"""
+        ticket = chat_scheduler.try_acquire(request.session_id)
+    except ChatQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     try:
-        # 将上传的文件保存到临时位置
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-            shutil.copyfileobj(file.file, tmp)
-            tmp_path = tmp.name
-        
-        # 调用语音处理器进行转录
-        text = transcribe_audio_file(tmp_path)
-        
-        # 清理临时文件
-        os.remove(tmp_path)
-        
-        return {"transcription": text}
+        # 调用LLM处理器获取一个事件流，交给调度器排队执行
+        events = chat_scheduler.run(
+            ticket,
+            get_chat_response_stream(request.message, request.session_id, timing=request.timing),
+        )
+        # 编码成 SSE 帧：合并短小增量、有界缓冲实现背压、空闲时发送心跳
+        body = sse_stream(
+            events,
+            heartbeat_interval=settings.SSE_HEARTBEAT_INTERVAL,
+            coalesce_delay=settings.SSE_COALESCE_MS / 1000,
+            coalesce_bytes=settings.SSE_COALESCE_BYTES,
+            queue_size=settings.SSE_QUEUE_SIZE,
+        )
+        return StreamingResponse(
+            body,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     except Exception as e:
+        # 异常处理：响应没有开始，归还准入名额
+        ticket.release()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # 确保文件句柄被关闭
-        await file.close()
 
-@app.post("/synthesize")
-async def synthesize_endpoint(request: TTSRequest):
-    """接收文本并触发语音合成（在服务器端播放）"""
-    try:
-        # 注意：这是一个后台任务，它会在服务器端播放声音。
-        # 在实际应用中，您可能希望返回音频流让客户端播放。
-        synthesize_speech_and_play(request.text)
-        return {"status": "ok", "message": "Speech synthesis started."}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+# --- 语音路由（仅在启用语音功能组时注册） ---
+if settings.ENABLE_VOICE:
+    @app.post("/transcribe")
+    async def transcribe_endpoint(file: UploadFile = File(...)):
+        """接收音频文件并返回转录文本"""
+        try:
+            # 上传内容直接读入内存交给异步 STT 客户端，不写临时文件、不阻塞事件循环
+            data = await file.read()
+            text = await transcription_pool.transcribe(
+                data,
+                filename=file.filename or "audio.wav",
+                content_type=file.content_type or "audio/wav",
+            )
+            return {"transcription": text}
+        except TranscriptionQueueFull as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            # 确保文件句柄被关闭
+            await file.close()
+
+    @app.get("/transcribe/stats")
+    async def transcribe_stats():
+        """转录任务池的并发数与排队深度"""
+        return transcription_pool.snapshot()
+
+    @app.post("/synthesize")
+    async def synthesize_endpoint(request: TTSRequest):
+        """接收文本，以分块流的形式返回合成的音频（重复的文本直接从磁盘缓存返回）"""
+        try:
+            media_type = audio_media_type(request.output_format)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        audio_stream = synthesize_speech_bytes(
+            request.text, voice=request.voice, output_format=request.output_format
+        )
+        # 先取到第一块音频再返回响应头：TTS 服务的错误（密钥、音色、网络）仍然以错误状态码返回
+        try:
+            first = await anext(audio_stream)
+        except StopAsyncIteration:
+            return Response(content=b"", media_type=media_type)
+        except Exception as e:
+            await audio_stream.aclose()
+            raise HTTPException(status_code=500, detail=str(e))
+
+        async def stream_audio():
+            try:
+                yield first
+                async for chunk in audio_stream:
+                    yield chunk
+            finally:
+                await audio_stream.aclose()
+
+        return StreamingResponse(stream_audio(), media_type=media_type)
+
+    @app.get("/synthesize/stats")
+    async def synthesize_stats():
+        """TTS 音频缓存的命中率和磁盘占用"""
+        return audio_cache.snapshot()
 
 
 # --- 用于直接运行API服务器的入口 ---
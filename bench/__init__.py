@@ -0,0 +1,7 @@
+# bench/__init__.py
+"""
+离线基准测试：用本地模拟的 OpenAI 兼容服务和内存版知识图谱替代 DeepSeek / Neo4j，
+对 api.py 的 /chat 施加并发负载，并把 TTFT、吞吐、延迟分位数和事件循环延迟写入结果文件。
+
+运行：python -m bench.run --sessions 16 --turns 4
+"""
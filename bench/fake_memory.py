@@ -0,0 +1,44 @@
+# bench/fake_memory.py
+import asyncio
+import time
+from typing import Dict, List
+
+from core.memory_manager import EmbeddedMemoryManager, aggregate_triplets
+
+
+class FakeMemoryManager(EmbeddedMemoryManager):
+    """
+    嵌入式图谱后端（不落盘）加上模拟的数据库往返耗时，用来近似 Neo4j 部署：
+    实体识别、邻域缓存、排序与 token 预算、三元组抽取等逻辑都走真实代码。
+    query_latency 模拟每次数据库往返的耗时（秒）。
+    """
+
+    def __init__(self, query_latency: float = 0.005, seed_triplets: List[Dict] = ()):
+        super().__init__(path=None)
+        self.vector_path = None   # 向量索引同样只保存在内存中
+        self.query_latency = query_latency
+        self.queries = 0
+        now = time.time()
+        for row in aggregate_triplets(list(seed_triplets)):
+            self._mention((row["subject"], row["relation"], row["object"]), row["count"], now)
+
+    async def _round_trip(self):
+        self.queries += 1
+        await asyncio.sleep(self.query_latency)
+
+    async def ensure_schema(self):
+        await self._round_trip()
+
+    async def load_entity_index(self) -> int:
+        await self._round_trip()
+        return await super().load_entity_index()
+
+    async def store_triplets(self, triplets: List[Dict]) -> int:
+        stored = await super().store_triplets(triplets)
+        if stored:
+            await self._round_trip()
+        return stored
+
+    async def _query_neighborhoods(self, names: List[str], limit: int) -> Dict[str, List[Dict]]:
+        await self._round_trip()
+        return await super()._query_neighborhoods(names, limit)
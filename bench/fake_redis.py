@@ -0,0 +1,167 @@
+# bench/fake_redis.py
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+
+class FakeRedisServer:
+    """
+    进程内的 RESP 协议替身，实现 RedisSessionBackend 用到的命令：
+    PING / AUTH / SELECT / GET / GETEX [EX] / SET [EX] / EXPIRE / DEL / DBSIZE / FLUSHDB，
+    以及乐观事务 WATCH / UNWATCH / MULTI / EXEC / DISCARD。
+    键的过期在访问时惰性判断；不支持的命令返回错误回复。
+    """
+
+    def __init__(self, password: Optional[str] = None):
+        self.password = password
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.revisions: Dict[bytes, int] = {}   # 每个键被修改的次数，供 WATCH 判断
+        self.commands = 0
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """开始监听，返回实际端口（port=0 时由系统分配）"""
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _touch(self, key: bytes):
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> Optional[list]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if line[:1] != b"*":
+            return line.strip().split()   # inline 命令（例如 redis-cli 的 PING）
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    @staticmethod
+    def _encode(reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        if isinstance(reply, Exception):
+            return f"-ERR {reply}\r\n".encode()
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(FakeRedisServer._encode(r) for r in reply)
+        return f"+{reply}\r\n".encode()
+
+    def _execute(self, args: list, state: dict):
+        name = args[0].decode().upper()
+        if self.password and not state["authed"] and name != "AUTH":
+            return Exception("NOAUTH Authentication required.")
+        if name == "PING":
+            return "PONG"
+        if name == "AUTH":
+            if args[-1].decode() != (self.password or ""):
+                return Exception("invalid password")
+            state["authed"] = True
+            return "OK"
+        if state["multi"] is not None and name not in ("EXEC", "DISCARD", "MULTI", "WATCH"):
+            state["multi"].append(args)
+            return "QUEUED"
+        if name == "WATCH":
+            if state["multi"] is not None:
+                return Exception("WATCH inside MULTI is not allowed")
+            for key in args[1:]:
+                state["watched"][key] = self.revisions.get(key, 0)
+            return "OK"
+        if name == "UNWATCH":
+            state["watched"].clear()
+            return "OK"
+        if name == "MULTI":
+            if state["multi"] is not None:
+                return Exception("MULTI calls can not be nested")
+            state["multi"] = []
+            return "OK"
+        if name == "DISCARD":
+            if state["multi"] is None:
+                return Exception("DISCARD without MULTI")
+            state["multi"] = None
+            state["watched"].clear()
+            return "OK"
+        if name == "EXEC":
+            if state["multi"] is None:
+                return Exception("EXEC without MULTI")
+            queued, state["multi"] = state["multi"], None
+            watched = dict(state["watched"])
+            state["watched"].clear()
+            if any(self.revisions.get(key, 0) != rev for key, rev in watched.items()):
+                return None   # 监视的键已被修改，事务不执行
+            return [self._execute(command, state) for command in queued]
+        if name == "SELECT":
+            return "OK"
+        if name == "GET":
+            return self._live(args[1])
+        if name == "GETEX":
+            value = self._live(args[1])
+            if value is not None and len(args) >= 4 and args[2].upper() == b"EX":
+                self.data[args[1]] = (value, time.monotonic() + int(args[3]))
+                self._touch(args[1])
+            return value
+        if name == "SET":
+            expires = None
+            if len(args) >= 5 and args[3].upper() == b"EX":
+                expires = time.monotonic() + int(args[4])
+            self.data[args[1]] = (args[2], expires)
+            self._touch(args[1])
+            return "OK"
+        if name == "EXPIRE":
+            value = self._live(args[1])
+            if value is None:
+                return 0
+            self.data[args[1]] = (value, time.monotonic() + int(args[2]))
+            self._touch(args[1])
+            return 1
+        if name == "DEL":
+            deleted = [key for key in args[1:] if self.data.pop(key, None) is not None]
+            for key in deleted:
+                self._touch(key)
+            return len(deleted)
+        if name == "DBSIZE":
+            return sum(1 for key in list(self.data) if self._live(key) is not None)
+        if name == "FLUSHDB":
+            for key in self.data:
+                self._touch(key)
+            self.data.clear()
+            return "OK"
+        return Exception(f"unknown command '{name}'")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        state = {"authed": False, "watched": {}, "multi": None}
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if not args:
+                    break
+                self.commands += 1
+                writer.write(self._encode(self._execute(args, state)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,139 @@
+# bench/loadgen.py
+import asyncio
+import math
+import time
+from typing import List, Optional
+
+import httpx
+
+from core.session_store import estimate_tokens
+from core.sse import SSEParser
+
+PROMPTS = [
+    "今天天气怎么样？",
+    "现在几点了？",
+    "帮我总结一下我们刚才聊的内容。",
+    "给我讲一个关于天气的小故事。",
+]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法计算分位数，p 取 0~100"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values: List[float], digits: int = 2) -> dict:
+    """count / mean / p50 / p95 / p99 / max"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), digits),
+        "p50": round(percentile(values, 50), digits),
+        "p95": round(percentile(values, 95), digits),
+        "p99": round(percentile(values, 99), digits),
+        "max": round(max(values), digits),
+    }
+
+
+class LoopLagProbe:
+    """
+    在被测服务的事件循环上周期性 sleep，记录实际唤醒时间比预期晚了多少。
+    延迟越大，说明循环被同步代码阻塞得越严重。
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples_ms: List[float] = []
+        self._stopped = False
+
+    async def run(self):
+        while not self._stopped:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.samples_ms.append(max(0.0, lag) * 1000)
+
+    def stop(self):
+        self._stopped = True
+
+
+async def chat_once(client: httpx.AsyncClient, session_id: str, message: str) -> dict:
+    """发送一次 /chat 请求并逐个解析 SSE 事件，返回该请求的计时样本"""
+    sample = {
+        "session_id": session_id,
+        "ttft_ms": None,
+        "latency_ms": None,
+        "tokens": 0,
+        "tokens_per_s": None,
+        "tool_calls": 0,
+        "frames": 0,
+        "error": None,
+    }
+    text = ""
+    parser = SSEParser()
+    start = time.perf_counter()
+    first_token = None
+    try:
+        async with client.stream(
+            "POST", "/chat", json={"message": message, "session_id": session_id}
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                event = parser.feed(line)
+                if event is None:
+                    continue
+                kind = event["event"]
+                if kind == "token":
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    sample["frames"] += 1
+                    text += event["data"]
+                elif kind == "tool_start":
+                    sample["tool_calls"] += 1
+                elif kind == "error":
+                    sample["error"] = event["data"].get("message", "error")
+                elif kind == "done":
+                    break
+    except Exception as e:
+        sample["error"] = f"{type(e).__name__}: {e}"
+
+    end = time.perf_counter()
+    sample["latency_ms"] = round((end - start) * 1000, 2)
+    # 与会话存储相同的估算方式，去掉每条消息固定的格式开销
+    sample["tokens"] = max(0, estimate_tokens({"content": text}) - 4) if text else 0
+    if first_token is not None:
+        sample["ttft_ms"] = round((first_token - start) * 1000, 2)
+        if end > first_token and sample["tokens"] > 1:
+            sample["tokens_per_s"] = round((sample["tokens"] - 1) / (end - first_token), 2)
+    return sample
+
+
+async def run_load(base_url: str, sessions: int, turns: int, think_time: float = 0.0) -> dict:
+    """
+    以 sessions 个并发会话驱动 /chat，每个会话顺序发送 turns 条消息。
+    返回全部请求样本和整体耗时。
+    """
+    samples: List[dict] = []
+    limits = httpx.Limits(max_connections=sessions, max_keepalive_connections=sessions)
+    timeout = httpx.Timeout(120.0, connect=10.0)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        async def session(index: int):
+            session_id = f"bench-{index}"
+            for turn in range(turns):
+                sample = await chat_once(client, session_id, PROMPTS[(index + turn) % len(PROMPTS)])
+                sample["turn"] = turn
+                samples.append(sample)
+                if think_time:
+                    await asyncio.sleep(think_time)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session(i) for i in range(sessions)))
+        wall_time = time.perf_counter() - start
+
+    return {"samples": samples, "wall_time_s": round(wall_time, 3)}
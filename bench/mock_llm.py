@@ -0,0 +1,137 @@
+# bench/mock_llm.py
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 回复文本使用的字符表：每个中文字符按 1 个 token 计（与 core.session_store.estimate_tokens 一致）
+VOCABULARY = "我们今天天气很好可以出去走走这个问题需要查询一下时间然后回答你的请求已经处理完成"
+
+
+class MockProfile:
+    """
+    模拟服务的行为参数：
+      - first_token_median / first_token_sigma：首个 token 延迟服从对数正态分布（中位数、形状参数）
+      - tokens_per_second：首 token 之后的输出速率
+      - reply_tokens：每条回复的 token 数（上下浮动 25%）
+      - tool_call_ratio：用户消息触发一次工具调用的概率，工具结果返回后再输出正文
+      - error_rate：直接返回 500 的请求比例
+    """
+
+    def __init__(
+        self,
+        first_token_median: float = 0.2,
+        first_token_sigma: float = 0.4,
+        tokens_per_second: float = 80.0,
+        reply_tokens: int = 120,
+        tool_call_ratio: float = 0.2,
+        tool_name: str = "get_current_time",
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.first_token_median = first_token_median
+        self.first_token_sigma = first_token_sigma
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.tool_call_ratio = tool_call_ratio
+        self.tool_name = tool_name
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def first_token_delay(self) -> float:
+        return self.first_token_median * self.random.lognormvariate(0, self.first_token_sigma)
+
+    def reply_text(self) -> str:
+        n = max(1, int(self.reply_tokens * self.random.uniform(0.75, 1.25)))
+        return "".join(self.random.choice(VOCABULARY) for _ in range(n))
+
+
+def _chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def create_mock_app(profile: MockProfile) -> FastAPI:
+    """创建模拟 /v1/chat/completions 的 FastAPI 应用，stats 记录收到的请求数"""
+    app = FastAPI()
+    app.state.stats = {"requests": 0, "streamed": 0, "tool_calls": 0, "errors": 0}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        if profile.random.random() < profile.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "mock upstream error"}}, status_code=500)
+
+        messages = body.get("messages", [])
+        last = messages[-1] if messages else {}
+        wants_tool = (
+            body.get("tools")
+            and last.get("role") == "user"
+            and profile.random.random() < profile.tool_call_ratio
+        )
+
+        # 非流式请求：记忆子系统的三元组 / 实体抽取（response_format=json_object）
+        if not body.get("stream"):
+            await asyncio.sleep(profile.first_token_delay())
+            content = json.dumps({
+                "triplets": [{"subject": "用户", "relation": "询问", "object": "天气"}],
+                "entities": ["天气"],
+            }, ensure_ascii=False)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+            }
+
+        stats["streamed"] += 1
+
+        async def stream():
+            await asyncio.sleep(profile.first_token_delay())
+            yield _chunk(completion_id, model, {"role": "assistant", "content": ""})
+            if wants_tool:
+                stats["tool_calls"] += 1
+                call = {
+                    "index": 0,
+                    "id": f"call_{uuid.uuid4().hex[:8]}",
+                    "type": "function",
+                    "function": {"name": profile.tool_name, "arguments": "{}"},
+                }
+                yield _chunk(completion_id, model, {"tool_calls": [call]})
+                yield _chunk(completion_id, model, {}, finish_reason="tool_calls")
+            else:
+                interval = 1.0 / profile.tokens_per_second
+                start = time.perf_counter()
+                for i, token in enumerate(profile.reply_text()):
+                    # 按绝对时间表输出，避免 sleep 误差累积导致速率偏低
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    yield _chunk(completion_id, model, {"content": token})
+                yield _chunk(completion_id, model, {}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
@@ -0,0 +1,277 @@
+# bench/run.py
+"""
+基准测试入口：在同一进程中启动模拟 LLM 服务和 api.py，用并发会话驱动 /chat，
+结果写入 bench/results/<时间戳>.json（汇总）和 <时间戳>-samples.jsonl（逐请求样本）。
+
+    python -m bench.run --sessions 16 --turns 4 --tokens-per-second 80
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test /chat against a mock LLM and an in-memory graph.")
+    parser.add_argument("--sessions", type=int, default=8, help="并发会话数")
+    parser.add_argument("--turns", type=int, default=4, help="每个会话发送的消息数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="同一会话两次请求之间的间隔（秒）")
+    parser.add_argument("--first-token-ms", type=float, default=200.0, help="模拟首 token 延迟的中位数")
+    parser.add_argument("--first-token-sigma", type=float, default=0.4, help="首 token 延迟对数正态分布的形状参数")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--tool-ratio", type=float, default=0.2, help="触发工具调用的请求比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回 500 的比例")
+    parser.add_argument("--memory-latency-ms", type=float, default=5.0, help="内存图谱每次查询的模拟耗时")
+    parser.add_argument("--no-memory", action="store_true", help="关闭长期记忆功能组")
+    parser.add_argument("--mock-port", type=int, default=18001, help="第 i 个模拟端点使用 mock-port + i")
+    parser.add_argument("--endpoints", type=int, default=1, help="模拟的 LLM 端点数，多于 1 个时经过路由器")
+    parser.add_argument("--endpoint-slowdown", type=float, default=3.0,
+                        help="第 i 个端点的首 token 延迟是第一个端点的 slowdown**i 倍")
+    parser.add_argument("--hedge", action="store_true", help="开启对冲请求")
+    parser.add_argument("--session-backend", choices=("memory", "sqlite", "redis"), default="memory",
+                        help="会话存储后端；redis 使用 bench/fake_redis.py 的本地 RESP 替身")
+    parser.add_argument("--redis-port", type=int, default=18379)
+    parser.add_argument("--api-port", type=int, default=18000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"), help="结果目录")
+    parser.add_argument("--tag", default="", help="附加在结果文件名中的标签")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args, workdir: str):
+    """必须在导入 core 之前调用：Settings 在导入时读取环境变量"""
+    os.environ.update({
+        "DEEPSEEK_API_KEY": "bench",
+        "DEEPSEEK_BASE_URL": f"http://127.0.0.1:{args.mock_port}/v1",
+        "LLM_ENDPOINTS": json.dumps([
+            {"name": f"mock{i}", "base_url": f"http://127.0.0.1:{args.mock_port + i}/v1", "api_key": "bench"}
+            for i in range(args.endpoints)
+        ]),
+        "LLM_HEDGE": "true" if args.hedge else "false",
+        "ENABLE_VOICE": "false",
+        "ENABLE_MEMORY": "false" if args.no_memory else "true",
+        "SESSION_BACKEND": args.session_backend,
+        "SESSION_SQLITE_PATH": os.path.join(workdir, "sessions.db"),
+        "SESSION_REDIS_URL": f"redis://127.0.0.1:{args.redis_port}/0",
+        # 每次运行使用全新的缓存，避免上一次的结果直接命中
+        "LLM_CACHE_PATH": os.path.join(workdir, "llm_cache.db"),
+        "API_HOST": "127.0.0.1",
+        "API_PORT": str(args.api_port),
+    })
+
+
+class ServerThread(threading.Thread):
+    """在独立线程和事件循环中运行 uvicorn；probe 会被调度到同一个循环上"""
+
+    def __init__(self, app, port: int, probe=None):
+        super().__init__(daemon=True)
+        import uvicorn
+
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.probe = probe
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        probe_task = asyncio.create_task(self.probe.run()) if self.probe else None
+        try:
+            await self.server.serve()
+        finally:
+            if probe_task:
+                self.probe.stop()
+                await probe_task
+
+    def wait_started(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("server failed to start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join(timeout=60)
+
+
+class FakeRedisThread(threading.Thread):
+    """在独立线程和事件循环中运行 FakeRedisServer"""
+
+    def __init__(self, port: int):
+        super().__init__(daemon=True)
+        from bench.fake_redis import FakeRedisServer
+
+        self.server = FakeRedisServer()
+        self.port = port
+        self._ready = threading.Event()
+        self._loop = None
+        self._stopped = None
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        await self.server.start(port=self.port)
+        self._ready.set()
+        await self._stopped.wait()
+        await self.server.close()
+
+    def wait_started(self, timeout: float = 10.0):
+        if not self._ready.wait(timeout):
+            raise RuntimeError("fake redis failed to start")
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        self.join(timeout=10)
+
+
+def install_fake_memory(args):
+    """用内存图谱替换 core.memory_manager 中的全局实例，须在导入 api 之前调用"""
+    from core import memory_manager as module
+    from core.config import settings
+    from bench.fake_memory import FakeMemoryManager
+
+    fake = FakeMemoryManager(
+        query_latency=args.memory_latency_ms / 1000,
+        seed_triplets=[
+            {"subject": "天气", "relation": "今天是", "object": "晴天"},
+            {"subject": "用户", "relation": "喜欢", "object": "散步"},
+        ],
+    )
+    module.memory_manager = fake
+    module.memory_write_queue = module.MemoryWriteQueue(
+        fake,
+        maxsize=settings.MEMORY_QUEUE_MAXSIZE,
+        batch_size=settings.MEMORY_BATCH_SIZE,
+        flush_interval=settings.MEMORY_FLUSH_INTERVAL,
+        overflow_policy=settings.MEMORY_QUEUE_POLICY,
+    )
+    return fake
+
+
+def build_report(args, load: dict, probe, mock_stats: dict, extra: dict) -> dict:
+    from bench.loadgen import summarize
+
+    samples = load["samples"]
+    ok = [s for s in samples if s["error"] is None]
+    total_tokens = sum(s["tokens"] for s in ok)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "python": sys.version.split()[0],
+        "wall_time_s": load["wall_time_s"],
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "requests_per_s": round(len(samples) / load["wall_time_s"], 2) if load["wall_time_s"] else None,
+        "aggregate_tokens_per_s": round(total_tokens / load["wall_time_s"], 2) if load["wall_time_s"] else None,
+        "ttft_ms": summarize([s["ttft_ms"] for s in ok if s["ttft_ms"] is not None]),
+        "latency_ms": summarize([s["latency_ms"] for s in ok]),
+        "tokens_per_s": summarize([s["tokens_per_s"] for s in ok if s["tokens_per_s"] is not None]),
+        "frames_per_request": summarize([s["frames"] for s in ok]),
+        "loop_lag_ms": summarize(probe.samples_ms, digits=3),
+        "mock_llm": mock_stats,
+        **extra,
+    }
+
+
+def write_report(report: dict, samples: list, output: str, tag: str = "") -> str:
+    os.makedirs(output, exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S") + (f"-{tag}" if tag else "")
+    path = os.path.join(output, f"{name}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(os.path.join(output, f"{name}-samples.jsonl"), "w", encoding="utf-8") as f:
+        for sample in samples:
+            f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+    return path
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="jarvis-bench-")
+    configure_environment(args, workdir)
+
+    from bench.loadgen import LoopLagProbe, run_load
+    from bench.mock_llm import MockProfile, create_mock_app
+
+    mock_apps, mocks = [], []
+    for i in range(args.endpoints):
+        profile = MockProfile(
+            first_token_median=args.first_token_ms / 1000 * args.endpoint_slowdown ** i,
+            first_token_sigma=args.first_token_sigma,
+            tokens_per_second=args.tokens_per_second,
+            reply_tokens=args.reply_tokens,
+            tool_call_ratio=args.tool_ratio,
+            error_rate=args.error_rate,
+            seed=args.seed + i,
+        )
+        mock_apps.append(create_mock_app(profile))
+        mocks.append(ServerThread(mock_apps[-1], args.mock_port + i))
+        mocks[-1].start()
+        mocks[-1].wait_started()
+
+    redis = None
+    if args.session_backend == "redis":
+        redis = FakeRedisThread(args.redis_port)
+        redis.start()
+        redis.wait_started()
+
+    fake_memory = None if args.no_memory else install_fake_memory(args)
+    import api
+
+    probe = LoopLagProbe()
+    server = ServerThread(api.app, args.api_port, probe=probe)
+    server.start()
+    server.wait_started()
+
+    try:
+        load = asyncio.run(run_load(
+            f"http://127.0.0.1:{args.api_port}", args.sessions, args.turns, args.think_time
+        ))
+    finally:
+        # 关闭 api 时 lifespan 会写完积压的记忆，统计要在之后读取
+        server.stop()
+        for mock in mocks:
+            mock.stop()
+        if redis is not None:
+            redis.stop()
+
+    extra = {}
+    if fake_memory is not None:
+        from core import memory_manager as module
+
+        extra["memory"] = {
+            "graph_queries": fake_memory.queries,
+            "neighborhood_cache": fake_memory.neighborhood_cache.snapshot(),
+            "vector_index": fake_memory.vector_index.snapshot() if fake_memory.vector_index else None,
+            "write_queue": module.memory_write_queue.stats,
+        }
+    extra["llm_cache"] = api.completion_cache.snapshot()
+    if redis is not None:
+        extra["fake_redis"] = {"commands": redis.server.commands, "keys": len(redis.server.data)}
+    extra["llm_router"] = {"chat": api.get_async_client().snapshot(), "aux": api.get_aux_client().snapshot()}
+
+    mock_stats = {f"mock{i}": dict(app.state.stats) for i, app in enumerate(mock_apps)}
+    report = build_report(args, load, probe, mock_stats, extra)
+    path = write_report(report, load["samples"], args.output, args.tag)
+
+    print(f"requests={report['requests']} errors={report['errors']} wall={report['wall_time_s']}s "
+          f"rps={report['requests_per_s']} tok/s={report['aggregate_tokens_per_s']}")
+    for key in ("ttft_ms", "latency_ms", "tokens_per_s", "loop_lag_ms"):
+        stats = report[key]
+        if stats.get("count"):
+            print(f"  {key:<13} p50={stats['p50']} p95={stats['p95']} p99={stats['p99']} max={stats['max']}")
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# core/cache.py
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUTTLCache:
+    """
+    进程内的 LRU + TTL 缓存。
+    超过 maxsize 时淘汰最久未使用的条目，超过 ttl 秒的条目在读取时视为过期。
+    ttl 为 None 表示条目永不过期（仅按容量淘汰）。
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self._MISSING, count=False) is not self._MISSING
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at >= time.monotonic():
+                self._data.move_to_end(key)
+                if count:
+                    self.stats["hits"] += 1
+                return value
+            del self._data[key]
+            self.stats["expirations"] += 1
+        if count:
+            self.stats["misses"] += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = float("inf") if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, key: Hashable):
+        if self._data.pop(key, None) is not None:
+            self.stats["invalidations"] += 1
+
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """删除所有满足 predicate(key, value) 的条目，返回删除的条目数"""
+        keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+        for key in keys:
+            del self._data[key]
+        self.stats["invalidations"] += len(keys)
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+
+    def snapshot(self) -> dict:
+        """返回统计信息（含命中率），用于调试和监控"""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
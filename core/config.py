@@ -1,5 +1,6 @@
 # core/config.py
 import os
+from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # 获取项目根目录的绝对路径
@@ -13,28 +14,150 @@ class Settings(BaseSettings):
     #.env文件的路径
     model_config = SettingsConfigDict(env_file=os.path.join(BASE_DIR, '.env'), env_file_encoding='utf-8')
 
+    # 可选功能组：关闭后对应子系统（及其依赖）不会被导入
+    ENABLE_MEMORY: bool = True   # 知识图谱长期记忆（neo4j）
+    ENABLE_VOICE: bool = True    # 语音转写与合成（openai 音频、elevenlabs、sounddevice）
+
     # LLM API配置
-    DEEPSEEK_API_KEY: str
+    # 各 API 密钥只在对应客户端首次使用时校验，未启用的功能无需配置
+    DEEPSEEK_API_KEY: str = ""
     DEEPSEEK_BASE_URL: str = "https://api.deepseek.com/v1"
     DEEPSEEK_MODEL: str = "deepseek-chat"
+    # 按服务商的限额设置：同时进行的 LLM 请求数、每秒请求数（0 为不限）与突发量
+    LLM_MAX_CONCURRENCY: int = 16
+    LLM_RATE_LIMIT_RPS: float = 10.0
+    LLM_RATE_LIMIT_BURST: int = 20
+    LLM_MAX_RETRIES: int = 3             # 429 / 5xx / 连接错误的最大重试次数
+    LLM_RETRY_BASE_DELAY: float = 0.5    # 抖动退避的基准延迟（秒），每次重试翻倍
+    LLM_RETRY_MAX_DELAY: float = 8.0
+    # 多端点路由（JSON 列表），未配置时只使用上面的 DEEPSEEK_* 端点。每项可包含：
+    # name、base_url、api_key、model、aux_model、purposes（["chat", "aux"]）、max_concurrency、rate_rps、burst
+    LLM_ENDPOINTS: list[dict] = []
+    LLM_AUX_MODEL: str = ""            # 实体 / 三元组抽取、历史摘要等辅助调用使用的小模型，留空则与主模型相同
+    LLM_HEDGE: bool = False            # 首选端点迟迟不返回时，向次优端点再发一次请求，先返回者胜出
+    LLM_HEDGE_MIN_DELAY: float = 0.5   # 对冲触发阈值的下限（秒），实际阈值取它与首选端点 p95 的较大者
 
     # STT API配置 (Whisper)
-    OPENAI_API_KEY: str
+    OPENAI_API_KEY: str = ""
     OPENAI_BASE_URL: str = "https://api.openai.com/v1"
     WHISPER_MODEL: str = "whisper-1"
+    STT_MAX_CONCURRENCY: int = 4   # 同时进行的转录请求数
+    STT_MAX_QUEUE: int = 32        # 排队等待的转录任务上限，超出时返回 503
 
     # TTS API配置
-    ELEVENLABS_API_KEY: str
+    ELEVENLABS_API_KEY: str = ""
+    TTS_VOICE: str = "Rachel"   # 声音名称或 ElevenLabs voice_id
+    TTS_MODEL: str = "eleven_multilingual_v2"
+    TTS_CACHE_DIR: str = os.path.join(BASE_DIR, "data", "tts_cache")
+    TTS_CACHE_MAX_BYTES: int = 200 * 1024 * 1024
+
+    # 录音配置：按语音活动检测自动起止，重采样后压缩上传
+    VOICE_SAMPLE_RATE: int = 16000      # 上传给 STT 的采样率（单声道）
+    VOICE_FORMAT: str = "flac"          # flac / opus / wav，flac 与 opus 需要安装 soundfile
+    VOICE_MAX_SECONDS: float = 30.0     # 单次录音的最长时间
+    VOICE_START_TIMEOUT: float = 8.0    # 多久没检测到说话就放弃（秒）
+    VOICE_END_SILENCE_MS: int = 800     # 连续静音多久判定为说完
+    VOICE_VAD_THRESHOLD: float = 3.0    # 帧能量超过背景噪声多少倍判为语音
+    VOICE_CHUNKED_UPLOAD: bool = False  # 是否在说话停顿处分段上传，边录边转录
+
+    # 长期记忆后端：neo4j（独立的图数据库服务）/ embedded（进程内邻接索引，持久化到本地 SQLite）
+    MEMORY_BACKEND: str = "neo4j"
+    MEMORY_SQLITE_PATH: str = os.path.join(BASE_DIR, "data", "memory_graph.db")
 
     # Neo4j数据库配置
-    NEO4J_URI: str
-    NEO4J_USER: str
-    NEO4J_PASSWORD: str
+    NEO4J_URI: str = "bolt://localhost:7687"
+    NEO4J_USER: str = "neo4j"
+    NEO4J_PASSWORD: str = ""
+    NEO4J_WRITE_RETRY_TIME: float = 15.0  # 写事务遇到瞬时错误时的最长重试时间（秒）
+    MEMORY_CACHE_SIZE: int = 4096         # 实体邻域缓存的最大条目数
+    MEMORY_CACHE_TTL: float = 300.0       # 实体邻域缓存的过期时间（秒）
+    MEMORY_LLM_ENTITY_FALLBACK: bool = False  # 本地实体索引未命中时是否再调用 LLM 抽取实体（索引未加载时总会调用）
+    MEMORY_ENTITY_REFRESH_SECONDS: float = 300.0  # 定期从图谱重新加载实体名，纳入其他 worker 写入的实体；0 表示不刷新
+    MEMORY_ENTITY_RETRY_SECONDS: float = 10.0     # 实体索引加载失败后多久重试
+    MEMORY_HOPS: int = 2                  # 检索的跳数（1 或 2）
+    MEMORY_FANOUT: int = 8                # 每个实体（及每个一跳邻居）保留得分最高的边数
+    MEMORY_SCAN_LIMIT: int = 1000         # 每个节点最多扫描的边数，防止超级节点拖慢查询
+    MEMORY_CONTEXT_TOKENS: int = 300      # 注入到提示中的背景知识 token 上限
+
+    # 记忆向量检索：事实和历史对话的嵌入存放在内存映射的 float32 矩阵中，与图谱检索的结果融合
+    MEMORY_VECTOR_ENABLED: bool = True
+    MEMORY_VECTOR_PATH: str = os.path.join(BASE_DIR, "data", "memory_vectors")  # 生成 .f32 与 .jsonl 两个文件
+    MEMORY_EMBEDDER: str = "hashing"      # hashing（离线特征哈希）/ sentence-transformers:<本地模型>
+    MEMORY_EMBEDDING_DIM: int = 512       # hashing 嵌入的维度
+    MEMORY_VECTOR_TOP_K: int = 8          # 每次检索取回的向量结果数
+    MEMORY_VECTOR_MIN_SCORE: float = 0.15 # 余弦相似度低于该值的结果丢弃
+    MEMORY_TURN_CHARS: int = 200          # 写入向量索引的对话轮次每一侧保留的字符数
+    MEMORY_IVF_THRESHOLD: int = 20000     # 向量数达到该值后启用 IVF 分区检索，0 表示始终暴力检索
+    MEMORY_IVF_NPROBE: int = 8            # IVF 检索时扫描的分区数
+
+    # 记忆写入队列配置（后台批量抽取三元组）
+    MEMORY_QUEUE_MAXSIZE: int = 256
+    MEMORY_BATCH_SIZE: int = 8
+    MEMORY_FLUSH_INTERVAL: float = 2.0
+    MEMORY_QUEUE_POLICY: str = "drop_oldest"  # drop_oldest / drop_newest / block
+
+    # 会话历史配置
+    # 存储后端：memory（单进程）/ sqlite（同机多 worker 共享）/ redis（跨机器共享）
+    SESSION_BACKEND: str = "memory"
+    SESSION_SQLITE_PATH: str = os.path.join(BASE_DIR, "data", "sessions.db")
+    SESSION_REDIS_URL: str = "redis://127.0.0.1:6379/0"
+    SESSION_TOKEN_BUDGET: int = 3000           # 单个会话保留的历史 token 上限，超出后裁剪并摘要
+    SESSION_MAX_COUNT: int = 1000              # 同时保留的最大会话数（LRU 淘汰）
+    SESSION_IDLE_TTL: float = 3600.0           # 会话空闲多久后被淘汰（秒）
+    SESSION_MAX_TOTAL_TOKENS: int = 2_000_000  # 全部会话历史的 token 总量上限
+    SESSION_SUMMARIZE: bool = True             # 是否把裁剪掉的旧轮次合并成滚动摘要
+
+    # LLM 补全缓存配置（按请求内容精确匹配，存放在本地 SQLite 文件）
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_PATH: str = os.path.join(BASE_DIR, "data", "llm_cache.db")
+    LLM_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    LLM_CACHE_TTL: float = 86400.0
+    LLM_CACHE_CHAT: bool = False   # 是否也缓存主对话请求（默认只缓存实体/三元组抽取等辅助调用）
 
     # API服务器配置
     API_HOST: str = "127.0.0.1"
     API_PORT: int = 8000
 
+    # /chat 准入控制：同一会话的请求按顺序执行，超出排队上限时直接返回 503。
+    # 以下限制和会话内的顺序只在单个 worker 进程内生效：多 worker 部署时同一会话的请求
+    # 需要固定路由到同一个 worker（会话粘滞），否则并发的两轮对话互相看不到对方的消息
+    # （共享会话存储的版本检查保证轮次不会丢失，但不保证顺序）
+    CHAT_MAX_CONCURRENCY: int = 32   # 同时生成回复的对话数
+    CHAT_MAX_QUEUE: int = 64         # 全局排队等待的请求上限
+    CHAT_MAX_PER_SESSION: int = 4    # 单个会话排队 + 执行中的请求上限
+    CHAT_QUEUE_TIMEOUT: float = 30.0 # 排队超过该时间仍未轮到则放弃（秒）
+
+    # /chat 的 SSE 输出配置
+    SSE_HEARTBEAT_INTERVAL: float = 15.0  # 空闲多久发送一次心跳注释（秒）
+    SSE_COALESCE_MS: float = 20.0         # 短小的文本增量最多等待多久再合并下发（毫秒）
+    SSE_COALESCE_BYTES: int = 1024        # 单个 token 事件合并到多少字节时立即下发
+    SSE_QUEUE_SIZE: int = 256             # 客户端读取过慢时最多缓冲的事件数，满了之后暂停读取上游
+
+    # GUI 与聊天引擎之间的传输方式：auto / inprocess / http
+    GUI_TRANSPORT: str = "auto"
+
+    @field_validator("MEMORY_IVF_THRESHOLD")
+    @classmethod
+    def _check_ivf_threshold(cls, value: int) -> int:
+        # IVF 至少需要 16 个分区才有意义，向量太少时暴力检索更快
+        if value != 0 and value < 16:
+            raise ValueError("MEMORY_IVF_THRESHOLD must be 0 (disabled) or at least 16")
+        return value
+
+    @field_validator("MEMORY_IVF_NPROBE")
+    @classmethod
+    def _check_ivf_nprobe(cls, value: int) -> int:
+        if value < 1:
+            raise ValueError("MEMORY_IVF_NPROBE must be at least 1")
+        return value
+
+    def require(self, name: str) -> str:
+        """读取必需的配置项，未配置时给出明确的错误提示"""
+        value = getattr(self, name)
+        if not value:
+            raise RuntimeError(f"{name} is not configured, please set it in .env")
+        return value
+
 # 创建一个全局可用的配置实例
 settings = Settings()
 
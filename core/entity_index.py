@@ -0,0 +1,130 @@
+# core/entity_index.py
+from collections import deque
+from typing import Iterable, List
+
+
+def _normalize(text: str) -> str:
+    """逐字符转小写且保持长度不变，保证匹配位置能对应回原文"""
+    return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+def _is_word_char(c: str) -> bool:
+    # 仅对 ASCII 字母数字要求词边界；中日韩文字之间没有空格，不做边界检查
+    return c.isascii() and c.isalnum()
+
+
+class EntityIndex:
+    """
+    基于 Aho-Corasick 自动机的本地实体识别索引。
+    由图谱中的 Entity.name 构建，一次扫描即可找出文本中出现的全部实体名，
+    用来替代每轮对话前调用 LLM 抽取实体。
+
+    新名字通过 add / add_many 增量插入字典树，失败指针在下一次查询时按需重建。
+    """
+
+    def __init__(self, min_length: int = 2):
+        self.min_length = min_length
+        self._goto: List[dict] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]   # 每个节点结束的规范化名字
+        self._dict_link: List[int] = [-1]       # 失败链上最近的有输出节点
+        self._names: dict[str, str] = {}        # 规范化名字 -> 原始名字
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return _normalize(name) in self._names
+
+    def add(self, name: str):
+        if not isinstance(name, str):
+            return
+        name = name.strip()
+        if len(name) < self.min_length:
+            return
+        key = _normalize(name)
+        if key in self._names:
+            self._names[key] = name
+            return
+        self._names[key] = name
+
+        node = 0
+        for c in key:
+            nxt = self._goto[node].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append(key)
+        self._dirty = True
+
+    def add_many(self, names: Iterable[str]):
+        for name in names:
+            self.add(name)
+
+    def _build(self):
+        """BFS 重建失败指针，并把失败链上的输出合并到 dict 输出中"""
+        self._fail = [0] * len(self._goto)
+        self._dict_link = [-1] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self._goto[node].items():
+                f = self._fail[node]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(c, 0)
+                self._fail[child] = target if target != child else 0
+                fail = self._fail[child]
+                self._dict_link[child] = fail if self._output[fail] else self._dict_link[fail]
+                queue.append(child)
+        self._dirty = False
+
+    def find(self, text: str) -> List[str]:
+        """
+        返回文本中出现的实体名（原始写法），按出现顺序去重。
+        重叠的匹配按“最左最长”原则取舍，例如同时存在“北京”和“北京大学”时只返回后者。
+        """
+        if not self._names or not text:
+            return []
+        if self._dirty:
+            self._build()
+
+        key_text = _normalize(text)
+        matches = []   # (start, end, key)
+        node = 0
+        for i, c in enumerate(key_text):
+            while node and c not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(c, 0)
+            out = node
+            while out > 0:
+                for key in self._output[out]:
+                    start, end = i - len(key) + 1, i + 1
+                    if self._at_boundary(key_text, start, end):
+                        matches.append((start, end, key))
+                out = self._dict_link[out]
+
+        matches.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+        result: List[str] = []
+        covered_until = 0
+        for start, end, key in matches:
+            if start < covered_until:
+                continue
+            covered_until = end
+            name = self._names[key]
+            if name not in result:
+                result.append(name)
+        return result
+
+    @staticmethod
+    def _at_boundary(text: str, start: int, end: int) -> bool:
+        if _is_word_char(text[start]) and start > 0 and _is_word_char(text[start - 1]):
+            return False
+        if _is_word_char(text[end - 1]) and end < len(text) and _is_word_char(text[end]):
+            return False
+        return True
@@ -0,0 +1,209 @@
+# core/llm_cache.py
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Optional
+
+from .config import settings
+
+# 参与缓存键计算的请求参数，其余参数（如 timeout、extra_headers）不影响结果
+_KEY_FIELDS = (
+    "model", "messages", "tools", "tool_choice", "response_format",
+    "temperature", "top_p", "max_tokens", "stop", "seed", "stream",
+)
+_NEVER = 253402300799.0   # 9999-12-31，表示永不过期
+
+
+def _normalize(value: Any) -> Any:
+    """规范化请求内容：统一换行符并去掉字符串首尾空白，使等价的提示词得到相同的键"""
+    if isinstance(value, str):
+        return value.replace("\r\n", "\n").strip()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if hasattr(value, "model_dump"):
+        return _normalize(value.model_dump(exclude_none=True))
+    return value
+
+
+class CompletionCache:
+    """
+    按内容寻址的 LLM 补全缓存。
+    键为 base_url、model、messages、tools、response_format 等参数规范化后的 SHA-256，
+    结果以 zlib 压缩后存入本地 SQLite 文件，超过 max_bytes 时按最近访问时间淘汰。
+    流式请求的命中结果会按原顺序一次性重放全部分片。
+
+    只有显式调用 create(..., cache=True) 的调用点才会使用缓存。
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = 86400.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS completions (
+                    key         TEXT PRIMARY KEY,
+                    value       BLOB NOT NULL,
+                    size        INTEGER NOT NULL,
+                    expires_at  REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_access ON completions(last_access)")
+            self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _run(self, fn, *args):
+        def locked():
+            with self._lock:
+                return fn(self._connect(), *args)
+        return asyncio.get_running_loop().run_in_executor(None, locked)
+
+    @staticmethod
+    def make_key(base_url: str, request: dict) -> str:
+        payload = {"base_url": base_url}
+        payload.update({k: _normalize(request[k]) for k in _KEY_FIELDS if request.get(k) is not None})
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _get(conn: sqlite3.Connection, key: str) -> Optional[bytes]:
+        row = conn.execute(
+            "SELECT value FROM completions WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def _put(self, conn: sqlite3.Connection, key: str, value: bytes, ttl: Optional[float]):
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else _NEVER
+        old = conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO completions (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), expires_at, now),
+        )
+        self._total_bytes += len(value) - (old[0] if old else 0)
+        if self._total_bytes > self.max_bytes:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """淘汰过期条目，再按最近访问时间从旧到新删除，直到占用降到上限的 90%"""
+        conn.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+        target = self.max_bytes * 0.9
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        rows = conn.execute("SELECT key, size FROM completions ORDER BY last_access").fetchall()
+        doomed = []
+        for key, size in rows:
+            if total <= target:
+                break
+            doomed.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM completions WHERE key = ?", doomed)
+        self.stats["evictions"] += len(doomed)
+        self._total_bytes = total
+
+    async def get(self, key: str) -> Optional[Any]:
+        data = await self._run(self._get, key)
+        return json.loads(zlib.decompress(data)) if data is not None else None
+
+    async def put(self, key: str, value: Any, ttl: Optional[float] = None):
+        data = zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+        await self._run(self._put, key, data, self.ttl if ttl is None else ttl)
+        self.stats["stores"] += 1
+
+    async def create(self, client, cache: bool = False, cache_ttl: Optional[float] = None, **request):
+        """
+        替代 client.chat.completions.create。
+        cache=False 时直接透传；cache=True 时先查缓存，未命中再请求并写入缓存。
+        """
+        if not cache or not settings.LLM_CACHE_ENABLED:
+            return await client.chat.completions.create(**request)
+
+        key = self.make_key(str(client.base_url), request)
+        try:
+            cached = await self.get(key)
+        except Exception as e:
+            print(f"LLM cache lookup failed: {e}")
+            cached = None
+
+        if cached is not None:
+            self.stats["hits"] += 1
+            if request.get("stream"):
+                return self._replay(cached)
+            from openai.types.chat import ChatCompletion
+
+            return ChatCompletion.model_validate(cached)
+
+        self.stats["misses"] += 1
+        response = await client.chat.completions.create(**request)
+        if request.get("stream"):
+            return self._record(key, response, cache_ttl)
+        await self._safe_put(key, response.model_dump(mode="json", exclude_unset=True), cache_ttl)
+        return response
+
+    async def _safe_put(self, key: str, value: Any, ttl: Optional[float]):
+        try:
+            await self.put(key, value, ttl)
+        except Exception as e:
+            print(f"LLM cache store failed: {e}")
+
+    @staticmethod
+    async def _replay(chunks: list) -> AsyncIterator:
+        from openai.types.chat import ChatCompletionChunk
+
+        for chunk in chunks:
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    async def _record(self, key: str, stream, ttl: Optional[float]) -> AsyncIterator:
+        """透传流式分片，完整结束后再把全部分片写入缓存（中途出错或被取消则不写入）"""
+        chunks = []
+        async with aclosing(stream):
+            async for chunk in stream:
+                chunks.append(chunk.model_dump(mode="json", exclude_unset=True))
+                yield chunk
+        await self._safe_put(key, chunks, ttl)
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+completion_cache = CompletionCache(
+    settings.LLM_CACHE_PATH,
+    max_bytes=settings.LLM_CACHE_MAX_BYTES,
+    ttl=settings.LLM_CACHE_TTL,
+)
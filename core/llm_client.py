@@ -1,8 +1,425 @@
 # core/llm_client.py
-from openai import AsyncOpenAI
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from . import metrics
 from .config import settings
+from .scheduler import TokenBucket
+from .startup import timed
+
+# 这些 HTTP 状态码视为可重试（限流 / 服务端临时故障）
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _retry_after(error) -> Optional[float]:
+    """读取 429/503 响应中的 Retry-After（秒），没有或无法解析时返回 None"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _is_retryable(error) -> bool:
+    from openai import APIConnectionError
+
+    if isinstance(error, APIConnectionError):   # 包括 APITimeoutError
+        return True
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+
+class _GatedStream:
+    """透传流式响应，流结束、出错或被关闭时归还并发名额（只归还一次）"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._release = release
+
+    def _done(self):
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            self._done()
+            raise
+
+    async def close(self):
+        try:
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                await close()
+        finally:
+            self._done()
+
+    aclose = close
+
+    def __del__(self):
+        self._done()
+
+
+class RateLimitedClient:
+    """
+    包装 AsyncOpenAI，对外提供相同的 client.chat.completions.create 接口：
+      - 令牌桶限制每秒发起的请求数，全局信号量限制同时进行（含流式输出中）的请求数；
+      - 遇到 429 / 5xx / 连接错误时按“全抖动”指数退避重试，优先遵循 Retry-After；
+      - 流式请求只在建立连接阶段重试，已经开始输出的流不会被重放。
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrency: int = 16,
+        rate: float = 0.0,
+        burst: int = 1,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+    ):
+        self._client = client
+        self.base_url = client.base_url
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(rate, burst)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {"requests": 0, "retries": 0, "failed": 0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def _backoff(self, attempt: int, error) -> float:
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def create(self, **request):
+        self.waiting += 1
+        try:
+            with metrics.span("llm.gate_wait"):
+                await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.stats["requests"] += 1
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                started = time.perf_counter()
+                try:
+                    response = await self._client.chat.completions.create(**request)
+                    break
+                except Exception as e:
+                    metrics.observe("llm.failed_attempt", started)
+                    if attempt >= self.max_retries or not _is_retryable(e):
+                        self.stats["failed"] += 1
+                        raise
+                    self.stats["retries"] += 1
+                    metrics.count("llm_retries")
+                    delay = self._backoff(attempt, e)
+                    print(f"LLM request failed ({e.__class__.__name__}), retrying in {delay:.2f}s")
+                    await asyncio.sleep(delay)
+        except BaseException:
+            self._release()
+            raise
+
+        if request.get("stream"):
+            return _GatedStream(response, self._release)
+        self._release()
+        return response
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "in_flight": self.in_flight, "waiting": self.waiting}
+
+
+class Endpoint:
+    """一个 OpenAI 兼容的服务端点：自己的客户端、并发上限、限速与重试策略"""
+
+    def __init__(self, name: str, base_url: str, api_key: str, model: str, aux_model: str = "",
+                 purposes=("chat", "aux"), max_concurrency: Optional[int] = None,
+                 rate_rps: Optional[float] = None, burst: Optional[int] = None):
+        from openai import AsyncOpenAI
+
+        self.name = name
+        self.model = model
+        self.aux_model = aux_model or model
+        self.purposes = tuple(purposes)
+        self.client = RateLimitedClient(
+            AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0),   # 重试由 RateLimitedClient 统一处理
+            max_concurrency=max_concurrency or settings.LLM_MAX_CONCURRENCY,
+            rate=settings.LLM_RATE_LIMIT_RPS if rate_rps is None else rate_rps,
+            burst=burst or settings.LLM_RATE_LIMIT_BURST,
+            max_retries=settings.LLM_MAX_RETRIES,
+            base_delay=settings.LLM_RETRY_BASE_DELAY,
+            max_delay=settings.LLM_RETRY_MAX_DELAY,
+        )
+
+    def model_for(self, purpose: str) -> str:
+        return self.aux_model if purpose == "aux" else self.model
+
+
+class EndpointStats:
+    """端点最近 window 次请求的延迟（到响应头 / 首字节）与成败，用于路由打分"""
+
+    MIN_SAMPLES = 5
+
+    def __init__(self, window: int = 100):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.requests = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float, ok: bool):
+        self.requests += 1
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+
+    def p95(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self) -> float:
+        """越小越好；样本不足的端点得分为 0，优先被探测"""
+        if len(self.outcomes) < self.MIN_SAMPLES:
+            return 0.0
+        return (self.p95() or 0.0) / max(0.05, 1.0 - self.error_rate())
+
+    def snapshot(self) -> dict:
+        p95 = self.p95()
+        return {
+            "requests": self.requests,
+            "p95_ms": round(p95 * 1000, 2) if p95 is not None else None,
+            "error_rate": round(self.error_rate(), 4),
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class _PeekedStream:
+    """
+    _peek_first 返回的流：先产出已经取到的第一个分片，再继续读原流。
+    aclose 总是关闭原流，即使还没有开始迭代（对冲落败的一方就是这种情况）。
+    """
+
+    def __init__(self, stream, first):
+        self._stream = stream
+        self._first = first
+        self._finished = first is None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            return first
+        if self._finished:
+            raise StopAsyncIteration
+        return await self._stream.__anext__()
+
+    async def aclose(self):
+        self._first = None
+        self._finished = True
+        close = getattr(self._stream, "aclose", None) or getattr(self._stream, "close", None)
+        if close is not None:
+            await close()
+
+
+async def _peek_first(stream):
+    """等待流的第一个分片，返回一个从该分片开始、行为与原流相同的异步迭代器"""
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        await stream.aclose()
+        raise
+    return _PeekedStream(stream, first)
+
+
+def _discard(task: asyncio.Task):
+    """对冲中落败的请求如果已经建立了流，关闭它以归还连接和并发名额"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "aclose", None)
+    if close is not None:
+        asyncio.ensure_future(close())
+
+
+class LLMRouter:
+    """
+    在多个 OpenAI 兼容端点之间路由请求，对外提供 client.chat.completions.create 接口：
+      - 按最近的 p95 延迟和错误率给端点打分，选择得分最低的端点（少量随机探索，让恢复的端点重新被选中）；
+      - 端点失败时按得分顺序切换到下一个端点；
+      - 开启对冲时，首选端点超过 max(hedge_min_delay, 其 p95) 仍未返回，就向次优端点再发一次，
+        先返回者胜出，另一个被取消；
+      - 请求中的 model 会被替换为所选端点对应用途（chat / aux）的模型。
+    """
+
+    def __init__(self, endpoints: List[Endpoint], purpose: str = "chat", hedge: bool = False,
+                 hedge_min_delay: float = 0.5, explore: float = 0.05):
+        self.endpoints = [e for e in endpoints if purpose in e.purposes] or list(endpoints)
+        self.purpose = purpose
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.explore = explore
+        # 缓存键只与用途相关：同一请求无论由哪个端点回答都可以复用
+        self.base_url = f"router://{purpose}"
+        self.stats: Dict[str, EndpointStats] = {e.name: EndpointStats() for e in self.endpoints}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def rank(self) -> List[Endpoint]:
+        # 样本不足的端点得分都是 0，其中请求数少的优先，保证每个端点都能积累样本
+        ranked = sorted(self.endpoints, key=lambda e: (self.stats[e.name].score(), self.stats[e.name].requests))
+        if len(ranked) > 1 and random.random() < self.explore:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    async def _call(self, endpoint: Endpoint, request: dict):
+        """
+        向单个端点发起请求。流式请求会先等到第一个分片再返回：很多服务先返回响应头、
+        之后才开始生成，只有首个分片的到达时间才反映真实的首 token 延迟，对冲也以它为准。
+        """
+        stats = self.stats[endpoint.name]
+        started = time.perf_counter()
+        try:
+            response = await endpoint.client.create(**{**request, "model": endpoint.model_for(self.purpose)})
+            if request.get("stream"):
+                response = await _peek_first(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats.record(time.perf_counter() - started, ok=False)
+            raise
+        stats.record(time.perf_counter() - started, ok=True)
+        return response
+
+    async def _hedged(self, primary: Endpoint, backup: Endpoint, request: dict, attempted: set):
+        delay = max(self.hedge_min_delay, self.stats[primary.name].p95() or 0.0)
+        first = asyncio.ensure_future(self._call(primary, request))
+        tasks = {first: primary}
+        attempted.add(primary.name)
+        winner = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if not done:
+                metrics.count("llm_hedged")
+                tasks[asyncio.ensure_future(self._call(backup, request))] = backup
+                attempted.add(backup.name)
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+                if winner is not None:
+                    if len(tasks) > 1:
+                        self.stats[tasks[winner].name].hedge_wins += 1
+                    return winner.result()
+            raise error
+        finally:
+            # 取消仍在进行的请求；已经成功但落败的一方关闭其响应流
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                task.add_done_callback(_discard)
+
+    async def create(self, **request):
+        candidates = self.rank()
+        attempted: set = set()
+        last_error = None
+        if self.hedge and len(candidates) > 1:
+            try:
+                return await self._hedged(candidates[0], candidates[1], request, attempted)
+            except Exception as e:
+                last_error = e
+        for endpoint in candidates:
+            if endpoint.name in attempted:
+                continue
+            attempted.add(endpoint.name)
+            try:
+                return await self._call(endpoint, request)
+            except Exception as e:
+                last_error = e
+                if len(attempted) < len(candidates):
+                    metrics.count("llm_failovers")
+                    print(f"LLM endpoint {endpoint.name} failed ({e.__class__.__name__}), trying next endpoint")
+        raise last_error
+
+    def snapshot(self) -> dict:
+        return {
+            "purpose": self.purpose,
+            "endpoints": {
+                e.name: {**self.stats[e.name].snapshot(), "model": e.model_for(self.purpose), **e.client.snapshot()}
+                for e in self.endpoints
+            },
+        }
+
+
+@lru_cache(maxsize=None)
+def _endpoints() -> List[Endpoint]:
+    """从 Settings 读取端点列表；未配置 LLM_ENDPOINTS 时使用 DEEPSEEK_* 单端点"""
+    with timed("llm_client"):
+        specs = settings.LLM_ENDPOINTS or [{
+            "name": "deepseek",
+            "base_url": settings.DEEPSEEK_BASE_URL,
+            "api_key": settings.require("DEEPSEEK_API_KEY"),
+            "model": settings.DEEPSEEK_MODEL,
+            "aux_model": settings.LLM_AUX_MODEL,
+        }]
+        endpoints = []
+        for i, spec in enumerate(specs):
+            spec = dict(spec)
+            spec.setdefault("name", f"endpoint{i}")
+            spec.setdefault("api_key", settings.DEEPSEEK_API_KEY)
+            spec.setdefault("model", settings.DEEPSEEK_MODEL)
+            spec.setdefault("aux_model", settings.LLM_AUX_MODEL)
+            endpoints.append(Endpoint(**spec))
+        return endpoints
+
+
+@lru_cache(maxsize=None)
+def get_async_client() -> LLMRouter:
+    """主对话使用的客户端；首次使用时才导入 openai 并创建各端点的客户端"""
+    return LLMRouter(
+        _endpoints(), purpose="chat",
+        hedge=settings.LLM_HEDGE, hedge_min_delay=settings.LLM_HEDGE_MIN_DELAY,
+    )
+
 
-async_client = AsyncOpenAI(
-    api_key=settings.DEEPSEEK_API_KEY,
-    base_url=settings.DEEPSEEK_BASE_URL,
-)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_aux_client() -> LLMRouter:
+    """辅助调用（实体 / 三元组抽取、历史摘要）使用的客户端，路由到更小更快的模型"""
+    return LLMRouter(
+        _endpoints(), purpose="aux",
+        hedge=settings.LLM_HEDGE, hedge_min_delay=settings.LLM_HEDGE_MIN_DELAY,
+    )
@@ -1,95 +1,212 @@
 # core/llm_handler.py
-import asyncio
-import json
+import time
+from contextlib import aclosing
 from typing import AsyncGenerator
 
 # ① 从独立模块导入，避免循环导入
-from .llm_client import async_client
+from .llm_client import get_async_client, get_aux_client
 from .config import settings
-from agents.basic_tools import available_tools, tools_metadata
-from .memory_manager import memory_manager   # ② 仍保留记忆管理器
-
-conversation_history: dict[str, list[dict]] = {}
+from . import metrics
+from .llm_cache import completion_cache
+from agents.basic_tools import available_tools, tool_settings, tools_metadata
+from .session_store import SessionStore, create_session_backend, estimate_tokens
+from .tool_runtime import ToolRuntime
+
+# ② 长期记忆是可选功能组，关闭时不导入 memory_manager（及 neo4j）
+if settings.ENABLE_MEMORY:
+    from .memory_manager import memory_manager, memory_write_queue
+else:
+    memory_manager = memory_write_queue = None
+
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant named Jarvis. "
+    "You can use tools to answer questions and you have a long-term memory."
+)
+
+
+async def summarize_history(previous_summary: str, dropped: list[dict]) -> str:
+    """把被裁剪掉的旧对话合并进滚动摘要"""
+    lines = []
+    for message in dropped:
+        if message.get("role") in ("user", "assistant") and message.get("content"):
+            lines.append(f"{message['role']}: {message['content']}")
+        elif message.get("role") == "tool":
+            lines.append(f"tool({message.get('name')}): {str(message.get('content'))[:200]}")
+    prompt = (
+        "请把【已有摘要】和【新对话】合并成一段简洁的中文摘要，保留用户的事实信息、偏好和未完成的事项，"
+        f"不超过 300 字，只输出摘要本身。\n\n【已有摘要】{previous_summary or '无'}\n\n【新对话】\n"
+        + "\n".join(lines)
+    )
+    with metrics.span("session.summarize"):
+        response = await get_aux_client().chat.completions.create(
+            model=settings.DEEPSEEK_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+        )
+    return (response.choices[0].message.content or "").strip()
+
+
+session_store = SessionStore(
+    SYSTEM_PROMPT,
+    backend=create_session_backend(
+        settings.SESSION_BACKEND,
+        sqlite_path=settings.SESSION_SQLITE_PATH,
+        redis_url=settings.SESSION_REDIS_URL,
+        idle_ttl=settings.SESSION_IDLE_TTL,
+    ),
+    token_budget=settings.SESSION_TOKEN_BUDGET,
+    max_sessions=settings.SESSION_MAX_COUNT,
+    idle_ttl=settings.SESSION_IDLE_TTL,
+    max_total_tokens=settings.SESSION_MAX_TOTAL_TOKENS,
+    summarizer=summarize_history if settings.SESSION_SUMMARIZE else None,
+)
+tool_runtime = ToolRuntime(available_tools, tool_settings)
+
+
+def _merge_tool_call_deltas(pending: dict[int, dict], deltas) -> None:
+    """
+    将流式返回的 tool_call 增量按 index 拼接成完整的工具调用。
+    id / name 只在首个分片出现，arguments 会被拆成多段依次到达。
+    """
+    for delta in deltas:
+        call = pending.setdefault(
+            delta.index,
+            {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+        )
+        if delta.id:
+            call["id"] = delta.id
+        if delta.function:
+            if delta.function.name:
+                call["function"]["name"] += delta.function.name
+            if delta.function.arguments:
+                call["function"]["arguments"] += delta.function.arguments
 
 
 async def get_chat_response_stream(
-    user_message: str, session_id: str
-) -> AsyncGenerator[str, None]:
+    user_message: str, session_id: str, timing: bool = False
+) -> AsyncGenerator[dict, None]:
     """
     获取 LLM 的流式聊天响应，已整合工具调用和知识图谱记忆。
-    """
-    if session_id not in conversation_history:
-        conversation_history[session_id] = [
-            {
-                "role": "system",
-                "content": "You are a helpful AI assistant named Jarvis. "
-                           "You can use tools to answer questions and you have a long-term memory."
-            }
-        ]
+    每一轮只发起一次 stream=True 请求：文本增量即时下发，
+    tool_calls 从增量中拼接，仅当本轮以工具调用结束时才进入工具循环。
 
-    messages = conversation_history[session_id]
+    产出带类型的事件 {"event": ..., "data": ...}（见 core/sse.py）：
+    token（文本增量）、tool_start / tool_result（工具调用开始与结果）、done（结束）。
+    各阶段耗时记入 core.metrics；timing=True 时在 done 之前额外产出一个 timing 事件，
+    包含本次请求的阶段明细和计数，便于调试。
+    """
+    trace = metrics.RequestTrace("chat")
+    first_token = True
+    events = metrics.traced(trace, _chat_events(user_message, session_id))
+    async with aclosing(events):
+        async for event in events:
+            if event["event"] == "token" and first_token:
+                first_token = False
+                metrics.observe("chat.first_token", trace.started)
+            elif event["event"] == "done":
+                metrics.observe("chat.total", trace.started)
+                if timing:
+                    yield {"event": "timing", "data": trace.report()}
+            yield event
+
+
+async def _chat_events(user_message: str, session_id: str) -> AsyncGenerator[dict, None]:
+    with metrics.span("session.load"):
+        messages = await session_store.load(session_id)
 
     # 步骤1：读取记忆
-    retrieved_context = await memory_manager.retrieve_context_for_prompt(user_message)
+    retrieved_context = ""
+    if memory_manager is not None:
+        with metrics.span("memory.retrieve"):
+            retrieved_context = await memory_manager.retrieve_context_for_prompt(user_message)
     full_user_message = retrieved_context + user_message
     messages.append({"role": "user", "content": full_user_message})
 
     max_turns = 5
-    assistant_response = ""
 
     for _ in range(max_turns):
-        response = await async_client.chat.completions.create(
+        metrics.count("llm_prompt_tokens", sum(estimate_tokens(m) for m in messages))
+        started = time.perf_counter()
+        stream = await completion_cache.create(
+            get_async_client(),
+            cache=settings.LLM_CACHE_CHAT,
             model=settings.DEEPSEEK_MODEL,
             messages=messages,
             tools=tools_metadata,
             tool_choice="auto",
-        )
-        response_message = response.choices[0].message
-
-        if response_message.tool_calls:
-            messages.append(response_message)
-
-            for tool_call in response_message.tool_calls:
-                func_name = tool_call.function.name
-                func_to_call = available_tools.get(func_name)
-
-                try:
-                    func_args = json.loads(tool_call.function.arguments)
-                    yield f"\n[Jarvis is using tool: {func_name}({json.dumps(func_args)})]...\n"
-                    func_result = func_to_call(**func_args)
-                except Exception as e:
-                    func_result = f"Error executing tool {func_name}: {e}"
-
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": func_name,
-                        "content": str(func_result),
-                    }
-                )
-            continue
-
-        # 无工具调用 → 直接流式输出
-        stream = await async_client.chat.completions.create(
-            model=settings.DEEPSEEK_MODEL,
-            messages=messages,
             stream=True,
         )
-        async for chunk in stream:
-            delta = chunk.choices[0].delta.content or ""
-            if delta:
-                assistant_response += delta
-                yield delta
-                await asyncio.sleep(0.01)
+
+        assistant_response = ""
+        pending_tool_calls: dict[int, dict] = {}
+        first_chunk = True
+        # 提前结束（客户端断开）时也要关闭上游流，归还连接和并发名额
+        async with aclosing(stream):
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if first_chunk and (delta.content or delta.tool_calls):
+                    first_chunk = False
+                    metrics.observe("llm.first_token", started)
+                if delta.tool_calls:
+                    _merge_tool_call_deltas(pending_tool_calls, delta.tool_calls)
+                if delta.content:
+                    assistant_response += delta.content
+                    yield {"event": "token", "data": delta.content}
+        metrics.observe("llm.stream", started)
+
+        if pending_tool_calls:
+            tool_calls = [pending_tool_calls[i] for i in sorted(pending_tool_calls)]
+            for tool_call in tool_calls:
+                tool_call["function"]["arguments"] = tool_call["function"]["arguments"] or "{}"
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": assistant_response or None,
+                    "tool_calls": tool_calls,
+                }
+            )
+            metrics.count("llm_completion_tokens", estimate_tokens(messages[-1]))
+
+            for tool_call in tool_calls:
+                yield {
+                    "event": "tool_start",
+                    "data": {
+                        "id": tool_call["id"],
+                        "name": tool_call["function"]["name"],
+                        "arguments": tool_call["function"]["arguments"],
+                    },
+                }
+
+            # 同一条消息中的工具调用并发执行，结果按 tool_call_id 原顺序写回
+            with metrics.span("tools"):
+                tool_messages = await tool_runtime.run_tool_calls(tool_calls)
+            messages.extend(tool_messages)
+            for tool_message in tool_messages:
+                yield {
+                    "event": "tool_result",
+                    "data": {
+                        "id": tool_message["tool_call_id"],
+                        "name": tool_message["name"],
+                        "content": tool_message["content"],
+                    },
+                }
+            continue
 
         if assistant_response:
             messages.append({"role": "assistant", "content": assistant_response})
-
-            # 步骤2：写入记忆
-            await memory_manager.extract_and_store_triplets(
-                f"用户说：{user_message}。AI回复：{assistant_response}"
-            )
+            metrics.count("llm_completion_tokens", estimate_tokens(messages[-1]))
+            with metrics.span("session.save"):
+                await session_store.save(session_id, messages)
+
+            # 步骤2：写入记忆（交给后台队列，不阻塞响应流结束）
+            if memory_write_queue is not None:
+                with metrics.span("memory.submit"):
+                    await memory_write_queue.submit(user_message, assistant_response)
+        yield {"event": "done", "data": {"finish_reason": "stop"}}
         return
 
-    yield "Max tool call turns reached. Please try rephrasing your request."
\ No newline at end of file
+    with metrics.span("session.save"):
+        await session_store.save(session_id, messages)
+    yield {"event": "token", "data": "Max tool call turns reached. Please try rephrasing your request."}
+    yield {"event": "done", "data": {"finish_reason": "max_turns"}}
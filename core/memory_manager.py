@@ -1,29 +1,173 @@
 # core/memory_manager.py
-from neo4j import AsyncGraphDatabase
+import abc
+import asyncio
 import json
-from typing import List, Dict
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import List, Dict, Iterable, Optional, Tuple
 
+from . import metrics
+from .cache import LRUTTLCache
 from .config import settings
-from .llm_client import async_client   # ① 从独立模块导入，避免循环依赖
+from .entity_index import EntityIndex
+from .llm_cache import completion_cache
+from .llm_client import get_aux_client
+from .session_store import estimate_tokens
+from .startup import timed   # ① 从独立模块导入，避免循环依赖
 
 
-class Neo4jMemoryManager:
+# 检索排序：得分 = 提及次数 / (1 + 距上次出现的时间 / RECENCY_SECONDS)，第二跳再乘以 HOP_DECAY
+RECENCY_SECONDS = 30 * 86400.0
+HOP_DECAY = 0.5
+
+
+def edge_score(mentions: Optional[float], last_seen: Optional[float], now: float) -> float:
+    if last_seen is None:
+        last_seen = now
+    return (mentions or 1) / (1.0 + (now - last_seen) / RECENCY_SECONDS)
+
+
+class MemoryManager(abc.ABC):
+    """
+    长期记忆后端的公共部分：实体识别、邻域缓存、三元组抽取、向量检索、排序与 token 预算。
+    子类只负责图的存取：_entity_names / store_triplets / _query_neighborhoods / export_edges / import_edges。
+    """
+
     def __init__(self):
-        self.driver = AsyncGraphDatabase.driver(
-            settings.NEO4J_URI,
-            auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD)
+        # 实体邻域缓存：name -> (查询时的 limit, [(得分, "主语 关系 宾语."), ...], 经过的实体集合)
+        self.neighborhood_cache = LRUTTLCache(
+            maxsize=settings.MEMORY_CACHE_SIZE,
+            ttl=settings.MEMORY_CACHE_TTL,
         )
+        # 本地实体识别索引，启动时从图谱加载，写入新三元组时增量更新；
+        # 加载失败时在后台重试，并定期刷新以纳入其他 worker 写入的实体
+        self.entity_index = EntityIndex()
+        self.entity_index_stats = {"loaded": False, "loads": 0, "failures": 0}
+        self._entity_index_loaded_at: Optional[float] = None
+        self._entity_index_next_load = 0.0
+        self._entity_index_task: Optional[asyncio.Task] = None
+        # 向量检索层：事实和历史对话的嵌入，补充实体名精确匹配找不到的换一种说法的提问
+        self.vector_path: Optional[str] = settings.MEMORY_VECTOR_PATH   # None 表示只保存在内存中
+        self._vector_index = None
+
+    @property
+    def vector_index(self):
+        """首次访问时才导入 numpy 并加载向量索引；未启用时为 None"""
+        if not settings.MEMORY_VECTOR_ENABLED:
+            return None
+        if self._vector_index is None:
+            with timed("vector_index"):
+                from .vector_index import VectorIndex, create_embedder
+
+                self._vector_index = VectorIndex(
+                    create_embedder(settings.MEMORY_EMBEDDER, settings.MEMORY_EMBEDDING_DIM),
+                    path=self.vector_path,
+                    ivf_threshold=settings.MEMORY_IVF_THRESHOLD,
+                    nprobe=settings.MEMORY_IVF_NPROBE,
+                )
+        return self._vector_index
+
+    async def _run_vectors(self, fn, *args):
+        # 嵌入和矩阵运算放到线程池中，不阻塞事件循环
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def ensure_schema(self):
+        """启动时准备存储结构（约束、索引、表），默认无需操作"""
 
     async def close(self):
-        await self.driver.close()
+        if self._entity_index_task is not None:
+            self._entity_index_task.cancel()
+        if self._vector_index is not None:
+            self._vector_index.close()
 
-    async def _execute_query(self, query, parameters=None):
-        async with self.driver.session() as session:
-            result = await session.run(query, parameters)
-            return [record.data() for record in await result.list()]
+    @abc.abstractmethod
+    async def _entity_names(self) -> List[str]:
+        raise NotImplementedError
+
+    async def load_entity_index(self) -> int:
+        """从图谱加载全部实体名构建本地实体索引（同时预先加载向量索引），返回索引中的实体数"""
+        try:
+            self.entity_index.add_many(await self._entity_names())
+        except Exception:
+            self.entity_index_stats["failures"] += 1
+            self._entity_index_next_load = time.monotonic() + settings.MEMORY_ENTITY_RETRY_SECONDS
+            raise
+        now = time.monotonic()
+        first = self._entity_index_loaded_at is None
+        self._entity_index_loaded_at = now
+        refresh = settings.MEMORY_ENTITY_REFRESH_SECONDS
+        self._entity_index_next_load = now + refresh if refresh > 0 else float("inf")
+        self.entity_index_stats["loaded"] = True
+        self.entity_index_stats["loads"] += 1
+        if first:
+            print(f"Loaded {len(self.entity_index)} entities into the local entity index.")
+        await self._run_vectors(lambda: self.vector_index)
+        return len(self.entity_index)
+
+    def _refresh_entity_index(self) -> bool:
+        """
+        返回实体索引是否已加载。尚未加载（启动时图谱不可用）或到了刷新时间时，
+        在后台任务中（重新）加载，不阻塞当前请求。
+        """
+        task = self._entity_index_task
+        if time.monotonic() >= self._entity_index_next_load and (task is None or task.done()):
+            self._entity_index_task = asyncio.get_running_loop().create_task(self._load_entity_index_quietly())
+        return self._entity_index_loaded_at is not None
+
+    async def _load_entity_index_quietly(self):
+        try:
+            await self.load_entity_index()
+        except Exception as e:
+            print(f"Failed to load entity index from the memory graph "
+                  f"(retrying in {settings.MEMORY_ENTITY_RETRY_SECONDS:g}s): {e}")
+
+    def entity_index_snapshot(self) -> dict:
+        loaded_at = self._entity_index_loaded_at
+        return {
+            **self.entity_index_stats,
+            "size": len(self.entity_index),
+            "age_seconds": round(time.monotonic() - loaded_at, 1) if loaded_at is not None else None,
+        }
+
+    @abc.abstractmethod
+    async def store_triplets(self, triplets: List[Dict]) -> int:
+        """写入一批三元组，累加每条边的提及次数并更新最近出现时间，返回写入的三元组数量"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _query_neighborhoods(self, names: List[str], limit: int) -> Dict[str, List[Dict]]:
+        """
+        返回 name -> [{"subject", "relation", "object", "score", "hop"}, ...]：
+        每个实体得分最高的 limit 条边（第一跳），以及从这些邻居再扩展的 limit 条边（第二跳）。
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def export_edges(self) -> List[Dict]:
+        """导出全部边：[{"subject", "relation", "object", "mentions", "first_seen", "last_seen"}, ...]"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def import_edges(self, edges: Iterable[Dict]) -> int:
+        """导入 export_edges 的结果，已存在的边以导入的计数和时间为准（可重复执行），返回导入的边数"""
+        raise NotImplementedError
+
+    def _after_write(self, rows: List[Dict]):
+        # 缓存的邻域包含第二跳，端点本身或端点的一跳邻居发生变化时都已失效
+        touched = set()
+        for row in rows:
+            touched.add(row["subject"])
+            touched.add(row["object"])
+            self.entity_index.add(row["subject"])
+            self.entity_index.add(row["object"])
+        if touched:
+            self.neighborhood_cache.invalidate_where(lambda name, cached: not touched.isdisjoint(cached[2]))
 
     async def extract_and_store_triplets(self, text: str):
-        """使用 LLM 从文本中提取三元组并存入 Neo4j"""
+        """使用 LLM 从文本中提取三元组，通过当前后端的 store_triplets 写入图谱，并加入向量索引"""
         prompt = f"""
         从以下文本中提取知识三元组（主语, 关系, 宾语）。
         请遵循以下规则：
@@ -34,12 +178,16 @@ class Neo4jMemoryManager:
 
         文本："{text}"
         """
-        response = await async_client.chat.completions.create(
-            model=settings.DEEPSEEK_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"}
-        )
+        with metrics.span("memory.extract_triplets"):
+            response = await completion_cache.create(
+                get_aux_client(),
+                cache=True,
+                model=settings.DEEPSEEK_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"}
+            )
 
+        content = None
         try:
             content = response.choices[0].message.content
             triplets_data = json.loads(content)
@@ -48,68 +196,746 @@ class Neo4jMemoryManager:
             if not isinstance(triplets, list):
                 return
 
-            for triplet in triplets:
-                query = """
-                MERGE (s:Entity {name: $subject})
-                MERGE (o:Entity {name: $object})
-                MERGE (s)-[:RELATION {type: $relation}]->(o)
-                """
-                await self._execute_query(
-                    query,
-                    parameters={
-                        "subject": triplet.get("subject"),
-                        "object": triplet.get("object"),
-                        "relation": triplet.get("relation"),
-                    }
-                )
-            print(f"Stored {len(triplets)} triplets in Neo4j.")
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            stored = await self.store_triplets(triplets)
+            await self.index_facts(triplets)
+            print(f"Stored {stored} triplets in the memory graph.")
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
             print(f"Failed to parse or store triplets: {e}\nRaw LLM output: {content}")
 
-    async def retrieve_context_for_prompt(self, prompt: str, top_k: int = 3) -> str:
-        """根据用户提问，从知识图谱中检索相关上下文"""
+    async def fetch_neighborhoods(self, entities: List[str], limit: int) -> Dict[str, List[Tuple[float, str]]]:
+        """
+        获取多个实体的 1–2 跳邻域，返回 name -> [(得分, "主语 关系 宾语."), ...]（按得分降序）。
+        先查缓存，未命中的实体用一条查询一次性取回，没有邻居的实体也会被缓存（负缓存）。
+        """
+        found: Dict[str, List[Tuple[float, str]]] = {}
+        missing: List[str] = []
+        for name in dict.fromkeys(entities):   # 去重并保持顺序
+            cached = self.neighborhood_cache.get(name)
+            if cached is not None and cached[0] >= limit:
+                found[name] = cached[1]
+            else:
+                missing.append(name)
+        metrics.count("memory_cache_hits", len(found))
+        metrics.count("memory_cache_misses", len(missing))
+
+        if missing:
+            with metrics.span("memory.graph_read"):
+                by_name = await self._query_neighborhoods(missing, limit)
+            for name in missing:
+                edges = by_name.get(name, [])
+                facts = rank_facts(edges)
+                self.neighborhood_cache.set(name, (limit, facts, neighborhood_entities(name, edges)))
+                found[name] = facts
+        return found
+
+    async def _extract_entities_with_llm(self, prompt: str) -> List[str]:
+        """使用 LLM 从问题中抽取实体（仅作为本地索引未命中时的可选兜底）"""
         entity_extraction_prompt = (
             f"从以下问题中识别出核心实体（人、地点、组织等），"
             f"并以 JSON 列表格式返回：'{prompt}'"
         )
-        response = await async_client.chat.completions.create(
-            model=settings.DEEPSEEK_MODEL,
-            messages=[{"role": "user", "content": entity_extraction_prompt}],
-            response_format={"type": "json_object"}
-        )
+        with metrics.span("memory.entity_llm"):
+            response = await completion_cache.create(
+                get_aux_client(),
+                cache=True,
+                model=settings.DEEPSEEK_MODEL,
+                messages=[{"role": "user", "content": entity_extraction_prompt}],
+                response_format={"type": "json_object"}
+            )
+        entities_data = json.loads(response.choices[0].message.content)
+        entities = entities_data.get("entities", [])   # ② 补全默认值
+        return [str(e) for e in entities if isinstance(e, (str, int, float)) and str(e)]
 
-        try:
-            entities_data = json.loads(response.choices[0].message.content)
-            entities = entities_data.get("entities", [])   # ② 补全默认值
-            if not entities:
-                return ""
-
-            context_parts: List[str] = []
-            for entity in entities:
-                query = """
-                MATCH (n:Entity {name: $entity_name})-[r]-(m)
-                RETURN n.name AS subject, type(r) AS relation, m.name AS object
+    async def index_facts(self, triplets: List[Dict]):
+        """把三元组以 "主语 关系 宾语." 的形式加入向量索引"""
+        texts = [f"{row['subject']} {row['relation']} {row['object']}." for row in aggregate_triplets(triplets)]
+        if texts and self.vector_index is not None:
+            with metrics.span("memory.vector_write"):
+                await self._run_vectors(self.vector_index.add, texts, "fact")
+
+    async def index_turns(self, turns: List[Tuple[str, str]]):
+        """把对话轮次加入向量索引，过长的部分截断"""
+        limit = settings.MEMORY_TURN_CHARS
+        texts = [f"用户：{user[:limit]} 助手：{reply[:limit]}" for user, reply in turns]
+        if texts and self.vector_index is not None:
+            with metrics.span("memory.vector_write"):
+                await self._run_vectors(self.vector_index.add, texts, "turn")
+
+    async def _graph_facts(self, prompt: str) -> List[Tuple[float, str]]:
+        loaded = self._refresh_entity_index()
+        with metrics.span("memory.entity_match"):
+            entities = self.entity_index.find(prompt)
+        # 实体索引还没加载成功时本地匹配不可靠，改用 LLM 抽取实体
+        if not entities and (settings.MEMORY_LLM_ENTITY_FALLBACK or not loaded):
+            entities = await self._extract_entities_with_llm(prompt)
+        if not entities:
+            return []
+        neighborhoods = await self.fetch_neighborhoods(entities, settings.MEMORY_FANOUT)
+        return merge_facts(fact for scored in neighborhoods.values() for fact in scored)
+
+    async def _vector_facts(self, prompt: str) -> List[Tuple[float, str]]:
+        if self.vector_index is None:
+            return []
+        with metrics.span("memory.vector_search"):
+            hits = (await self._run_vectors(self.vector_index.search, [prompt], settings.MEMORY_VECTOR_TOP_K))[0]
+        return [(score, text) for score, text in hits if score >= settings.MEMORY_VECTOR_MIN_SCORE]
+
+    async def retrieve_context_for_prompt(
+        self, prompt: str, token_budget: int = settings.MEMORY_CONTEXT_TOKENS
+    ) -> str:
+        """
+        根据用户提问检索相关上下文：图谱（实体匹配 + 1–2 跳邻域）和向量检索并行执行，
+        两路结果按排名融合后截断到 token_budget 以内。任一路失败时只使用另一路的结果。
+        """
+        rankings = []
+        for tier, result in zip(("graph", "vector"), await asyncio.gather(
+            self._graph_facts(prompt), self._vector_facts(prompt), return_exceptions=True
+        )):
+            if isinstance(result, Exception):
+                print(f"Failed to retrieve context from the memory {tier}: {result}")
+            else:
+                rankings.append(result)
+        return format_context(fuse_rankings(rankings), token_budget)
+
+
+class Neo4jMemoryManager(MemoryManager):
+    # 单个写事务内 UNWIND 的最大行数，超大批次会被拆分成多个事务
+    WRITE_CHUNK_SIZE = 500
+
+    def __init__(self):
+        super().__init__()
+        self._driver = None
+
+    @property
+    def driver(self):
+        """首次访问时才导入 neo4j 并创建驱动"""
+        if self._driver is None:
+            with timed("neo4j_driver"):
+                from neo4j import AsyncGraphDatabase
+
+                self._driver = AsyncGraphDatabase.driver(
+                    settings.NEO4J_URI,
+                    auth=(settings.NEO4J_USER, settings.require("NEO4J_PASSWORD")),
+                    # 托管事务遇到瞬时错误（死锁、Leader 切换、连接中断）时的总重试时长
+                    max_transaction_retry_time=settings.NEO4J_WRITE_RETRY_TIME,
+                )
+        return self._driver
+
+    async def close(self):
+        await super().close()
+        if self._driver is not None:
+            await self._driver.close()
+            self._driver = None
+
+    async def _execute_query(self, query, parameters=None):
+        async with self.driver.session() as session:
+            result = await session.run(query, parameters)
+            return [record.data() for record in await result.list()]
+
+    async def ensure_schema(self):
+        """
+        启动时创建约束和索引（已存在时跳过）：Entity.name 唯一约束自带索引，
+        让 MERGE / MATCH 按名字走索引查找而不是扫描整个标签；关系类型索引用于按关系名过滤。
+        """
+        statements = [
+            "CREATE CONSTRAINT entity_name_unique IF NOT EXISTS FOR (n:Entity) REQUIRE n.name IS UNIQUE",
+            "CREATE INDEX relation_type IF NOT EXISTS FOR ()-[r:RELATION]-() ON (r.type)",
+        ]
+        for statement in statements:
+            try:
+                await self._execute_query(statement)
+            except Exception as e:
+                # 例如已有重复的实体名导致唯一约束无法创建：退回普通索引，保证查找仍然走索引
+                print(f"Failed to apply schema statement ({statement}): {e}")
+                if "CONSTRAINT" in statement:
+                    await self._execute_query(
+                        "CREATE INDEX entity_name IF NOT EXISTS FOR (n:Entity) ON (n.name)"
+                    )
+
+    async def _entity_names(self) -> List[str]:
+        results = await self._execute_query("MATCH (n:Entity) RETURN n.name AS name")
+        return [res["name"] for res in results]
+
+    @staticmethod
+    async def _run_write(tx, query, parameters):
+        result = await tx.run(query, parameters)
+        return await result.consume()
+
+    async def store_triplets(self, triplets: List[Dict]) -> int:
+        """
+        批量写入三元组：每个分块一次 UNWIND $rows MERGE，
+        放在托管写事务中执行，驱动会对瞬时错误自动重试。
+        每条边记录被提及的次数（mentions）和最近一次出现的时间（last_seen），用于检索排序。
+        返回实际写入的三元组数量。
+        """
+        rows = aggregate_triplets(triplets)
+        if not rows:
+            return 0
+
+        query = """
+        UNWIND $rows AS row
+        MERGE (s:Entity {name: row.subject})
+        MERGE (o:Entity {name: row.object})
+        MERGE (s)-[r:RELATION {type: row.relation}]->(o)
+        ON CREATE SET r.mentions = row.count, r.first_seen = $now, r.last_seen = $now
+        ON MATCH SET r.mentions = coalesce(r.mentions, 0) + row.count, r.last_seen = $now
+        """
+        with metrics.span("memory.graph_write"):
+            await self._write_rows(query, rows, time.time())
+        metrics.count("memory_triplets_written", len(rows))
+        self._after_write(rows)
+        return len(rows)
+
+    async def _write_rows(self, query: str, rows: List[Dict], now: float):
+        async with self.driver.session() as session:
+            for start in range(0, len(rows), self.WRITE_CHUNK_SIZE):
+                chunk = rows[start:start + self.WRITE_CHUNK_SIZE]
+                await session.execute_write(self._run_write, query, {"rows": chunk, "now": now})
+
+    async def _query_neighborhoods(self, names: List[str], limit: int) -> Dict[str, List[Dict]]:
+        """
+        有界的 1–2 跳排序查询：每个实体最多扫描 scan 条边，按 edge_score
+        取前 limit 条作为第一跳；再从这些邻居各扩展前 limit 条边作为第二跳（得分乘以衰减系数）。
+        返回的是关系上保存的真实关系名（r.type），而不是关系类型 RELATION。
+        """
+        query = """
+        UNWIND $names AS name
+        MATCH (n:Entity {name: name})
+        CALL {
+            WITH n
+            MATCH (n)-[r:RELATION]-(m:Entity)
+            WITH r, m LIMIT $scan
+            WITH r, m, coalesce(r.mentions, 1) / (1.0 + ($now - coalesce(r.last_seen, $now)) / $recency) AS score
+            ORDER BY score DESC
+            LIMIT $limit
+            RETURN collect({subject: startNode(r).name, relation: r.type, object: endNode(r).name,
+                            score: score, hop: 1, via: m}) AS hop1
+        }
+        CALL {
+            WITH n, hop1
+            UNWIND (CASE WHEN $hops > 1 THEN hop1 ELSE [] END) AS edge
+            CALL {
+                WITH n, edge
+                WITH n, edge, edge.via AS m
+                MATCH (m)-[r:RELATION]-(x:Entity)
+                WHERE x <> n
+                WITH edge, r LIMIT $scan
+                WITH r, edge.score * $decay * coalesce(r.mentions, 1)
+                        / (1.0 + ($now - coalesce(r.last_seen, $now)) / $recency) AS score
+                ORDER BY score DESC
                 LIMIT $limit
+                RETURN collect({subject: startNode(r).name, relation: r.type, object: endNode(r).name,
+                                score: score, hop: 2}) AS hop2
+            }
+            RETURN reduce(acc = [], edges IN collect(hop2) | acc + edges) AS second
+        }
+        RETURN name, [e IN hop1 | e {.subject, .relation, .object, .score, .hop}] + second AS edges
+        """
+        results = await self._execute_query(query, parameters={
+            "names": names,
+            "limit": limit,
+            "hops": settings.MEMORY_HOPS,
+            "scan": settings.MEMORY_SCAN_LIMIT,
+            "decay": HOP_DECAY,
+            "now": time.time(),
+            "recency": RECENCY_SECONDS,
+        })
+        return {res["name"]: res["edges"] for res in results}
+
+    async def export_edges(self) -> List[Dict]:
+        return await self._execute_query(
+            """
+            MATCH (s:Entity)-[r:RELATION]->(o:Entity)
+            RETURN s.name AS subject, r.type AS relation, o.name AS object,
+                   coalesce(r.mentions, 1) AS mentions, r.first_seen AS first_seen, r.last_seen AS last_seen
+            """
+        )
+
+    async def import_edges(self, edges: Iterable[Dict]) -> int:
+        rows = normalize_edges(edges)
+        query = """
+        UNWIND $rows AS row
+        MERGE (s:Entity {name: row.subject})
+        MERGE (o:Entity {name: row.object})
+        MERGE (s)-[r:RELATION {type: row.relation}]->(o)
+        SET r.mentions = row.mentions, r.first_seen = row.first_seen, r.last_seen = row.last_seen
+        """
+        await self._write_rows(query, rows, time.time())
+        self._after_write(rows)
+        return len(rows)
+
+
+def aggregate_triplets(triplets: List[Dict]) -> List[Dict]:
+    """校验并合并重复的三元组，count 为同一批次中出现的次数"""
+    rows: Dict[tuple, Dict] = {}
+    for triplet in triplets:
+        if not isinstance(triplet, dict):
+            continue
+        subject = triplet.get("subject")
+        relation = triplet.get("relation")
+        obj = triplet.get("object")
+        if subject and relation and obj:
+            key = (str(subject), str(relation), str(obj))
+            row = rows.setdefault(key, {"subject": key[0], "relation": key[1], "object": key[2], "count": 0})
+            row["count"] += 1
+    return list(rows.values())
+
+
+def normalize_edges(edges: Iterable[Dict]) -> List[Dict]:
+    """校验导入的边，补全旧数据中缺失的提及次数和时间"""
+    now = time.time()
+    rows = []
+    for edge in edges:
+        if not (edge.get("subject") and edge.get("relation") and edge.get("object")):
+            continue
+        last_seen = edge.get("last_seen") or now
+        rows.append({
+            "subject": str(edge["subject"]),
+            "relation": str(edge["relation"]),
+            "object": str(edge["object"]),
+            "mentions": int(edge.get("mentions") or 1),
+            "first_seen": edge.get("first_seen") or last_seen,
+            "last_seen": last_seen,
+        })
+    return rows
+
+
+def neighborhood_entities(name: str, edges: List[Dict]) -> frozenset:
+    """
+    邻域结果依赖的实体：实体本身和它的一跳邻居。这些实体中任何一个的边发生变化，
+    第一跳或从该邻居扩展的第二跳都可能改变。
+    """
+    entities = {name}
+    for edge in edges:
+        if edge.get("hop", 1) == 1:
+            entities.add(edge.get("subject"))
+            entities.add(edge.get("object"))
+    return frozenset(entities)
+
+
+def rank_facts(edges: List[Dict]) -> List[Tuple[float, str]]:
+    """把查询返回的边转换成 (得分, 事实文本)，同一条事实只保留最高得分，按得分降序"""
+    best: Dict[str, float] = {}
+    for edge in edges:
+        if not (edge.get("subject") and edge.get("relation") and edge.get("object")):
+            continue
+        fact = f"{edge['subject']} {edge['relation']} {edge['object']}."
+        score = float(edge.get("score") or 0.0)
+        if score > best.get(fact, -1.0):
+            best[fact] = score
+    return sorted(((score, fact) for fact, score in best.items()), reverse=True)
+
+
+def merge_facts(facts: Iterable[Tuple[float, str]]) -> List[Tuple[float, str]]:
+    """合并多个实体的事实，同一条事实只保留最高得分，按得分降序"""
+    best: Dict[str, float] = {}
+    for score, fact in facts:
+        best[fact] = max(score, best.get(fact, score))
+    return sorted(((score, fact) for fact, score in best.items()), reverse=True)
+
+
+def fuse_rankings(rankings: List[List[Tuple[float, str]]], k: int = 60) -> List[Tuple[float, str]]:
+    """
+    倒数排名融合（RRF）：每条结果的得分是它在各路排名中 1 / (k + 名次) 之和。
+    图谱得分（提及次数）与余弦相似度的量纲不同，只使用名次即可合并；两路都命中的结果排在前面。
+    """
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, (_, text) in enumerate(ranking, 1):
+            fused[text] = fused.get(text, 0.0) + 1.0 / (k + rank)
+    return sorted(((score, text) for text, score in fused.items()), reverse=True)
+
+
+def format_context(facts: List[Tuple[float, str]], token_budget: int) -> str:
+    """按得分从高到低放入背景知识，放不下的条目跳过，总量不超过 token 预算"""
+    selected, used = [], estimate_tokens({"content": "背景知识："})
+    for _, fact in merge_facts(facts):
+        cost = estimate_tokens({"content": fact}) - 4   # 去掉每条消息固定的格式开销
+        if used + cost > token_budget:
+            continue
+        selected.append(fact)
+        used += cost
+    if not selected:
+        return ""
+    return f"背景知识：{' '.join(selected)}\n\n"
+
+
+class EmbeddedMemoryManager(MemoryManager):
+    """
+    进程内的图谱后端：邻接索引常驻内存，检索是本地字典查找，不需要数据库服务，适合单用户桌面部署。
+    path 不为空时，每次写入同步落盘到 SQLite（WAL 模式），首次使用时整体加载；path 为 None 时只保存在内存中。
+    SQLite 调用在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__()
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._loaded = path is None
+        # (主语, 关系, 宾语) -> [提及次数, 首次出现时间, 最近出现时间]
+        self.edges: Dict[Tuple[str, str, str], list] = {}
+        # 实体名 -> 与它相连的全部边（出边和入边）
+        self.adjacency: Dict[str, List[Tuple[str, str, str]]] = defaultdict(list)
+
+    def _run(self, fn, *args):
+        def locked():
+            with self._lock:
+                return fn(*args)
+        return asyncio.get_running_loop().run_in_executor(None, locked)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
                 """
-                results = await self._execute_query(
-                    query,
-                    parameters={"entity_name": entity, "limit": top_k}
+                CREATE TABLE IF NOT EXISTS edges (
+                    subject    TEXT NOT NULL,
+                    relation   TEXT NOT NULL,
+                    object     TEXT NOT NULL,
+                    mentions   INTEGER NOT NULL,
+                    first_seen REAL NOT NULL,
+                    last_seen  REAL NOT NULL,
+                    PRIMARY KEY (subject, relation, object)
                 )
-                for res in results:
-                    context_parts.append(
-                        f"{res['subject']} {res['relation']} {res['object']}."
-                    )
+                """
+            )
+        return self._conn
+
+    def _load_rows(self) -> list:
+        return self._connect().execute(
+            "SELECT subject, relation, object, mentions, first_seen, last_seen FROM edges"
+        ).fetchall()
+
+    def _persist(self, sql: str, params: list):
+        conn = self._connect()
+        with conn:   # 一个批次一个事务
+            conn.executemany(sql, params)
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with timed("memory_graph_load"):
+            rows = await self._run(self._load_rows)
+        if not self._loaded:   # 并发的首次调用只应用一次
+            for subject, relation, obj, mentions, first_seen, last_seen in rows:
+                self._set_edge((subject, relation, obj), mentions, first_seen, last_seen)
+            self._loaded = True
+
+    def _set_edge(self, key: Tuple[str, str, str], mentions: int, first_seen: float, last_seen: float):
+        if key not in self.edges:
+            self.adjacency[key[0]].append(key)
+            if key[2] != key[0]:
+                self.adjacency[key[2]].append(key)
+        self.edges[key] = [mentions, first_seen, last_seen]
+
+    def _mention(self, key: Tuple[str, str, str], count: int, now: float):
+        state = self.edges.get(key)
+        if state is None:
+            self._set_edge(key, count, now, now)
+        else:
+            state[0] += count
+            state[2] = now
+
+    async def ensure_schema(self):
+        await self._ensure_loaded()
 
-            if not context_parts:
-                return ""
+    async def _entity_names(self) -> List[str]:
+        await self._ensure_loaded()
+        return list(self.adjacency)
 
-            context_str = " ".join(set(context_parts))  # 去重
-            return f"背景知识：{context_str}\n\n"
+    async def store_triplets(self, triplets: List[Dict]) -> int:
+        rows = aggregate_triplets(triplets)
+        if not rows:
+            return 0
+        await self._ensure_loaded()
+        now = time.time()
+        with metrics.span("memory.graph_write"):
+            if self.path:
+                await self._run(self._persist, """
+                    INSERT INTO edges (subject, relation, object, mentions, first_seen, last_seen)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (subject, relation, object)
+                    DO UPDATE SET mentions = mentions + excluded.mentions, last_seen = excluded.last_seen
+                """, [(r["subject"], r["relation"], r["object"], r["count"], now, now) for r in rows])
+            for row in rows:
+                self._mention((row["subject"], row["relation"], row["object"]), row["count"], now)
+        metrics.count("memory_triplets_written", len(rows))
+        self._after_write(rows)
+        return len(rows)
 
+    def _top_edges(self, name: str, exclude: Optional[str], limit: int, now: float) -> List[tuple]:
+        scored = []
+        for key in self.adjacency.get(name, ())[:settings.MEMORY_SCAN_LIMIT]:
+            if exclude is not None and exclude in (key[0], key[2]):
+                continue
+            state = self.edges[key]
+            scored.append((edge_score(state[0], state[2], now), key))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored[:limit]
+
+    async def _query_neighborhoods(self, names: List[str], limit: int) -> Dict[str, List[Dict]]:
+        await self._ensure_loaded()
+        now = time.time()
+        result: Dict[str, List[Dict]] = {}
+        for name in names:
+            if name not in self.adjacency:
+                continue
+            edges = []
+            for score, key in self._top_edges(name, None, limit, now):
+                edges.append({"subject": key[0], "relation": key[1], "object": key[2], "score": score, "hop": 1})
+                if settings.MEMORY_HOPS < 2:
+                    continue
+                neighbour = key[2] if key[0] == name else key[0]
+                for score2, key2 in self._top_edges(neighbour, name, limit, now):
+                    edges.append({"subject": key2[0], "relation": key2[1], "object": key2[2],
+                                  "score": score * HOP_DECAY * score2, "hop": 2})
+            result[name] = edges
+        return result
+
+    async def export_edges(self) -> List[Dict]:
+        await self._ensure_loaded()
+        return [
+            {"subject": key[0], "relation": key[1], "object": key[2],
+             "mentions": state[0], "first_seen": state[1], "last_seen": state[2]}
+            for key, state in self.edges.items()
+        ]
+
+    async def import_edges(self, edges: Iterable[Dict]) -> int:
+        rows = normalize_edges(edges)
+        await self._ensure_loaded()
+        if self.path:
+            await self._run(self._persist, """
+                INSERT OR REPLACE INTO edges (subject, relation, object, mentions, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(r["subject"], r["relation"], r["object"], r["mentions"], r["first_seen"], r["last_seen"])
+                  for r in rows])
+        for row in rows:
+            self._set_edge((row["subject"], row["relation"], row["object"]),
+                           row["mentions"], row["first_seen"], row["last_seen"])
+        self._after_write(rows)
+        return len(rows)
+
+    async def close(self):
+        await super().close()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_memory_manager(kind: str, sqlite_path: str) -> MemoryManager:
+    """根据配置创建长期记忆后端：neo4j / embedded"""
+    if kind == "neo4j":
+        return Neo4jMemoryManager()
+    if kind == "embedded":
+        return EmbeddedMemoryManager(sqlite_path)
+    raise ValueError(f"Unknown memory backend: {kind}")
+
+
+async def copy_memory(source: MemoryManager, target: MemoryManager) -> int:
+    """把 source 中的全部边导入 target（例如从 Neo4j 迁移到嵌入式后端）并建立向量索引，返回导入的边数"""
+    edges = await source.export_edges()
+    count = await target.import_edges(edges)
+    await target.index_facts(edges)
+    return count
+
+
+class MemoryWriteQueue:
+    """
+    知识图谱记忆的后台写入队列（write-behind）。
+    对话轮次先进入有界队列，由后台任务合并成一次抽取请求写入图谱，
+    使三元组抽取和图谱写入不再占用聊天响应的时间。
+
+    overflow_policy 决定队列满时的行为：
+      - "drop_oldest": 丢弃最早的一轮，保留最新对话（默认）
+      - "drop_newest": 直接丢弃新提交的一轮
+      - "block":       等待队列腾出空间（最多 put_timeout 秒，超时则丢弃）
+    """
+
+    POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(
+        self,
+        manager: MemoryManager,
+        maxsize: int = 256,
+        batch_size: int = 8,
+        flush_interval: float = 2.0,
+        overflow_policy: str = "drop_oldest",
+        put_timeout: float = 0.5,
+    ):
+        if overflow_policy not in self.POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.manager = manager
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.put_timeout = put_timeout
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._closing = False
+        self.stats = {"submitted": 0, "dropped": 0, "batches": 0, "turns_written": 0, "failed": 0}
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        """在当前事件循环中启动后台写入任务（可重复调用）"""
+        if self._worker and not self._worker.done():
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._closing = False
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, user_message: str, assistant_response: str) -> bool:
+        """提交一轮对话，返回是否成功入队"""
+        if self._closing:
+            self.stats["dropped"] += 1
+            return False
+        self.start()
+
+        turn = (user_message, assistant_response)
+        try:
+            self._queue.put_nowait(turn)
+        except asyncio.QueueFull:
+            if self.overflow_policy == "drop_newest":
+                self.stats["dropped"] += 1
+                return False
+            if self.overflow_policy == "drop_oldest":
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self.stats["dropped"] += 1
+                self._queue.put_nowait(turn)
+            else:
+                try:
+                    await asyncio.wait_for(self._queue.put(turn), self.put_timeout)
+                except asyncio.TimeoutError:
+                    self.stats["dropped"] += 1
+                    return False
+        self.stats["submitted"] += 1
+        return True
+
+    async def _next_batch(self) -> list:
+        """阻塞等待首条数据，然后在 flush_interval 内尽量凑满一个批次"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._closing:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write_batch(self, batch: list):
+        text = "\n".join(
+            f"{i}. 用户说：{user}。AI回复：{reply}"
+            for i, (user, reply) in enumerate(batch, 1)
+        )
+        try:
+            with metrics.span("memory.write_batch"):
+                await self.manager.index_turns(batch)
+                await self.manager.extract_and_store_triplets(text)
+            self.stats["batches"] += 1
+            self.stats["turns_written"] += len(batch)
         except Exception as e:
-            print(f"Failed to retrieve context from Neo4j: {e}")
-            return ""
+            self.stats["failed"] += len(batch)
+            print(f"Background memory write failed: {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            await self._write_batch(batch)
+
+    async def flush(self, timeout: Optional[float] = None):
+        """等待队列中已提交的对话全部写入"""
+        if self._queue is None:
+            return
+        self.start()
+        await asyncio.wait_for(self._queue.join(), timeout)
+
+    async def stop(self, timeout: float = 30.0):
+        """关闭时调用：拒绝新提交，尽力写完剩余数据后停止后台任务"""
+        self._closing = True
+        try:
+            await self.flush(timeout)
+        except asyncio.TimeoutError:
+            print(f"Memory write queue flush timed out, {self.depth} turns discarded.")
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
 
 
 # 全局实例
-memory_manager = Neo4jMemoryManager()
\ No newline at end of file
+memory_manager = create_memory_manager(settings.MEMORY_BACKEND, settings.MEMORY_SQLITE_PATH)
+memory_write_queue = MemoryWriteQueue(
+    memory_manager,
+    maxsize=settings.MEMORY_QUEUE_MAXSIZE,
+    batch_size=settings.MEMORY_BATCH_SIZE,
+    flush_interval=settings.MEMORY_FLUSH_INTERVAL,
+    overflow_policy=settings.MEMORY_QUEUE_POLICY,
+)
+
+def main(argv=None):
+    """
+    在两种后端之间批量导出 / 导入边：
+        python -m core.memory_manager copy neo4j embedded
+        python -m core.memory_manager export neo4j edges.jsonl
+        python -m core.memory_manager import embedded edges.jsonl
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export or import the long-term memory graph.")
+    parser.add_argument("command", choices=("copy", "export", "import"))
+    parser.add_argument("backend", choices=("neo4j", "embedded"), help="copy 的源后端，或 export / import 的后端")
+    parser.add_argument("target", help="copy 的目标后端，或 export / import 的 JSONL 文件")
+    args = parser.parse_args(argv)
+
+    async def run():
+        manager = create_memory_manager(args.backend, settings.MEMORY_SQLITE_PATH)
+        try:
+            if args.command == "copy":
+                target = create_memory_manager(args.target, settings.MEMORY_SQLITE_PATH)
+                try:
+                    count = await copy_memory(manager, target)
+                finally:
+                    await target.close()
+            elif args.command == "export":
+                edges = await manager.export_edges()
+                with open(args.target, "w", encoding="utf-8") as f:
+                    for edge in edges:
+                        f.write(json.dumps(edge, ensure_ascii=False) + "\n")
+                count = len(edges)
+            else:
+                with open(args.target, encoding="utf-8") as f:
+                    edges = [json.loads(line) for line in f if line.strip()]
+                count = await manager.import_edges(edges)
+                await manager.index_facts(edges)
+        finally:
+            await manager.close()
+        print(f"{args.command}: {count} edges")
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+# core/metrics.py
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+# 默认的延迟分桶（秒），覆盖从本地缓存命中到长时间的 LLM 流
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs: Iterable[Tuple[str, str]]) -> str:
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + body + "}" if body else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增的计数器，按标签值分组"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """累积分桶直方图，输出 _bucket / _sum / _count 三类样本"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数..., 总和, 总数]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in items:
+            pairs = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, state):
+                yield f"{self.name}_bucket", pairs + [("le", _number(bound))], count
+            yield f"{self.name}_bucket", pairs + [("le", "+Inf")], state[-1]
+            yield f"{self.name}_sum", pairs, round(state[-2], 6)
+            yield f"{self.name}_count", pairs, state[-1]
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，render() 输出 Prometheus 文本格式。
+    已有的 stats 字典（缓存命中、队列深度等）通过 collector 回调在抓取时读取，不必重复计数。
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        # 回调返回 [(name, kind, help, [(labels dict, value), ...]), ...]
+        self._collectors: List[Callable[[], list]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], list]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, pairs, value in metric.samples():
+                lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(labels.items())} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "jarvis_stage_duration_seconds", "Duration of each request stage.", ("stage",)
+)
+EVENTS = registry.counter(
+    "jarvis_events_total", "Counted events such as tokens and cache hits.", ("name",)
+)
+
+
+class RequestTrace:
+    """单个请求的阶段耗时与计数，用于调试时随 SSE 事件返回"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[dict] = []
+        self.counts: Dict[str, float] = {}
+
+    def add_span(self, stage: str, start: float, duration: float):
+        self.spans.append({
+            "stage": stage,
+            "start_ms": round((start - self.started) * 1000, 2),
+            "duration_ms": round(duration * 1000, 2),
+        })
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report(self) -> dict:
+        return {
+            "total_ms": round(self.elapsed() * 1000, 2),
+            "spans": sorted(self.spans, key=lambda item: item["start_ms"]),
+            "counts": dict(self.counts),
+        }
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("current_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+def observe(stage: str, start: float):
+    """记录从 start（time.perf_counter()）到现在的阶段耗时，用于无法包进 with 块的阶段（如跨越 yield 的流）"""
+    duration = time.perf_counter() - start
+    STAGE_SECONDS.observe(duration, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, start, duration)
+
+
+@contextmanager
+def span(stage: str):
+    """记录一个阶段的耗时：写入全局直方图，并追加到当前请求的 trace（如果有）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, start)
+
+
+def count(name: str, amount: float = 1):
+    """累加一个计数（token 数、缓存命中等），同时记入当前请求的 trace"""
+    EVENTS.inc(amount, name=name)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.counts[name] = trace.counts.get(name, 0) + amount
+
+
+async def traced(trace: RequestTrace, stream: AsyncIterator) -> AsyncIterator:
+    """
+    在 trace 的上下文中逐步驱动异步生成器。
+    生成器的每一步可能在不同的任务中被恢复（例如进程内传输），所以每一步之前都重新绑定 trace。
+    """
+    try:
+        while True:
+            _current_trace.set(trace)
+            try:
+                item = await stream.__anext__()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        _current_trace.set(trace)
+        await stream.aclose()
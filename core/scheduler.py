@@ -0,0 +1,176 @@
+# core/scheduler.py
+import asyncio
+import time
+from typing import AsyncIterator, Dict, Optional
+
+from . import metrics
+from .config import settings
+
+
+class ChatQueueFull(Exception):
+    """等待中的聊天请求已达上限"""
+
+
+class TokenBucket:
+    """
+    令牌桶限速器：平均每秒 rate 个请求，允许 burst 个突发。
+    采用预约方式：令牌不足时先记账（余额变为负数），再按欠额睡眠，等待者按到达顺序放行。
+    rate <= 0 表示不限速。
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class ChatTicket:
+    """
+    try_acquire 返回的准入凭证：已计入排队数和会话的请求数，由 run 消费并在结束时归还。
+    响应没能开始（例如客户端在开始读取之前断开、生成器从未被驱动）时，
+    release() 或对象被回收时归还（只归还一次）。
+    """
+
+    def __init__(self, scheduler: "ChatScheduler", session_id: str, entry: list):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.entry = entry
+        self.waiting = True
+        self.released = False
+
+    def started(self):
+        """排队结束（轮到执行或超时放弃），不再计入排队数"""
+        if self.waiting:
+            self.waiting = False
+            self.scheduler.waiting -= 1
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.started()
+        entry = self.entry
+        entry[1] -= 1
+        sessions = self.scheduler._sessions
+        if entry[1] == 0 and sessions.get(self.session_id) is entry:
+            del sessions[self.session_id]
+
+    def __del__(self):
+        self.release()
+
+
+class ChatScheduler:
+    """
+    /chat 的准入与调度：
+      - 同一会话的请求按到达顺序逐个执行（FIFO 锁），不会并发读写同一段历史；
+      - 全局最多 max_active 个对话同时生成，其余排队；
+      - 排队总数超过 max_waiting、或单个会话排队超过 max_per_session 时立即拒绝（API 返回 503），
+        检查与占用在 try_acquire 中一步完成；
+      - 排队超过 queue_timeout 秒仍未轮到的请求以 error 事件结束，而不是无限等待。
+
+    会话锁和各项计数都在进程内：多 worker 部署时，同一会话的请求必须由负载均衡固定路由到
+    同一个 worker，才能保证按顺序执行（见 README 的多进程部署一节）。
+    """
+
+    def __init__(
+        self,
+        max_active: int = 32,
+        max_waiting: int = 64,
+        max_per_session: int = 4,
+        queue_timeout: float = 30.0,
+    ):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.max_per_session = max_per_session
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_active)
+        self._sessions: Dict[str, list] = {}
+        self.waiting = 0
+        self.active = 0
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0, "completed": 0}
+
+    def try_acquire(self, session_id: str) -> ChatTicket:
+        """
+        检查并占用排队名额（同步执行，检查与占用之间不会插入其他请求），满了就抛出 ChatQueueFull。
+        返回的凭证交给 run；run 没有被驱动时由凭证自行归还。
+        """
+        entry = self._sessions.get(session_id)
+        if self.waiting >= self.max_waiting:
+            self.stats["rejected"] += 1
+            raise ChatQueueFull(f"{self.waiting} chat requests already waiting")
+        if entry is not None and entry[1] >= self.max_per_session:
+            self.stats["rejected"] += 1
+            raise ChatQueueFull(f"session {session_id} already has {entry[1]} requests in progress")
+        if entry is None:
+            # session_id -> [FIFO 锁, 该会话已准入（排队 + 执行中）的请求数]
+            entry = self._sessions[session_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.waiting += 1
+        self.stats["admitted"] += 1
+        return ChatTicket(self, session_id, entry)
+
+    async def _acquire(self, lock: asyncio.Lock):
+        await lock.acquire()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            lock.release()
+            raise
+
+    async def run(self, ticket: ChatTicket, events: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        """排队轮到后再驱动 events，结束（或客户端断开）时释放会话锁、全局名额和准入凭证"""
+        lock = ticket.entry[0]
+        acquired = False
+        try:
+            try:
+                with metrics.span("chat.queue_wait"):
+                    await asyncio.wait_for(self._acquire(lock), self.queue_timeout)
+                acquired = True
+            except asyncio.TimeoutError:
+                self.stats["timed_out"] += 1
+                yield {"event": "error", "data": {"message": "Server is busy, please try again later."}}
+                return
+            finally:
+                ticket.started()
+
+            self.active += 1
+            try:
+                async for event in events:
+                    yield event
+                self.stats["completed"] += 1
+            finally:
+                self.active -= 1
+        finally:
+            if acquired:
+                self._slots.release()
+                lock.release()
+            ticket.release()
+            await events.aclose()
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "sessions": len(self._sessions),
+            "max_active": self.max_active,
+        }
+
+
+chat_scheduler = ChatScheduler(
+    max_active=settings.CHAT_MAX_CONCURRENCY,
+    max_waiting=settings.CHAT_MAX_QUEUE,
+    max_per_session=settings.CHAT_MAX_PER_SESSION,
+    queue_timeout=settings.CHAT_QUEUE_TIMEOUT,
+)
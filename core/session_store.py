@@ -0,0 +1,612 @@
+# core/session_store.py
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import urlparse
+
+
+def estimate_tokens(message: dict) -> int:
+    """
+    粗略估算一条消息占用的 token 数：中日韩字符按 1 个 token 计，
+    其余字符按 4 个字符 1 个 token 计，再加上每条消息固定的格式开销。
+    """
+    text = message.get("content") or ""
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        text += function.get("name", "") + function.get("arguments", "")
+    cjk = sum(1 for c in text if "⺀" <= c <= "鿿" or "가" <= c <= "힯")
+    return cjk + (len(text) - cjk) // 4 + 4
+
+
+def split_turns(messages: List[dict]) -> List[List[dict]]:
+    """按 user 消息切分成完整的轮次，保证 assistant 的 tool_calls 与对应的 tool 消息不会被拆开"""
+    turns: List[List[dict]] = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+Summarizer = Callable[[str, List[dict]], Awaitable[str]]
+
+
+class SessionHistory(list):
+    """
+    load 返回的消息列表，额外记录读取时的记录版本和其中历史消息的条数，
+    save 据此判断会话是否在本轮期间被其他 worker 修改，并只合并本轮新增的消息。
+    """
+
+    def __init__(self, messages: List[dict], version: int, base: int):
+        super().__init__(messages)
+        self.version = version
+        self.base = base
+
+
+def _json_default(obj):
+    # 兼容 OpenAI SDK 返回的 pydantic 对象（例如未转换的 tool_calls）
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(exclude_none=True)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_record(record: dict) -> bytes:
+    """紧凑序列化会话记录：紧凑 JSON，超过 1KB 时再用 zlib 压缩，首字节标记格式"""
+    raw = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+    if len(raw) > 1024:
+        return b"z" + zlib.compress(raw, 1)
+    return b"j" + raw
+
+
+def loads_record(data: bytes) -> dict:
+    if data[:1] == b"z":
+        return json.loads(zlib.decompress(data[1:]))
+    return json.loads(data[1:])
+
+
+class SessionConflictError(RuntimeError):
+    """会话记录被其他 worker 反复并发修改，多次重试后仍未写入"""
+
+
+class SessionBackend(abc.ABC):
+    """
+    会话记录的存储后端接口。记录格式：
+    {"summary": str, "messages": list, "tokens": int, "last_access": float, "version": int}
+
+    version 每次写入加一，put 按 expected_version 做比较并交换（compare-and-set），
+    多个 worker 并发修改同一会话时后写入的一方会失败并重试，而不是直接覆盖。
+    """
+
+    @abc.abstractmethod
+    async def get(self, session_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def put(self, session_id: str, record: dict, expected_version: Optional[int] = None) -> bool:
+        """
+        写入记录并把 record["version"] 设为新版本号。expected_version 不为 None 时，
+        只有当前版本（不存在的会话为 0）与之相等才写入。未写入（版本不符或并发修改）时返回 False。
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete(self, session_id: str):
+        raise NotImplementedError
+
+    async def evict(self, max_sessions: int, idle_ttl: float, max_total_tokens: int) -> int:
+        """淘汰空闲或超出容量的会话，返回被淘汰的会话数"""
+        return 0
+
+    async def stats(self) -> dict:
+        return {}
+
+    async def close(self):
+        pass
+
+
+class InMemorySessionBackend(SessionBackend):
+    """进程内存后端，按 LRU 顺序淘汰。只适用于单 worker 部署。"""
+
+    def __init__(self):
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+        self._total_tokens = 0
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        record = self._sessions.get(session_id)
+        if record is None:
+            return None
+        self._sessions.move_to_end(session_id)
+        return {**record, "messages": list(record["messages"])}
+
+    async def put(self, session_id: str, record: dict, expected_version: Optional[int] = None) -> bool:
+        old = self._sessions.get(session_id)
+        version = old["version"] if old is not None else 0
+        if expected_version is not None and version != expected_version:
+            return False
+        if old is not None:
+            del self._sessions[session_id]
+            self._total_tokens -= old["tokens"]
+        record["version"] = version + 1
+        self._sessions[session_id] = record
+        self._total_tokens += record["tokens"]
+        return True
+
+    async def delete(self, session_id: str):
+        record = self._sessions.pop(session_id, None)
+        if record is not None:
+            self._total_tokens -= record["tokens"]
+
+    async def evict(self, max_sessions: int, idle_ttl: float, max_total_tokens: int) -> int:
+        now = time.time()
+        evicted = 0
+        while self._sessions:
+            session_id, record = next(iter(self._sessions.items()))
+            idle = now - record["last_access"] > idle_ttl
+            if not (idle or len(self._sessions) > max_sessions
+                    or self._total_tokens > max_total_tokens):
+                break
+            await self.delete(session_id)
+            evicted += 1
+        return evicted
+
+    async def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "total_tokens": self._total_tokens}
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    本地磁盘 SQLite 后端（WAL 模式），同一台机器上的多个 uvicorn worker 可以共享。
+    SQLite 调用在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10.0)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id  TEXT PRIMARY KEY,
+                data        BLOB NOT NULL,
+                tokens      INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                version     INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "version" not in columns:   # 旧版本创建的数据库
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access)")
+
+    def _run(self, fn, *args):
+        def locked():
+            with self._lock:
+                return fn(*args)
+        return asyncio.get_running_loop().run_in_executor(None, locked)
+
+    def _get(self, session_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT data, version FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "UPDATE sessions SET last_access = ? WHERE session_id = ?", (time.time(), session_id)
+        )
+        return {**loads_record(row[0]), "version": row[1]}
+
+    def _put(self, session_id: str, record: dict, expected_version: Optional[int]) -> bool:
+        # BEGIN IMMEDIATE 先取得写锁，其他进程的写入在检查版本到提交之间无法插入
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            version = row[0] if row is not None else 0
+            if expected_version is not None and version != expected_version:
+                conn.execute("ROLLBACK")
+                return False
+            record["version"] = version + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, data, tokens, last_access, version) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, dumps_record(record), record["tokens"], record["last_access"], record["version"]),
+            )
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, max_sessions: int, idle_ttl: float, max_total_tokens: int) -> int:
+        conn = self._conn
+        evicted = conn.execute("DELETE FROM sessions WHERE last_access < ?", (time.time() - idle_ttl,)).rowcount
+        evicted += conn.execute(
+            """
+            DELETE FROM sessions WHERE session_id IN (
+                SELECT session_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_sessions,),
+        ).rowcount
+        # 按最近访问时间倒序累计 token，超出总量上限的旧会话全部删除
+        evicted += conn.execute(
+            """
+            DELETE FROM sessions WHERE session_id IN (
+                SELECT session_id FROM (
+                    SELECT session_id, SUM(tokens) OVER (ORDER BY last_access DESC) AS running
+                    FROM sessions
+                ) WHERE running > ?
+            )
+            """,
+            (max_total_tokens,),
+        ).rowcount
+        return evicted
+
+    def _stats(self) -> dict:
+        count, tokens = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM sessions").fetchone()
+        return {"sessions": count, "total_tokens": tokens}
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        return await self._run(self._get, session_id)
+
+    async def put(self, session_id: str, record: dict, expected_version: Optional[int] = None) -> bool:
+        return await self._run(self._put, session_id, record, expected_version)
+
+    async def delete(self, session_id: str):
+        await self._run(self._conn.execute, "DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    async def evict(self, max_sessions: int, idle_ttl: float, max_total_tokens: int) -> int:
+        return await self._run(self._evict, max_sessions, idle_ttl, max_total_tokens)
+
+    async def stats(self) -> dict:
+        return await self._run(self._stats)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisSessionBackend(SessionBackend):
+    """
+    Redis 协议后端（需要 Redis 6.2+ 的 GETEX），多台机器上的 worker 可以共享会话。
+    内置一个极简的 RESP 客户端，不依赖 redis-py，可以直接对接 Redis、KeyDB、
+    或测试用的本地 RESP 替身。空闲淘汰交给键的过期时间（EX），
+    会话总数和内存上限交给服务端的 maxmemory 策略。
+    按版本写入使用 WATCH / MULTI / EXEC 乐观事务。
+    """
+
+    def __init__(self, url: str, idle_ttl: float, pool_size: int = 8, key_prefix: str = "jarvis:session:"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.idle_ttl = max(1, int(idle_ttl))
+        self.key_prefix = key_prefix
+        self.pool_size = pool_size
+        self._pool: Optional[asyncio.Queue] = None
+        self._created = 0
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        conn = (reader, writer)
+        if self.password:
+            await self._send(conn, "AUTH", self.password)
+        if self.db:
+            await self._send(conn, "SELECT", str(self.db))
+        return conn
+
+    @staticmethod
+    async def _read_reply(reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {payload.decode()}")
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await RedisSessionBackend._read_reply(reader) for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    @staticmethod
+    async def _send(conn, *args):
+        reader, writer = conn
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        writer.write(b"".join(parts))
+        await writer.drain()
+        return await RedisSessionBackend._read_reply(reader)
+
+    @asynccontextmanager
+    async def _connection(self):
+        """从连接池取出一个连接独占使用（WATCH 事务需要在同一连接上完成）"""
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+        if self._pool.empty() and self._created < self.pool_size:
+            self._created += 1
+            try:
+                conn = await self._connect()
+            except Exception:
+                self._created -= 1
+                raise
+        else:
+            conn = await self._pool.get()
+        try:
+            yield conn
+        except RuntimeError:
+            self._pool.put_nowait(conn)   # 服务端返回的错误，连接本身仍可用
+            raise
+        except BaseException:
+            conn[1].close()
+            self._created -= 1
+            raise
+        self._pool.put_nowait(conn)
+
+    async def _command(self, *args):
+        async with self._connection() as conn:
+            return await self._send(conn, *args)
+
+    def _key(self, session_id: str) -> str:
+        return self.key_prefix + session_id
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        # 读取的同时续期，一次往返
+        data = await self._command("GETEX", self._key(session_id), "EX", self.idle_ttl)
+        if data is None:
+            return None
+        return {"version": 0, **loads_record(data)}
+
+    async def put(self, session_id: str, record: dict, expected_version: Optional[int] = None) -> bool:
+        key = self._key(session_id)
+        async with self._connection() as conn:
+            # WATCH 之后键被其他连接修改时 EXEC 返回空，事务不执行
+            await self._send(conn, "WATCH", key)
+            current = await self._send(conn, "GET", key)
+            version = loads_record(current).get("version", 0) if current is not None else 0
+            if expected_version is not None and version != expected_version:
+                await self._send(conn, "UNWATCH")
+                return False
+            record["version"] = version + 1
+            await self._send(conn, "MULTI")
+            await self._send(conn, "SET", key, dumps_record(record), "EX", self.idle_ttl)
+            return await self._send(conn, "EXEC") is not None
+
+    async def delete(self, session_id: str):
+        await self._command("DEL", self._key(session_id))
+
+    async def stats(self) -> dict:
+        return {"keyspace_size": await self._command("DBSIZE")}
+
+    async def close(self):
+        while self._pool is not None and not self._pool.empty():
+            _, writer = self._pool.get_nowait()
+            writer.close()
+        self._created = 0
+
+
+def create_session_backend(kind: str, sqlite_path: str, redis_url: str, idle_ttl: float) -> SessionBackend:
+    """根据配置创建会话存储后端：memory / sqlite / redis"""
+    if kind == "memory":
+        return InMemorySessionBackend()
+    if kind == "sqlite":
+        return SQLiteSessionBackend(sqlite_path)
+    if kind == "redis":
+        return RedisSessionBackend(redis_url, idle_ttl)
+    raise ValueError(f"Unknown session backend: {kind}")
+
+
+class SessionStore:
+    """
+    带 token 预算的会话存储，实际数据保存在可替换的 SessionBackend 中。
+
+    - 每个会话只保存对话轮次和一段滚动摘要，系统提示词在 load 时拼接；
+    - 会话 token 数超过 token_budget 时，从最早的完整轮次开始裁剪到预算的 3/4，
+      若配置了 summarizer，被裁掉的轮次会在后台合并进滚动摘要；
+    - 由后端按 LRU 顺序淘汰空闲超过 idle_ttl 秒的会话，并限制会话总数和全部会话的 token 总量；
+    - 写入按记录版本比较并交换，多个 worker 共享后端时并发的保存和摘要回写不会互相覆盖。
+    """
+
+    # 版本冲突时的最大重试次数
+    MAX_WRITE_ATTEMPTS = 8
+
+    def __init__(
+        self,
+        system_prompt: str,
+        backend: Optional[SessionBackend] = None,
+        token_budget: int = 3000,
+        max_sessions: int = 1000,
+        idle_ttl: float = 3600.0,
+        max_total_tokens: int = 2_000_000,
+        summarizer: Optional[Summarizer] = None,
+        evict_interval: float = 5.0,
+    ):
+        self.system_prompt = system_prompt
+        self.backend = backend or InMemorySessionBackend()
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_total_tokens = max_total_tokens
+        self.summarizer = summarizer
+        self.evict_interval = evict_interval
+
+        self._last_evict = 0.0
+        self._summary_tasks: set = set()
+        self._summary_locks: dict[str, asyncio.Lock] = {}
+        self._summary_pending: dict[str, int] = {}
+        # 会话记录的读-改-写锁：save 与摘要回写互斥，避免摘要覆盖刚保存的新一轮对话
+        self._write_locks: dict[str, list] = {}
+        self.stats = {"evicted": 0, "trimmed_turns": 0, "summaries": 0, "write_conflicts": 0}
+
+    def _prompt_prefix(self, summary: str) -> List[dict]:
+        prefix = [{"role": "system", "content": self.system_prompt}]
+        if summary:
+            prefix.append({"role": "system", "content": f"以下是与用户之前对话的摘要：{summary}"})
+        return prefix
+
+    async def load(self, session_id: str) -> List[dict]:
+        """返回可直接发送给模型的消息列表（系统提示词 + 摘要 + 最近的对话轮次）"""
+        record = await self.backend.get(session_id)
+        if record is None:
+            return SessionHistory(self._prompt_prefix(""), version=0, base=0)
+        return SessionHistory(
+            self._prompt_prefix(record["summary"]) + record["messages"],
+            version=record["version"],
+            base=len(record["messages"]),
+        )
+
+    async def save(self, session_id: str, messages: List[dict]):
+        """
+        保存本轮结束后的完整消息列表（开头的系统消息会被自动去掉）。
+        messages 来自 load 时按版本比较并交换写入：会话在本轮期间被其他 worker 或摘要回写修改过，
+        就把本轮新增的消息接到最新记录之后再写，不会覆盖别人的轮次。
+        """
+        start = 0
+        while start < len(messages) and messages[start].get("role") == "system":
+            start += 1
+        history = list(messages[start:])
+        loaded_version = getattr(messages, "version", None)
+        new_messages = history[getattr(messages, "base", 0):]
+
+        async with self._write_lock(session_id):
+            for _ in range(self.MAX_WRITE_ATTEMPTS):
+                record = await self.backend.get(session_id) or {"summary": "", "messages": [], "version": 0}
+                merged = history
+                if loaded_version is not None and record["version"] != loaded_version:
+                    merged = record["messages"] + new_messages
+                merged, dropped = self._trim(merged)
+                record["messages"] = merged
+                record["tokens"] = sum(estimate_tokens(m) for m in merged) + self._summary_tokens(record["summary"])
+                record["last_access"] = time.time()
+                if await self.backend.put(session_id, record, expected_version=record["version"]):
+                    break
+                self.stats["write_conflicts"] += 1
+            else:
+                raise SessionConflictError(f"Session {session_id} was modified concurrently, giving up")
+
+        if dropped and self.summarizer is not None:
+            self._schedule_summary(session_id, dropped)
+        await self._maybe_evict()
+
+    @asynccontextmanager
+    async def _write_lock(self, session_id: str):
+        # [锁, 持有或等待的协程数]，没有人使用时删除，会话很多时不会无限增长
+        entry = self._write_locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._write_locks[session_id]
+
+    @staticmethod
+    def _summary_tokens(summary: str) -> int:
+        return estimate_tokens({"content": summary}) if summary else 0
+
+    def _trim(self, history: List[dict]) -> tuple:
+        tokens = sum(estimate_tokens(m) for m in history)
+        if tokens <= self.token_budget:
+            return history, []
+
+        turns = split_turns(history)
+        target = self.token_budget * 3 // 4
+        dropped: List[dict] = []
+        while len(turns) > 1 and tokens > target:
+            turn = turns.pop(0)
+            tokens -= sum(estimate_tokens(m) for m in turn)
+            dropped.extend(turn)
+            self.stats["trimmed_turns"] += 1
+        return [m for turn in turns for m in turn], dropped
+
+    def _schedule_summary(self, session_id: str, dropped: List[dict]):
+        self._summary_pending[session_id] = self._summary_pending.get(session_id, 0) + 1
+        task = asyncio.get_running_loop().create_task(self._summarize(session_id, dropped))
+        self._summary_tasks.add(task)
+        task.add_done_callback(self._summary_tasks.discard)
+        task.add_done_callback(lambda _: self._release_summary_lock(session_id))
+
+    def _release_summary_lock(self, session_id: str):
+        self._summary_pending[session_id] -= 1
+        if not self._summary_pending[session_id]:
+            del self._summary_pending[session_id]
+            self._summary_locks.pop(session_id, None)
+
+    async def _summarize(self, session_id: str, dropped: List[dict]):
+        # 同一会话的摘要任务串行执行，避免两次裁剪互相覆盖摘要
+        lock = self._summary_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            record = await self.backend.get(session_id)
+            previous = record["summary"] if record else ""
+            summary = None
+            for _ in range(self.MAX_WRITE_ATTEMPTS):
+                if summary is None:
+                    try:
+                        summary = await self.summarizer(previous, dropped)
+                    except Exception as e:
+                        print(f"Failed to summarize session {session_id}: {e}")
+                        return
+                # 调用摘要模型期间不持有写锁；回写时重新读取，保留期间保存的新对话，
+                # 并且只在记录版本未变时写入（版本变了就重读再试）
+                async with self._write_lock(session_id):
+                    record = await self.backend.get(session_id)
+                    if record is None:   # 会话在摘要期间已被淘汰
+                        return
+                    if record["summary"] != previous:
+                        # 其他 worker 已经更新了摘要：在新摘要的基础上重新合并
+                        previous, summary = record["summary"], None
+                        continue
+                    record["tokens"] += self._summary_tokens(summary) - self._summary_tokens(record["summary"])
+                    record["summary"] = summary
+                    if await self.backend.put(session_id, record, expected_version=record["version"]):
+                        self.stats["summaries"] += 1
+                        return
+                    self.stats["write_conflicts"] += 1
+            print(f"Failed to write back the summary of session {session_id}: too many concurrent writes")
+
+    async def _maybe_evict(self):
+        now = time.monotonic()
+        if now - self._last_evict < self.evict_interval:
+            return
+        self._last_evict = now
+        self.stats["evicted"] += await self.backend.evict(
+            self.max_sessions, self.idle_ttl, self.max_total_tokens
+        )
+
+    async def delete(self, session_id: str):
+        await self.backend.delete(session_id)
+
+    async def close(self):
+        """等待进行中的摘要任务结束，然后关闭后端"""
+        if self._summary_tasks:
+            await asyncio.gather(*self._summary_tasks, return_exceptions=True)
+        await self.backend.close()
+
+    async def snapshot(self) -> dict:
+        return {**self.stats, "backend": type(self.backend).__name__, **await self.backend.stats()}
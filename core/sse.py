@@ -0,0 +1,133 @@
+# core/sse.py
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Iterable, Iterator, Optional
+
+# 聊天流中的事件类型（timing 仅在请求要求时出现在 done 之前，包含本次请求的阶段耗时）
+EVENT_TYPES = ("token", "tool_start", "tool_result", "timing", "done", "error")
+
+
+def format_event(event: str, data) -> bytes:
+    """按 SSE 规范编码一个事件，data 统一用 JSON 编码，文本中的换行不会破坏分帧"""
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
+
+
+async def sse_stream(
+    events: AsyncIterator[dict],
+    heartbeat_interval: float = 15.0,
+    coalesce_delay: float = 0.02,
+    coalesce_bytes: int = 1024,
+    queue_size: int = 256,
+) -> AsyncIterator[bytes]:
+    """
+    把聊天事件流转换成 SSE 字节流。
+
+    - 相邻的 token 事件会被合并：已到达的 token 立即合并下发；合并内容太短时最多再等
+      coalesce_delay 秒，攒够 coalesce_bytes 字节也立即下发。客户端越慢，每帧合并得越多；
+    - 事件经过容量为 queue_size 的有界队列，客户端读得慢时生产端会被挂起（背压），
+      而不是在内存中无限堆积；
+    - 超过 heartbeat_interval 秒没有事件时发送注释行作为心跳，防止代理断开空闲连接；
+    - 生产端抛出的异常会被转换成 error 事件，流末尾总是有 done 或 error 事件。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    end = object()
+
+    async def produce():
+        # 被取消（客户端已断开）时不再放入结束标记：队列可能已满，而且已经没有读取方
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put({"event": "error", "data": {"message": str(e)}})
+        await queue.put(end)
+
+    producer = asyncio.get_running_loop().create_task(produce())
+    min_flush_bytes = 16
+    finished = False
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), heartbeat_interval)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            if item is end:
+                break
+            if item["event"] != "token":
+                finished = finished or item["event"] in ("done", "error")
+                yield format_event(item["event"], item["data"])
+                continue
+
+            # 合并连续的 token
+            parts = [item["data"]]
+            size = len(item["data"].encode("utf-8"))
+            deadline = time.monotonic() + coalesce_delay
+            pending = None
+            while size < coalesce_bytes:
+                if queue.empty():
+                    remaining = deadline - time.monotonic()
+                    if size >= min_flush_bytes or remaining <= 0:
+                        break
+                    try:
+                        nxt = await asyncio.wait_for(queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    nxt = queue.get_nowait()
+                if nxt is end or nxt["event"] != "token":
+                    pending = nxt
+                    break
+                parts.append(nxt["data"])
+                size += len(nxt["data"].encode("utf-8"))
+
+            yield format_event("token", "".join(parts))
+            if pending is end:
+                break
+            if pending is not None:
+                finished = finished or pending["event"] in ("done", "error")
+                yield format_event(pending["event"], pending["data"])
+
+        if not finished:
+            yield format_event("done", {"finish_reason": "stop"})
+    finally:
+        # 客户端断开时取消生产端，关闭上游的 LLM 流（以及调度器释放会话锁和全局名额）
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            # 只吞掉生产端自身的取消；当前任务被取消时继续向上传播
+            task = asyncio.current_task()
+            if not producer.cancelled() or (task is not None and task.cancelling()):
+                raise
+        finally:
+            await events.aclose()
+
+
+class SSEParser:
+    """增量 SSE 解析器：逐行喂入，遇到空行时返回一个完整事件（忽略心跳注释）"""
+
+    def __init__(self):
+        self.event, self.data_lines = "message", []
+
+    def feed(self, line: str) -> Optional[dict]:
+        if line == "":
+            event, data_lines = self.event, self.data_lines
+            self.event, self.data_lines = "message", []
+            if data_lines:
+                return {"event": event, "data": json.loads("\n".join(data_lines))}
+        elif line.startswith("event:"):
+            self.event = line[6:].strip()
+        elif line.startswith("data:"):
+            self.data_lines.append(line[5:].lstrip())
+        return None
+
+
+def parse_sse(lines: Iterable[str]) -> Iterator[dict]:
+    """解析 SSE 文本行，产出 {"event": ..., "data": ...} 事件"""
+    parser = SSEParser()
+    for line in lines:
+        event = parser.feed(line)
+        if event is not None:
+            yield event
@@ -0,0 +1,40 @@
+# core/startup.py
+import sys
+import time
+from contextlib import contextmanager
+
+# 尽早导入本模块（api.py 的第一个导入），以它的导入时刻作为冷启动的计时起点
+_started = time.perf_counter()
+_stages: dict[str, float] = {}
+
+# 启动报告中关注的重量级依赖：出现在已加载列表中说明对应子系统已被初始化
+HEAVY_MODULES = ("openai", "neo4j", "numpy", "soundfile", "sounddevice", "elevenlabs", "PyQt5")
+
+
+@contextmanager
+def timed(stage: str):
+    """记录一个启动阶段（或首次使用时的延迟初始化）的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stages[stage] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def mark(stage: str):
+    """记录从启动到当前时刻经过的时间，例如 “ready”"""
+    _stages[stage] = round((time.perf_counter() - _started) * 1000, 2)
+
+
+def report() -> dict:
+    return {
+        "uptime_ms": round((time.perf_counter() - _started) * 1000, 2),
+        "stages_ms": dict(_stages),
+        "loaded_heavy_modules": [m for m in HEAVY_MODULES if m in sys.modules],
+    }
+
+
+def summary() -> str:
+    stages = ", ".join(f"{name}={ms}ms" for name, ms in _stages.items())
+    loaded = ", ".join(report()["loaded_heavy_modules"]) or "none"
+    return f"Startup: {stages} | heavy modules loaded: {loaded}"
@@ -0,0 +1,213 @@
+# core/tool_runtime.py
+import asyncio
+import inspect
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from . import metrics
+from .cache import LRUTTLCache
+
+
+def _release_threadsafe(loop: asyncio.AbstractEventLoop, semaphore: asyncio.Semaphore):
+    # 执行器线程中完成的回调：回到事件循环里归还名额（事件循环已关闭时无需归还）
+    try:
+        loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:
+        pass
+
+
+class ToolRuntime:
+    """
+    工具执行运行时，保证工具调用不会阻塞事件循环。
+
+    每个工具可以在 tool_settings 中声明：
+      - executor: "async"（原生协程）/ "inline"（轻量同步函数，直接在事件循环中调用）/
+                  "thread"（阻塞 IO，放入线程池）/ "process"（CPU 密集，放入进程池）。
+                  未声明时协程函数默认 "async"，普通函数默认 "thread"。
+      - timeout: 单次调用超时（秒）；线程 / 进程中超时的调用在真正结束前仍占用并发名额
+      - max_concurrency: 该工具同时执行的最大调用数
+      - cache_ttl: 结果缓存时长（秒），声明后才会缓存该工具的结果
+      - deterministic: 相同参数总是返回相同结果；为 True 且未声明 cache_ttl 时结果永久缓存（仅按 LRU 淘汰）
+
+    缓存键为工具名 + 规范化后的 JSON 参数；相同参数的并发调用只会真正执行一次（single-flight）。
+    """
+
+    def __init__(
+        self,
+        tools: Dict[str, Callable],
+        tool_settings: Optional[Dict[str, dict]] = None,
+        default_timeout: float = 30.0,
+        default_concurrency: int = 8,
+        max_threads: int = 16,
+        max_processes: int = 2,
+        cache_size: int = 1024,
+    ):
+        self.tools = tools
+        self.tool_settings = tool_settings or {}
+        self.default_timeout = default_timeout
+        self.default_concurrency = default_concurrency
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.result_cache = LRUTTLCache(maxsize=cache_size, ttl=None)
+        # 缓存键 -> [执行中的任务, 等待者数量]
+        self._in_flight: Dict[tuple, list] = {}
+        self.cache_stats: Dict[str, Dict[str, int]] = {}
+
+    def _options(self, name: str) -> dict:
+        func = self.tools[name]
+        options = self.tool_settings.get(name, {})
+        default_executor = "async" if inspect.iscoroutinefunction(func) else "thread"
+        return {
+            "executor": options.get("executor", default_executor),
+            "timeout": options.get("timeout", self.default_timeout),
+            "max_concurrency": options.get("max_concurrency", self.default_concurrency),
+            "cache_ttl": options.get("cache_ttl"),
+            "deterministic": options.get("deterministic", False),
+        }
+
+    def _semaphore(self, name: str, limit: int) -> asyncio.Semaphore:
+        if name not in self._semaphores:
+            self._semaphores[name] = asyncio.Semaphore(limit)
+        return self._semaphores[name]
+
+    def _executor(self, kind: str):
+        if kind == "process":
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.max_processes)
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="tool")
+        return self._thread_pool
+
+    async def _invoke(self, func: Callable, executor: str, args: dict) -> Any:
+        if executor == "async":
+            return await func(**args)
+        return func(**args)
+
+    @staticmethod
+    def cache_key(name: str, args: dict) -> tuple:
+        return name, json.dumps(args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+    async def _execute(self, name: str, args: dict, options: dict) -> str:
+        func, executor, timeout = self.tools[name], options["executor"], options["timeout"]
+        semaphore = self._semaphore(name, options["max_concurrency"])
+        # 名额可能被超时后仍在运行的调用占着，等待名额同样受 timeout 限制
+        async with asyncio.timeout(timeout):
+            await semaphore.acquire()
+        if executor in ("async", "inline"):
+            try:
+                return str(await asyncio.wait_for(self._invoke(func, executor, args), timeout))
+            finally:
+                semaphore.release()
+
+        # 线程 / 进程中的调用超时后无法中断，名额要等它真正结束才归还，
+        # 否则反复超时的工具会突破 max_concurrency，并逐渐占满执行器
+        try:
+            future = self._executor(executor).submit(partial(func, **args))
+        except BaseException:
+            semaphore.release()
+            raise
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: _release_threadsafe(loop, semaphore))
+        return str(await asyncio.wait_for(asyncio.wrap_future(future), timeout))
+
+    async def _execute_cached(self, name: str, args: dict, options: dict) -> str:
+        stats = self.cache_stats.setdefault(name, {"hits": 0, "misses": 0, "coalesced": 0})
+        key = self.cache_key(name, args)
+
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            stats["hits"] += 1
+            metrics.count("tool_cache_hits")
+            return cached
+
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            stats["coalesced"] += 1
+            metrics.count("tool_cache_coalesced")
+        else:
+            stats["misses"] += 1
+            metrics.count("tool_cache_misses")
+            task = asyncio.get_running_loop().create_task(self._execute_shared(key, name, args, options))
+            entry = self._in_flight[key] = [task, 0]
+
+        # 共享的调用在独立任务中执行，各等待者通过 shield 等待：
+        # 某个等待者被取消（例如客户端断开）只会让它自己离开，不影响其他会话；最后一个等待者离开时才取消调用
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+                if self._in_flight.get(key) is entry:
+                    del self._in_flight[key]
+
+    async def _execute_shared(self, key: tuple, name: str, args: dict, options: dict) -> str:
+        try:
+            result = await self._execute(name, args, options)
+            self.result_cache.set(key, result, ttl=options["cache_ttl"])
+            return result
+        finally:
+            entry = self._in_flight.get(key)
+            if entry is not None and entry[0] is asyncio.current_task():
+                del self._in_flight[key]
+
+    async def run(self, name: str, args: dict) -> str:
+        """执行单个工具，异常和超时都转换成返回给模型的错误文本（错误结果不会被缓存）"""
+        if name not in self.tools:
+            return f"Error executing tool {name}: unknown tool"
+        options = self._options(name)
+        cacheable = options["cache_ttl"] is not None or options["deterministic"]
+        try:
+            with metrics.span(f"tool.{name}"):
+                if cacheable:
+                    return await self._execute_cached(name, args, options)
+                return await self._execute(name, args, options)
+        except asyncio.TimeoutError:
+            return f"Error executing tool {name}: timed out after {options['timeout']}s"
+        except Exception as e:
+            return f"Error executing tool {name}: {e}"
+
+    def cache_report(self) -> dict:
+        """各工具的缓存命中统计"""
+        tools = {}
+        for name, stats in self.cache_stats.items():
+            lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+            saved = stats["hits"] + stats["coalesced"]
+            tools[name] = {**stats, "hit_rate": round(saved / lookups, 4) if lookups else 0.0}
+        return {"cache": self.result_cache.snapshot(), "tools": tools}
+
+    async def run_tool_calls(self, tool_calls: List[dict]) -> List[dict]:
+        """
+        并发执行同一条 assistant 消息中的全部工具调用，
+        返回的 tool 消息与 tool_calls 的原始顺序一一对应。
+        """
+        async def run_one(tool_call: dict) -> dict:
+            func_name = tool_call["function"]["name"]
+            try:
+                func_args = json.loads(tool_call["function"]["arguments"] or "{}")
+                content = await self.run(func_name, func_args)
+            except Exception as e:
+                content = f"Error executing tool {func_name}: {e}"
+            return {
+                "tool_call_id": tool_call["id"],
+                "role": "tool",
+                "name": func_name,
+                "content": content,
+            }
+
+        return list(await asyncio.gather(*(run_one(tc) for tc in tool_calls)))
+
+    def shutdown(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._process_pool = None
@@ -0,0 +1,137 @@
+# core/transport.py
+import abc
+import asyncio
+import sys
+import threading
+from typing import Iterator, Optional
+
+from .config import settings
+from .sse import parse_sse
+
+# FastAPI 服务所在的事件循环（由 api.py 的 lifespan 在启动时注册）
+_server_loop: Optional[asyncio.AbstractEventLoop] = None
+_server_loop_ready = threading.Event()
+
+
+def register_server_loop(loop: Optional[asyncio.AbstractEventLoop]):
+    """api.py 启动 / 关闭时调用，供同进程的 GUI 直接把协程提交到服务的事件循环"""
+    global _server_loop
+    _server_loop = loop
+    if loop is None:
+        _server_loop_ready.clear()
+    else:
+        _server_loop_ready.set()
+
+
+class ChatTransport(abc.ABC):
+    """GUI 与聊天引擎之间的传输层接口"""
+
+    @abc.abstractmethod
+    def chat(self, message: str, session_id: str = "default_session") -> Iterator[dict]:
+        """产出带类型的聊天事件 {"event": ..., "data": ...}，事件类型见 core/sse.py"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def transcribe(self, data: bytes, filename: str = "audio.wav", content_type: str = "audio/wav") -> str:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class HttpTransport(ChatTransport):
+    """通过 HTTP 访问（远程）API 服务，使用带连接池的 keep-alive 会话"""
+
+    def __init__(self, api_url: str, pool_size: int = 4):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_url = api_url.rstrip("/")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def chat(self, message: str, session_id: str = "default_session") -> Iterator[dict]:
+        response = self.session.post(
+            f"{self.api_url}/chat",
+            json={"message": message, "session_id": session_id},
+            stream=True
+        )
+        response.raise_for_status()
+        with response:
+            # iter_lines 按字节切分行，多字节字符不会被拆开；解码后交给 SSE 解析器
+            lines = (line.decode("utf-8") for line in response.iter_lines(chunk_size=None))
+            yield from parse_sse(lines)
+
+    def transcribe(self, data: bytes, filename: str = "audio.wav", content_type: str = "audio/wav") -> str:
+        files = {"file": (filename, data, content_type)}
+        r = self.session.post(f"{self.api_url}/transcribe", files=files)
+        r.raise_for_status()
+        return r.json().get("transcription", "")
+
+    def close(self):
+        self.session.close()
+
+
+class InProcessTransport(ChatTransport):
+    """
+    与 API 服务同进程运行时使用：直接把 get_chat_response_stream 和转录任务
+    提交到服务的事件循环执行，直接拿到事件对象，省去回环 HTTP 的连接、SSE 分帧和 JSON 编解码。
+    """
+
+    def __init__(self, ready_timeout: float = 30.0):
+        self.ready_timeout = ready_timeout
+
+    def _loop(self) -> asyncio.AbstractEventLoop:
+        if not _server_loop_ready.wait(self.ready_timeout):
+            raise RuntimeError("API event loop is not running")
+        return _server_loop
+
+    def chat(self, message: str, session_id: str = "default_session") -> Iterator[dict]:
+        from .llm_handler import get_chat_response_stream
+        from .scheduler import chat_scheduler
+
+        loop = self._loop()
+
+        async def admit():
+            # 准入状态只在服务循环上修改
+            return chat_scheduler.try_acquire(session_id)
+
+        ticket = asyncio.run_coroutine_threadsafe(admit(), loop).result()
+        stream = chat_scheduler.run(ticket, get_chat_response_stream(message, session_id))
+
+        async def next_chunk():
+            return await stream.__anext__()
+
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(next_chunk(), loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            # 调用方提前停止读取时，在服务循环上关闭生成器以释放资源
+            asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result(timeout=5)
+
+    def transcribe(self, data: bytes, filename: str = "audio.wav", content_type: str = "audio/wav") -> str:
+        from .voice_handler import transcription_pool
+
+        coro = transcription_pool.transcribe(data, filename=filename, content_type=content_type)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop()).result()
+
+
+def create_transport(mode: str = settings.GUI_TRANSPORT) -> ChatTransport:
+    """
+    选择 GUI 的传输方式：
+      - "inprocess": 直接调用同进程的聊天引擎
+      - "http": 通过 HTTP 访问 API 服务
+      - "auto": 若 FastAPI 应用已在当前进程中加载（由 run.py 启动），使用 inprocess，否则使用 http
+    """
+    if mode == "auto":
+        mode = "inprocess" if "api" in sys.modules else "http"
+    if mode == "inprocess":
+        return InProcessTransport()
+    if mode == "http":
+        return HttpTransport(f"http://{settings.API_HOST}:{settings.API_PORT}")
+    raise ValueError(f"Unknown GUI transport: {mode}")
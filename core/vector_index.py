@@ -0,0 +1,291 @@
+# core/vector_index.py
+import json
+import os
+import re
+import threading
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 暴力检索时每次参与矩阵乘法的行数，限制内存映射文件一次读入的大小
+SEARCH_BLOCK_ROWS = 65536
+
+
+class HashingEmbedder:
+    """
+    特征哈希嵌入：中文按单字和相邻二字、英文数字按单词和三字母片段切分，
+    每个特征用 crc32 映射到 dim 维中的一维（并带正负号），再做 L2 归一化。
+    完全离线、无需模型文件，能匹配用词有重叠的不同说法。
+    """
+
+    name = "hashing"
+    _token = re.compile(r"[一-鿿]+|[a-z0-9]+")
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def features(self, text: str) -> Dict[str, float]:
+        weights: Dict[str, float] = {}
+        for token in self._token.findall(text.lower()):
+            if token[0] >= "一":
+                grams = [(c, 0.5) for c in token] + [(token[i:i + 2], 1.0) for i in range(len(token) - 1)]
+            else:
+                padded = f"#{token}#"
+                grams = [(token, 1.0)] + [(padded[i:i + 3], 0.5) for i in range(len(padded) - 2)]
+            for gram, weight in grams:
+                weights[gram] = weights.get(gram, 0.0) + weight
+        return weights
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram, weight in self.features(text).items():
+                h = zlib.crc32(gram.encode("utf-8"))
+                # 重复出现的特征按对数增长，避免长文本被个别高频字主导
+                vectors[row, h % self.dim] += np.log1p(weight) if h & 0x80000000 else -np.log1p(weight)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    """本地 sentence-transformers 模型（需要自行安装并提前下载模型，运行时不联网）"""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.name = f"sentence-transformers:{model_name}"
+        self._model = SentenceTransformer(model_name)
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = self._model.encode(texts, normalize_embeddings=True, convert_to_numpy=True)
+        return vectors.astype(np.float32, copy=False)
+
+
+def create_embedder(spec: str, dim: int = 512):
+    """根据配置创建嵌入器：hashing / sentence-transformers:<模型名或本地路径>"""
+    if spec == "hashing":
+        return HashingEmbedder(dim)
+    if spec.startswith("sentence-transformers:"):
+        return SentenceTransformerEmbedder(spec.split(":", 1)[1])
+    raise ValueError(f"Unknown embedder: {spec}")
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """对 (查询数, 候选数) 的得分矩阵逐行取前 k 个，返回按得分降序的 (下标, 得分)"""
+    k = min(k, scores.shape[1])
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class VectorIndex:
+    """
+    稠密向量检索：全部向量按行存放在一个连续的 float32 矩阵中，查询是批量的矩阵乘法加 top-k。
+    path 不为空时矩阵是内存映射文件 <path>.f32，文本存放在 <path>.jsonl（首行记录嵌入器与维度），
+    容量不足时文件按倍数扩容；path 为 None 时只保存在内存中。
+    向量数达到 ivf_threshold 后构建 IVF 分区（球面 k-means 聚类），查询只扫描最近的 nprobe 个分区。
+    所有方法都是同步的，可以放到线程池中执行；内部用锁保护。
+    """
+
+    def __init__(self, embedder, path: Optional[str] = None, ivf_threshold: int = 20000, nprobe: int = 8):
+        self.embedder = embedder
+        self.dim = embedder.dim
+        self.path = path
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self.texts: List[str] = []
+        self.kinds: List[str] = []
+        self._rows: Dict[str, int] = {}   # 文本 -> 行号，相同文本只保存一次
+        self._matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self._meta = None
+        # IVF 状态：质心、每行所属分区、构建时的行数（增长一倍后重建）
+        self._centroids: Optional[np.ndarray] = None
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._ivf_rows = 0
+        # 倒排表：按分区排序后的行号，以及每个分区在其中的起止位置（新增向量后延迟重建）
+        self._order: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+        self.stats = {"searches": 0, "ivf_searches": 0, "added": 0, "ivf_builds": 0}
+        if path:
+            self._open()
+
+    @property
+    def size(self) -> int:
+        return len(self.texts)
+
+    def _header(self) -> dict:
+        return {"embedder": self.embedder.name, "dim": self.dim}
+
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        meta_path, vec_path = f"{self.path}.jsonl", f"{self.path}.f32"
+        entries = []
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            if lines and json.loads(lines[0]) == self._header():
+                entries = [json.loads(line) for line in lines[1:]]
+            else:
+                # 嵌入器或维度变了，旧向量不再可比，从头开始
+                print(f"Vector index at {self.path} was built with a different embedder, rebuilding.")
+                os.remove(meta_path)
+                if os.path.exists(vec_path):
+                    os.remove(vec_path)
+        capacity = os.path.getsize(vec_path) // (4 * self.dim) if os.path.exists(vec_path) else 0
+        if len(entries) > capacity:
+            # 向量文件比文本短（被删除或截断）：丢弃没有向量的文本，保证之后追加的行号对齐
+            entries = entries[:capacity]
+            with open(meta_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(self._header()) + "\n")
+                f.writelines(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+        if capacity:
+            self._matrix = np.memmap(vec_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        for entry in entries:
+            self._rows[entry["text"]] = len(self.texts)
+            self.texts.append(entry["text"])
+            self.kinds.append(entry["kind"])
+        new_meta = not os.path.exists(meta_path)
+        self._meta = open(meta_path, "a", encoding="utf-8")
+        if new_meta:
+            self._meta.write(json.dumps(self._header()) + "\n")
+            self._meta.flush()
+
+    def _reserve(self, rows: int):
+        capacity = self._matrix.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        if self.path:
+            vec_path = f"{self.path}.f32"
+            if isinstance(self._matrix, np.memmap):
+                self._matrix.flush()
+            self._matrix = None
+            with open(vec_path, "ab") as f:
+                f.truncate(capacity * self.dim * 4)
+            self._matrix = np.memmap(vec_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        else:
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[:self.size] = self._matrix[:self.size]
+            self._matrix = grown
+
+    def add(self, texts: List[str], kind: str) -> int:
+        """嵌入并追加新文本（已存在的跳过），返回新增的条数"""
+        with self._lock:
+            new = [t for t in dict.fromkeys(texts) if t and t not in self._rows]
+            if not new:
+                return 0
+            vectors = self.embedder.embed(new)
+            start = self.size
+            self._reserve(start + len(new))
+            self._matrix[start:start + len(new)] = vectors
+            if self._centroids is not None:
+                self._assign = np.concatenate([self._assign, self._nearest_partition(vectors)])
+                self._order = None
+            for text in new:
+                self._rows[text] = len(self.texts)
+                self.texts.append(text)
+                self.kinds.append(kind)
+            if self._meta is not None:
+                if isinstance(self._matrix, np.memmap):
+                    self._matrix.flush()
+                self._meta.write("".join(json.dumps({"text": t, "kind": kind}, ensure_ascii=False) + "\n" for t in new))
+                self._meta.flush()
+            self.stats["added"] += len(new)
+            return len(new)
+
+    def _nearest_partition(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _build_ivf(self, iterations: int = 10, sample_size: int = 50000, seed: int = 0):
+        """在样本上做球面 k-means 得到 sqrt(n) 个质心，再把全部向量分配到最近的质心"""
+        n = self.size
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self._matrix[rng.choice(n, min(n, sample_size), replace=False)])
+        # 质心数不能超过样本数（阈值设得很小时向量可能少于 16 个）
+        nlist = max(1, min(int(min(4096, max(16, np.sqrt(n)))), len(sample)))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            present, starts = np.unique(labels[order], return_index=True)
+            sums = np.zeros_like(centroids)
+            sums[present] = np.add.reduceat(sample[order], starts, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # 空分区保留原质心
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        self._centroids = centroids.astype(np.float32)
+        self._assign = np.concatenate([
+            self._nearest_partition(np.asarray(self._matrix[i:min(n, i + SEARCH_BLOCK_ROWS)]))
+            for i in range(0, n, SEARCH_BLOCK_ROWS)
+        ])
+        self._ivf_rows = n
+        self._order = None
+        self.stats["ivf_builds"] += 1
+
+    def _search_flat(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        best_idx = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, self.size, SEARCH_BLOCK_ROWS):
+            block = self._matrix[start:min(self.size, start + SEARCH_BLOCK_ROWS)]
+            idx, scores = top_k(queries @ block.T, k)
+            idx, scores = top_k_merge(best_idx, best_scores, idx + start, scores, k)
+            best_idx, best_scores = idx, scores
+        return best_idx, best_scores
+
+    def _search_ivf(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if self._order is None:
+            self._order = np.argsort(self._assign, kind="stable")
+            self._offsets = np.searchsorted(self._assign[self._order], np.arange(len(self._centroids) + 1))
+        probes, _ = top_k(queries @ self._centroids.T, self.nprobe)
+        results = []
+        for query, probe in zip(queries, probes):
+            rows = np.concatenate([self._order[self._offsets[p]:self._offsets[p + 1]] for p in probe])
+            if not len(rows):
+                results.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)))
+                continue
+            idx, scores = top_k((self._matrix[rows] @ query)[None, :], k)
+            results.append((rows[idx[0]], scores[0]))
+        return results
+
+    def search(self, queries: List[str], k: int) -> List[List[Tuple[float, str]]]:
+        """批量检索，每个查询返回按余弦相似度降序的 [(得分, 文本), ...]"""
+        vectors = self.embedder.embed(queries)
+        with self._lock:
+            self.stats["searches"] += len(queries)
+            if not self.size or k <= 0:
+                return [[] for _ in queries]
+            if self.ivf_threshold and self.size >= self.ivf_threshold:
+                if self._centroids is None or self.size >= 2 * self._ivf_rows:
+                    self._build_ivf()
+                self.stats["ivf_searches"] += len(queries)
+                pairs = self._search_ivf(vectors, k)
+            else:
+                idx, scores = self._search_flat(vectors, k)
+                pairs = list(zip(idx, scores))
+            return [
+                [(float(score), self.texts[row]) for row, score in zip(rows, scores)]
+                for rows, scores in pairs
+            ]
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "size": self.size, "ivf": self._centroids is not None}
+
+    def close(self):
+        with self._lock:
+            if isinstance(self._matrix, np.memmap):
+                self._matrix.flush()
+            if self._meta is not None:
+                self._meta.close()
+                self._meta = None
+
+
+def top_k_merge(idx_a, scores_a, idx_b, scores_b, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """合并两组逐行的 top-k 结果"""
+    idx = np.concatenate([idx_a, idx_b], axis=1)
+    scores = np.concatenate([scores_a, scores_b], axis=1)
+    order, merged = top_k(scores, k)
+    return np.take_along_axis(idx, order, axis=1), merged
@@ -1,64 +1,633 @@
 # core/voice_handler.py
-from openai import OpenAI
-from elevenlabs.client import ElevenLabs
-from elevenlabs import play, stream
-import sounddevice as sd
-import numpy as np
-from scipy.io.wavfile import write
-import tempfile
+import asyncio
+import hashlib
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Iterator, List, NamedTuple, Optional
+import time
 import os
 
+from . import metrics
 from.config import settings
+from .startup import timed
+
+# openai、elevenlabs、sounddevice、numpy、soundfile 都在首次使用时才导入，
+# 只用文字聊天的进程不会为音频子系统付出启动开销
 
 # --- STT (Speech-to-Text) using Whisper ---
-stt_client = OpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    base_url=settings.OPENAI_BASE_URL
-)
+@lru_cache(maxsize=None)
+def get_async_stt_client():
+    with timed("async_stt_client"):
+        from openai import AsyncOpenAI
 
-def transcribe_audio_file(file_path: str) -> str:
-    """使用Whisper API转录音频文件"""
-    with open(file_path, "rb") as audio_file:
-        transcript = stt_client.audio.transcriptions.create(
-            model=settings.WHISPER_MODEL,
-            file=audio_file
+        return AsyncOpenAI(
+            api_key=settings.require("OPENAI_API_KEY"),
+            base_url=settings.OPENAI_BASE_URL
         )
-    return transcript.text
+
+
+class TranscriptionQueueFull(Exception):
+    """等待中的转录任务已达上限"""
+
+
+class TranscriptionPool:
+    """
+    异步转录任务池：限制同时进行的 STT 请求数，超出的任务排队等待，
+    排队数超过 max_waiting 时直接拒绝，避免上传堆积拖垮服务。
+    """
+
+    def __init__(self, max_concurrency: int = 4, max_waiting: int = 32):
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.active = 0
+        self.stats = {"completed": 0, "failed": 0, "rejected": 0}
+
+    async def transcribe(self, data: bytes, filename: str, content_type: str = "audio/wav") -> str:
+        """直接把内存中的音频数据交给异步 STT 客户端，不落盘"""
+        if self.waiting >= self.max_waiting:
+            self.stats["rejected"] += 1
+            raise TranscriptionQueueFull(f"{self.waiting} transcription jobs already waiting")
+
+        self.waiting += 1
+        try:
+            with metrics.span("stt.queue_wait"):
+                await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        metrics.count("stt_audio_bytes", len(data))
+        try:
+            with metrics.span("stt.transcribe"):
+                transcript = await get_async_stt_client().audio.transcriptions.create(
+                    model=settings.WHISPER_MODEL,
+                    file=(filename, data, content_type),
+                )
+            self.stats["completed"] += 1
+            return transcript.text
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_concurrency": self.max_concurrency,
+        }
+
+
+transcription_pool = TranscriptionPool(
+    max_concurrency=settings.STT_MAX_CONCURRENCY,
+    max_waiting=settings.STT_MAX_QUEUE,
+)
 
 # --- TTS (Text-to-Speech) using ElevenLabs ---
-tts_client = ElevenLabs(api_key=settings.ELEVENLABS_API_KEY)
+@lru_cache(maxsize=None)
+def get_tts_client():
+    with timed("tts_client"):
+        from elevenlabs.client import ElevenLabs
+
+        return ElevenLabs(api_key=settings.require("ELEVENLABS_API_KEY"))
+
+@lru_cache(maxsize=64)
+def resolve_voice_id(voice: str) -> str:
+    """TTS_VOICE 可以填声音名称（如 Rachel）或 voice_id；名称通过声音库搜索换成 voice_id"""
+    if len(voice) == 20 and voice.isascii() and voice.isalnum():
+        return voice
+    voices = get_tts_client().voices.search(search=voice).voices
+    for v in voices:
+        if v.name.lower() == voice.lower():
+            return v.voice_id
+    if voices:
+        return voices[0].voice_id
+    raise ValueError(f"Unknown ElevenLabs voice: {voice}")
 
-def synthesize_speech_and_play(text: str):
-    """合成语音并直接播放"""
-    audio = tts_client.generate(
+def tts_stream(text: str, voice: str, model: str, output_format: str) -> Iterator[bytes]:
+    """流式合成语音，返回音频分片的同步迭代器（阻塞，需在线程中消费）"""
+    return get_tts_client().text_to_speech.stream(
+        resolve_voice_id(voice),
         text=text,
-        voice="Rachel", # 可以选择你喜欢的声音
-        model="eleven_multilingual_v2"
+        model_id=model,
+        output_format=output_format,
     )
-    play(audio)
-
-def synthesize_speech_stream(text_generator):
-    """接收一个文本生成器，流式合成并播放语音"""
-    audio_stream = tts_client.generate(
-        text=text_generator,
-        voice="Rachel",
-        model="eleven_multilingual_v2",
-        stream=True
-    )
-    stream(audio_stream)
+
+
+# --- 边生成边朗读的语音流水线 ---
+SENTENCE_ENDINGS = "。！？!?；;…\n"
+CLAUSE_ENDINGS = "，、,：:"
+
+class SentenceSegmenter:
+    """
+    把流式到达的文本切成适合朗读的片段：遇到句末标点立即切分，
+    片段足够长时也会在逗号等分句标点处切分。英文句点只有后面跟空白时才算句末，
+    以免把小数和缩写切断。第一个片段使用更短的长度阈值，以便尽早开始播放。
+    """
+
+    def __init__(self, min_clause_chars: int = 24, first_clause_chars: int = 8):
+        self.min_clause_chars = min_clause_chars
+        self.first_clause_chars = first_clause_chars
+        self._buffer = ""
+        self._emitted = 0
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        segments = []
+        start = 0
+        for i in range(len(self._buffer)):
+            if self._is_boundary(start, i):
+                segment = self._buffer[start:i + 1].strip()
+                start = i + 1
+                if segment:
+                    segments.append(segment)
+                    self._emitted += 1
+        self._buffer = self._buffer[start:]
+        return segments
+
+    def _is_boundary(self, start: int, i: int) -> bool:
+        c = self._buffer[i]
+        if c in SENTENCE_ENDINGS:
+            return True
+        if c == "." and i + 1 < len(self._buffer) and self._buffer[i + 1].isspace():
+            return True
+        if c in CLAUSE_ENDINGS:
+            threshold = self.first_clause_chars if self._emitted == 0 else self.min_clause_chars
+            return i + 1 - start >= threshold
+        return False
+
+    def flush(self) -> List[str]:
+        segment = self._buffer.strip()
+        self._buffer = ""
+        return [segment] if segment else []
+
+
+class SpeechPipeline:
+    """
+    流式语音输出：文本片段一到就并发提交 TTS（PCM 输出），
+    播放线程按片段顺序从各自的缓冲队列取音频写入声卡。
+    当前片段边合成边播放，后续片段在后台提前合成，起到抖动缓冲的作用。
+    """
+
+    def __init__(self, synth_workers: int = 2, sample_rate: int = 22050):
+        self.sample_rate = sample_rate
+        self.segmenter = SentenceSegmenter()
+        self._executor = ThreadPoolExecutor(max_workers=synth_workers, thread_name_prefix="tts")
+        self._segments: "queue.Queue[Optional[queue.Queue]]" = queue.Queue()
+        self._stopped = threading.Event()
+        self._player = threading.Thread(target=self._play_loop, daemon=True)
+        self._player.start()
+
+    def feed(self, text: str):
+        for segment in self.segmenter.feed(text):
+            self._submit(segment)
+
+    def finish(self):
+        """文本流结束：提交剩余文本，播放完已提交的片段后自动退出"""
+        for segment in self.segmenter.flush():
+            self._submit(segment)
+        self._segments.put(None)
+        self._executor.shutdown(wait=False)
+
+    def stop(self):
+        """立即停止合成和播放"""
+        self._stopped.set()
+        self._segments.put(None)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait(self, timeout: Optional[float] = None):
+        self._player.join(timeout)
+
+    def _submit(self, segment: str):
+        if self._stopped.is_set():
+            return
+        audio_queue: queue.Queue = queue.Queue()
+        self._segments.put(audio_queue)
+        self._executor.submit(self._synthesize, segment, audio_queue)
+
+    def _synthesize(self, segment: str, audio_queue: queue.Queue):
+        started = time.perf_counter()
+        first = True
+        try:
+            for chunk in tts_stream(segment, settings.TTS_VOICE, settings.TTS_MODEL, f"pcm_{self.sample_rate}"):
+                if self._stopped.is_set():
+                    break
+                if chunk:
+                    if first:
+                        first = False
+                        metrics.observe("tts.segment_first_chunk", started)
+                    audio_queue.put(chunk)
+        except Exception as e:
+            print(f"TTS synthesis failed for segment {segment!r}: {e}")
+        finally:
+            audio_queue.put(None)
+
+    def _play_loop(self):
+        import numpy as np
+        import sounddevice as sd
+
+        with sd.OutputStream(samplerate=self.sample_rate, channels=1, dtype="int16") as out:
+            while not self._stopped.is_set():
+                audio_queue = self._segments.get()
+                if audio_queue is None:
+                    break
+                leftover = b""
+                while not self._stopped.is_set():
+                    chunk = audio_queue.get()
+                    if chunk is None:
+                        break
+                    data = leftover + chunk
+                    usable = len(data) - len(data) % 2   # 16 位采样，分片可能在采样中间断开
+                    leftover = data[usable:]
+                    if usable:
+                        out.write(np.frombuffer(data[:usable], dtype=np.int16))
+
+
+# 客户端可选择的输出格式前缀 -> HTTP 媒体类型
+AUDIO_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "pcm": "audio/L16",
+    "ulaw": "audio/basic",
+    "alaw": "audio/x-alaw-basic",
+    "opus": "audio/ogg",
+}
+
+def audio_media_type(output_format: str) -> str:
+    """根据 ElevenLabs 输出格式（如 mp3_44100_128、pcm_16000）返回对应的媒体类型"""
+    media_type = AUDIO_MEDIA_TYPES.get(output_format.split("_", 1)[0])
+    if media_type is None:
+        raise ValueError(f"Unsupported audio format: {output_format}")
+    return media_type
+
+
+class AudioCache:
+    """
+    按内容寻址的磁盘音频缓存，键为 (文本, 声音, 模型, 格式) 的 SHA-256。
+    总大小超过 max_bytes 时按最近访问时间淘汰最旧的文件。
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()   # key -> 文件大小，按访问顺序排列
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(text: str, voice: str, model: str, output_format: str) -> str:
+        raw = "\x00".join((text.strip(), voice, model, output_format))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".audio")
+
+    def _load_index(self):
+        """首次使用时扫描缓存目录，按文件修改时间恢复 LRU 顺序"""
+        if self._loaded:
+            return
+        files = []
+        if os.path.isdir(self.directory):
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if name.endswith(".audio"):
+                        stat = os.stat(os.path.join(root, name))
+                        files.append((stat.st_mtime, name[:-len(".audio")], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._loaded = True
+
+    def _get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._load_index()
+            if key not in self._entries:
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)   # 刷新修改时间，重启后仍能保持 LRU 顺序
+            except OSError:
+                self._total_bytes -= self._entries.pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def _put(self, key: str, data: bytes):
+        with self._lock:
+            self._load_index()
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)   # 原子替换，读者不会看到写了一半的文件
+
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                self.stats["evictions"] += 1
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = await asyncio.get_running_loop().run_in_executor(None, self._get, key)
+        self.stats["hits" if data is not None else "misses"] += 1
+        return data
+
+    async def put(self, key: str, data: bytes):
+        await asyncio.get_running_loop().run_in_executor(None, self._put, key, data)
+
+    def snapshot(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+
+audio_cache = AudioCache(settings.TTS_CACHE_DIR, max_bytes=settings.TTS_CACHE_MAX_BYTES)
+
+
+async def _iterate_in_thread(
+    make_iterator: Callable[[], Iterator[bytes]], max_buffered: int = 8
+) -> AsyncIterator[bytes]:
+    """
+    在后台线程中消费同步迭代器（阻塞的 SDK 流），把分片逐个交给事件循环。
+    最多缓冲 max_buffered 个分片，消费端读得慢时生产线程暂停拉取；
+    消费端关闭（客户端断开）后生产线程停止，并关闭 SDK 的流以释放连接。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    credits = threading.Semaphore(max_buffered)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        if not stop.is_set():
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def worker():
+        iterator = None
+        try:
+            iterator = make_iterator()
+            for item in iterator:
+                credits.acquire()
+                if stop.is_set():
+                    return
+                put(item)
+            put(done)
+        except Exception as e:
+            put(e)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    threading.Thread(target=worker, daemon=True).start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            credits.release()
+            yield item
+    finally:
+        # 通知生产线程停止；归还一个名额，唤醒可能正在等待缓冲空间的线程
+        stop.set()
+        credits.release()
+
+
+async def synthesize_speech_bytes(
+    text: str,
+    voice: str = settings.TTS_VOICE,
+    model: str = settings.TTS_MODEL,
+    output_format: str = "mp3_44100_128",
+    chunk_size: int = 16 * 1024,
+) -> AsyncIterator[bytes]:
+    """
+    流式合成语音并逐块返回音频字节。命中磁盘缓存时不调用 TTS 服务；
+    未命中时边合成边下发，完整合成后写入缓存（中途断开则不缓存）。
+    """
+    key = audio_cache.make_key(text, voice, model, output_format)
+    cached = await audio_cache.get(key)
+    if cached is not None:
+        metrics.count("tts_cache_hits")
+        for start in range(0, len(cached), chunk_size):
+            yield cached[start:start + chunk_size]
+        return
+
+    metrics.count("tts_cache_misses")
+    started = time.perf_counter()
+    chunks = []
+    audio_stream = _iterate_in_thread(lambda: tts_stream(text, voice, model, output_format))
+    try:
+        async for chunk in audio_stream:
+            if chunk:
+                if not chunks:
+                    metrics.observe("tts.first_chunk", started)
+                chunks.append(chunk)
+                yield chunk
+    finally:
+        await audio_stream.aclose()
+    metrics.observe("tts.synthesize", started)
+    await audio_cache.put(key, b"".join(chunks))
 
 # --- 音频录制功能 ---
-def record_audio(duration: int = 5, sample_rate: int = 44100) -> str:
+class EncodedAudio(NamedTuple):
+    """编码后的一段录音，可直接作为 /transcribe 的上传文件"""
+    data: bytes
+    filename: str
+    content_type: str
+    duration: float
+
+
+# 录音编码格式：soundfile 格式 / 子类型 / 扩展名 / MIME 类型
+AUDIO_ENCODINGS = {
+    "flac": ("FLAC", "PCM_16", "flac", "audio/flac"),
+    "opus": ("OGG", "OPUS", "ogg", "audio/ogg"),
+    "wav": ("WAV", "PCM_16", "wav", "audio/wav"),
+}
+
+
+def resample_audio(samples, src_rate: int, dst_rate: int):
+    """
+    向量化重采样：降采样前先用加窗 sinc 低通滤波抗混叠，再用线性插值取样。
+    samples 为一维 float32 数组，返回目标采样率的 float32 数组。
+    """
+    import numpy as np
+
+    samples = np.asarray(samples, dtype=np.float32)
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    if dst_rate < src_rate:
+        taps = 63
+        n = np.arange(taps) - (taps - 1) / 2
+        cutoff = 0.45 * dst_rate / src_rate   # 截止频率略低于目标奈奎斯特频率
+        kernel = np.sinc(2 * cutoff * n) * np.hamming(taps)
+        samples = np.convolve(samples, kernel / kernel.sum(), mode="same")
+    positions = np.arange(int(len(samples) * dst_rate / src_rate)) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+# 首次退回 WAV 时打印原因，之后不再重复
+_encoder_fallback_logged = False
+
+
+def encode_audio(samples, sample_rate: int, fmt: str = settings.VOICE_FORMAT) -> EncodedAudio:
+    """
+    把 float32 单声道音频编码为 FLAC / Opus（需要 soundfile），
+    未安装 soundfile、或其 libsndfile 不支持该格式时退回 16 位 WAV。
+    """
+    global _encoder_fallback_logged
+    import io
+    import numpy as np
+
+    container, subtype, extension, content_type = AUDIO_ENCODINGS[fmt]
+    samples = np.clip(np.asarray(samples, dtype=np.float32), -1.0, 1.0)
+    buffer = io.BytesIO()
+    try:
+        import soundfile as sf
+
+        sf.write(buffer, samples, sample_rate, format=container, subtype=subtype)
+    except (ImportError, RuntimeError, TypeError, ValueError) as e:
+        # libsndfile 缺少编码器时抛出 LibsndfileError（RuntimeError）/ TypeError / ValueError
+        import wave
+
+        if not _encoder_fallback_logged:
+            _encoder_fallback_logged = True
+            print(f"Cannot encode audio as {fmt} ({e}), falling back to WAV.")
+        extension, content_type = "wav", "audio/wav"
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(sample_rate)
+            w.writeframes((samples * 32767).astype("<i2").tobytes())
+    return EncodedAudio(buffer.getvalue(), f"speech.{extension}", content_type, len(samples) / sample_rate)
+
+
+class VoiceActivityDetector:
+    """
+    基于能量的语音活动检测：跟踪背景噪声的 RMS（只在非语音帧上做指数平滑），
+    帧能量超过噪声的 threshold_ratio 倍且高于 min_rms 时判为语音。
+    """
+
+    def __init__(self, threshold_ratio: float = 3.0, min_rms: float = 0.01, noise_alpha: float = 0.05):
+        self.threshold_ratio = threshold_ratio
+        self.min_rms = min_rms
+        self.noise_alpha = noise_alpha
+        self.noise: Optional[float] = None
+
+    def is_speech(self, frame) -> bool:
+        import numpy as np
+
+        rms = float(np.sqrt(np.mean(np.square(frame, dtype=np.float64))))
+        if self.noise is None:
+            self.noise = rms
+        speech = rms > max(self.noise * self.threshold_ratio, self.min_rms)
+        if not speech:
+            self.noise += self.noise_alpha * (rms - self.noise)
+        return speech
+
+
+def capture_speech(
+    chunked: bool = settings.VOICE_CHUNKED_UPLOAD,
+    max_duration: float = settings.VOICE_MAX_SECONDS,
+    start_timeout: float = settings.VOICE_START_TIMEOUT,
+    end_silence_ms: int = settings.VOICE_END_SILENCE_MS,
+    target_rate: int = settings.VOICE_SAMPLE_RATE,
+    fmt: str = settings.VOICE_FORMAT,
+    stop_event: Optional[threading.Event] = None,
+    frame_ms: int = 30,
+    pre_roll_ms: int = 300,
+    min_speech_ms: int = 90,
+    pause_ms: int = 350,
+    min_segment_s: float = 2.0,
+) -> Iterator[EncodedAudio]:
     """
-    录制指定时长的音频并保存为临时WAV文件。
-    返回文件路径。
+    从麦克风采集一句话：检测到语音开始后才开始保留音频（带 pre_roll_ms 的前导），
+    连续静音 end_silence_ms 或达到 max_duration、或 stop_event 被设置时结束。
+    音频按设备原生采样率采集，结束后重采样到 target_rate 单声道并压缩编码。
+
+    chunked=False 时只产出一段完整录音；chunked=True 时在说话中的停顿处（pause_ms）
+    切分并立即产出已完成的片段（至少 min_segment_s 秒），调用方可以边录边上传转录。
+    start_timeout 秒内没有检测到语音时不产出任何内容。
     """
-    print("开始录音...")
-    recording = sd.rec(int(duration * sample_rate), samplerate=sample_rate, channels=1, dtype='int16')
-    sd.wait() # 等待录音完成
+    import numpy as np
+    import sounddevice as sd
+
+    device_rate = int(sd.query_devices(kind="input")["default_samplerate"])
+    frame_len = int(device_rate * frame_ms / 1000)
+    frames_for = lambda ms: max(1, int(ms / frame_ms))
+
+    blocks: queue.Queue = queue.Queue()
+    vad = VoiceActivityDetector(threshold_ratio=settings.VOICE_VAD_THRESHOLD)
+    pre_roll = deque(maxlen=frames_for(pre_roll_ms))
+    speech: list = []
+    segment_start = 0
+    speech_run = silence_run = 0
+    started = False
+
+    def callback(indata, frames, time_info, status):
+        blocks.put(indata[:, 0].copy())
+
+    def encode(frames) -> EncodedAudio:
+        return encode_audio(resample_audio(np.concatenate(frames), device_rate, target_rate), target_rate, fmt)
+
+    print("开始录音（检测到静音后自动结束）...")
+    deadline = time.monotonic() + start_timeout
+    with sd.InputStream(samplerate=device_rate, channels=1, dtype="float32",
+                        blocksize=frame_len, callback=callback):
+        while not (stop_event is not None and stop_event.is_set()):
+            try:
+                frame = blocks.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            speaking = vad.is_speech(frame)
+
+            if not started:
+                pre_roll.append(frame)
+                speech_run = speech_run + 1 if speaking else 0
+                if speech_run >= frames_for(min_speech_ms):
+                    started = True
+                    speech.extend(pre_roll)
+                elif time.monotonic() > deadline:
+                    print("未检测到语音。")
+                    return
+                continue
+
+            speech.append(frame)
+            silence_run = 0 if speaking else silence_run + 1
+            if silence_run >= frames_for(end_silence_ms) or len(speech) * frame_ms >= max_duration * 1000:
+                break
+            # 说话中的停顿：把已完成的片段先交给调用方上传
+            if (chunked and silence_run == frames_for(pause_ms)
+                    and (len(speech) - segment_start) * frame_ms >= min_segment_s * 1000):
+                yield encode(speech[segment_start:])
+                segment_start = len(speech)
     print("录音结束。")
 
-    # 创建一个临时文件来保存录音
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-    write(temp_file.name, sample_rate, recording)
-    return temp_file.name
\ No newline at end of file
+    # 去掉结尾多余的静音，只保留一个短停顿
+    speech = speech[:len(speech) - max(0, silence_run - frames_for(pause_ms))]
+    if started and len(speech) > segment_start:
+        yield encode(speech[segment_start:])
@@ -1,19 +1,19 @@
 # gui.py
-import os
 import sys
-import json
-import requests
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import html
 from typing import Iterable
 
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QTextBrowser, QLineEdit,
     QPushButton, QVBoxLayout, QWidget
 )
-from PyQt5.QtCore import pyqtSignal, QObject, QThread
+from PyQt5.QtCore import pyqtSignal, QObject, QThread, QTimer
+from PyQt5.QtGui import QTextCursor, QTextDocument, QTextDocumentFragment
 
-from core.config import settings
-from core.voice_handler import record_audio, synthesize_speech_stream
+from core.transport import ChatTransport, create_transport
+from core.voice_handler import capture_speech, SpeechPipeline
 
 
 # ---------------- 线程安全的信号 ----------------
@@ -21,68 +21,171 @@ class WorkerSignals(QObject):
     append_chat = pyqtSignal(str)
     set_input   = pyqtSignal(str)
     enable_record = pyqtSignal(bool)
+    record_state = pyqtSignal(str)
 
 
 # ---------------- 聊天请求线程 ----------------
 class ChatThread(QThread):
-    def __init__(self, api_url: str, text: str):
+    def __init__(self, transport: ChatTransport, text: str):
         super().__init__()
-        self.api_url = api_url
+        self.transport = transport
         self.text = text
         self.signals = WorkerSignals()
 
     def run(self):
+        # 边接收边朗读：文本按句切分后立即送去合成，不再等整段回复结束
+        speech = SpeechPipeline()
         try:
-            response = requests.post(
-                f"{self.api_url}/chat",
-                json={"message": self.text},
-                stream=True
-            )
-            response.raise_for_status()
-
-            full_response = ""
-            for chunk in response.iter_content(chunk_size=None):
-                if chunk:
-                    decoded = chunk.decode("utf-8")
-                    full_response += decoded
-                    self.signals.append_chat.emit(decoded)
-
-            def gen():
-                yield full_response
-            threading.Thread(
-                target=synthesize_speech_stream,
-                args=(gen(),)
-            ).start()
-
-        except requests.RequestException as e:
+            for event in self.transport.chat(self.text):
+                kind, data = event["event"], event["data"]
+                if kind == "token":
+                    self.signals.append_chat.emit(data)
+                    speech.feed(data)
+                elif kind == "tool_start":
+                    # 工具调用提示只显示，不朗读
+                    self.signals.append_chat.emit(
+                        f"\n[Jarvis is using tool: {data['name']}({data['arguments']})]...\n"
+                    )
+                elif kind == "error":
+                    raise RuntimeError(data.get("message", "unknown error"))
+            speech.finish()
+
+        except Exception as e:
+            speech.stop()
             self.signals.append_chat.emit(f"\n**Error:** {e}\n\n---\n")
 
 
 # ---------------- 录音线程 ----------------
+def join_transcripts(parts: Iterable[str]) -> str:
+    """拼接分段转录结果：两侧都是英文 / 数字时补一个空格，中文直接相连"""
+    text = ""
+    for part in (p.strip() for p in parts):
+        if not part:
+            continue
+        if text and text[-1].isascii() and text[-1].isalnum() and part[0].isascii() and part[0].isalnum():
+            text += " "
+        text += part
+    return text
+
+
 class RecordThread(QThread):
-    def __init__(self, api_url: str):
+    """
+    说话时录音，检测到说完（静音）后自动结束并转录。
+    开启分段上传时，每个在停顿处切出的片段立即提交转录，录音结束后只需等待最后一段。
+    """
+
+    def __init__(self, transport: ChatTransport):
         super().__init__()
-        self.api_url = api_url
+        self.transport = transport
         self.signals = WorkerSignals()
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        """提前结束录音（已录下的内容仍会被转录）"""
+        self.stop_event.set()
 
     def run(self):
         try:
-            audio_path = record_audio()
-            with open(audio_path, "rb") as f:
-                files = {"file": (os.path.basename(audio_path), f, "audio/wav")}
-                r = requests.post(f"{self.api_url}/transcribe", files=files)
-            r.raise_for_status()
-            text = r.json().get("transcription", "")
-            self.signals.set_input.emit(text)
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix="transcribe") as pool:
+                futures = []
+                for segment in capture_speech(stop_event=self.stop_event):
+                    futures.append(pool.submit(
+                        self.transport.transcribe, segment.data,
+                        filename=segment.filename, content_type=segment.content_type,
+                    ))
+                self.signals.record_state.emit("Transcribing...")
+                text = join_transcripts(f.result() for f in futures)
+            if text:
+                self.signals.set_input.emit(text)
         except Exception as e:
             print("Record/Transcribe error:", e)
         finally:
             self.signals.enable_record.emit(True)
 
 
+# ---------------- 聊天渲染 ----------------
+class ChatRenderer(QObject):
+    """
+    合并刷新的聊天渲染器：流式文本先进入缓冲区，由固定帧率的定时器统一刷新，
+    每帧只重新渲染正在生成的那条消息（Markdown），已完成的消息不再重排。
+    文档的最大段落数受限，旧的聊天记录会被自动丢弃，界面开销不随会话变长而增长。
+    """
+
+    def __init__(self, view: QTextBrowser, fps: int = 30, max_blocks: int = 2000):
+        super().__init__(view)
+        self.view = view
+        self.view.document().setMaximumBlockCount(max_blocks)
+        self._pending: list[str] = []
+        self._active_text = ""
+        # 锚定在当前消息开头的光标：文档达到段落上限时 Qt 会从顶部删除旧段落，
+        # 光标位置随之自动调整，不会像保存的绝对偏移那样失效
+        self._anchor: QTextCursor | None = None
+        self._active = False
+        self._timer = QTimer(self)
+        self._timer.setInterval(max(1, 1000 // fps))
+        self._timer.timeout.connect(self._flush)
+
+    def append_block(self, html_text: str):
+        """追加一段静态 HTML（用户消息、分隔线等）"""
+        self.finish_message()
+        self._scroll_after(lambda: self.view.append(html_text))
+
+    def start_message(self, header_html: str):
+        """开始一条新的流式消息"""
+        self.finish_message()
+        self._scroll_after(lambda: self.view.append(header_html))
+        self._active = True
+        self._active_text = ""
+        self._anchor = QTextCursor(self.view.document())
+        self._anchor.movePosition(QTextCursor.End)
+        # 在锚点处插入内容时锚点保持不动，始终指向消息开头
+        self._anchor.setKeepPositionOnInsert(True)
+
+    def append_text(self, text: str):
+        """接收流式文本（只写缓冲区，实际渲染在下一帧进行）"""
+        if not self._active:
+            self.start_message("<b>Jarvis:</b><br/>")
+        self._pending.append(text)
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def finish_message(self):
+        if self._active:
+            self._flush()
+            self._active = False
+            self._anchor = None
+        self._timer.stop()
+
+    def _flush(self):
+        if not self._pending:
+            self._timer.stop()
+            return
+        self._active_text += "".join(self._pending)
+        self._pending.clear()
+        self._scroll_after(self._render_active)
+
+    def _render_active(self):
+        fragment_doc = QTextDocument()
+        fragment_doc.setMarkdown(self._active_text)
+
+        # 用锚点到文档末尾的选区替换上一帧的渲染结果
+        cursor = QTextCursor(self.view.document())
+        cursor.setPosition(self._anchor.position())
+        cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        cursor.insertFragment(QTextDocumentFragment(fragment_doc))
+
+    def _scroll_after(self, update):
+        """仅当用户停留在底部时才自动滚动，查看历史时不打断"""
+        bar = self.view.verticalScrollBar()
+        at_bottom = bar.value() >= bar.maximum() - 4
+        update()
+        if at_bottom:
+            bar.setValue(bar.maximum())
+
+
 # ---------------- 主窗口 ----------------
 class JarvisGUI(QMainWindow):
-    def __init__(self):
+    def __init__(self, transport: ChatTransport = None):
         super().__init__()
         self.setWindowTitle("Jarvis AI Assistant")
         self.setGeometry(100, 100, 800, 600)
@@ -93,12 +196,14 @@ class JarvisGUI(QMainWindow):
         # UI
         self.chat_display = QTextBrowser()
         self.chat_display.setOpenExternalLinks(True)
+        self.renderer = ChatRenderer(self.chat_display)
 
         self.input_box = QLineEdit()
         self.input_box.setPlaceholderText("Type your message here or press Record...")
 
         self.send_btn = QPushButton("Send")
-        self.rec_btn = QPushButton("Record (5s)")
+        self.rec_btn = QPushButton("Record")
+        self.record_thread = None
 
         # Layout
         layout = QVBoxLayout()
@@ -112,7 +217,8 @@ class JarvisGUI(QMainWindow):
         self.setCentralWidget(container)
 
         # Signals
-        self.api_url = f"http://{settings.API_HOST}:{settings.API_PORT}"
+        # 由 run.py 启动时与 API 同进程，直接调用聊天引擎；单独运行时通过 HTTP 访问
+        self.transport = transport or create_transport()
         self.send_btn.clicked.connect(self.on_send)
         self.input_box.returnPressed.connect(self.on_send)
         self.rec_btn.clicked.connect(self.on_record)
@@ -120,10 +226,11 @@ class JarvisGUI(QMainWindow):
     # 2. 追加消息
     def append_md(self, role: str, text: str):
         if role.lower() == "user":
-            html = f"<b>You:</b><br/>{text}<hr/>"
+            self.renderer.append_block(f"<b>You:</b><br/>{html.escape(text)}<hr/>")
         else:
-            html = f"<b>Jarvis:</b><br/>{text}"
-        self.chat_display.append(html)
+            self.renderer.start_message("<b>Jarvis:</b><br/>")
+            if text:
+                self.renderer.append_text(text)
 
     # 3. 发送文本
     def on_send(self):
@@ -131,34 +238,49 @@ class JarvisGUI(QMainWindow):
         if not text:
             return
         self.append_md("user", text)
+        self.append_md("assistant", "")
         self.input_box.clear()
 
-        thread = ChatThread(self.api_url, text)
-        thread.signals.append_chat.connect(self.chat_display.insertPlainText)
+        thread = ChatThread(self.transport, text)
+        thread.signals.append_chat.connect(self.renderer.append_text)
+        thread.finished.connect(self.renderer.finish_message)
         thread.finished.connect(lambda: self.threads.remove(thread))
         self.threads.append(thread)
         thread.start()
 
-    # 4. 录音
+    # 4. 录音：说完后自动结束；录音中再次点击按钮可提前结束
     def on_record(self):
-        self.rec_btn.setEnabled(False)
-        self.rec_btn.setText("Recording...")
+        if self.record_thread is not None:
+            self.record_thread.stop()
+            self.rec_btn.setEnabled(False)
+            return
+        self.rec_btn.setText("Listening... (click to stop)")
 
-        thread = RecordThread(self.api_url)
+        thread = RecordThread(self.transport)
+        self.record_thread = thread
         thread.signals.set_input.connect(self.input_box.setText)
+        thread.signals.record_state.connect(self.rec_btn.setText)
+        thread.signals.record_state.connect(lambda _: self.rec_btn.setEnabled(False))
         thread.signals.enable_record.connect(self.rec_btn.setEnabled)
-        thread.signals.enable_record.connect(lambda _: self.rec_btn.setText("Record (5s)"))
+        thread.signals.enable_record.connect(lambda _: self.rec_btn.setText("Record"))
         thread.signals.set_input.connect(self.on_send)
         thread.finished.connect(lambda: self.threads.remove(thread))
+        thread.finished.connect(self._on_record_finished)
         self.threads.append(thread)
         thread.start()
 
+    def _on_record_finished(self):
+        self.record_thread = None
+
     # 5. 优雅退出
     def closeEvent(self, event):
+        if self.record_thread is not None:
+            self.record_thread.stop()
         for t in self.threads[:]:
             if t.isRunning():
                 t.quit()
                 t.wait()
+        self.transport.close()
         event.accept()
 
 
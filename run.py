@@ -23,6 +23,7 @@ def run_pyqt():
     """在主线程中运行PyQt5 GUI"""
     print("Starting PyQt5 GUI...")
     app = QApplication(sys.argv)
+    # API 与 GUI 在同一进程中，JarvisGUI 会自动选择进程内传输，直接调用聊天引擎
     main_win = JarvisGUI()
     main_win.show()
     sys.exit(app.exec_())
@@ -0,0 +1,40 @@
+# tests/test_config.py
+import os
+import re
+
+from core.config import BASE_DIR, Settings
+
+EXAMPLE = os.path.join(BASE_DIR, ".env.example")
+
+
+def example_defaults() -> dict:
+    """.env.example 中被注释掉的可选配置：取消注释后按 dotenv 规则解析"""
+    from dotenv import dotenv_values
+
+    with open(EXAMPLE, encoding="utf-8") as f:
+        lines = [line[1:] for line in f if re.match(r"#[A-Z][A-Z0-9_]*=", line)]
+    path = os.path.join(os.path.dirname(EXAMPLE), ".env.example.uncommented")
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        return dotenv_values(path)
+    finally:
+        os.remove(path)
+
+
+def test_every_setting_is_documented():
+    with open(EXAMPLE, encoding="utf-8") as f:
+        documented = set(re.findall(r"^#?([A-Z][A-Z0-9_]*)=", f.read(), re.M))
+    assert set(Settings.model_fields) - documented == set()
+
+
+def test_documented_values_are_the_defaults(monkeypatch):
+    values = example_defaults()
+    defaults = Settings(_env_file=None)
+    for name, value in values.items():
+        monkeypatch.setenv(name, value)
+    parsed = Settings(_env_file=None)
+    for name, value in values.items():
+        if name.endswith(("_PATH", "_DIR")):
+            continue   # 示例中使用相对路径
+        assert getattr(parsed, name) == getattr(defaults, name), name
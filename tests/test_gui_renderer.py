@@ -0,0 +1,54 @@
+# tests/test_gui_renderer.py
+import os
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+QtWidgets = pytest.importorskip("PyQt5.QtWidgets")
+
+from gui import ChatRenderer
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def stream(renderer: ChatRenderer, parts):
+    renderer.start_message("<b>Jarvis:</b><br/>")
+    for part in parts:
+        renderer.append_text(part)
+        renderer._flush()
+    renderer.finish_message()
+
+
+PARTS = ["第一句话。\n\n", "第二句话。\n\n", "第三句话。\n\n", "最后一段。"]
+
+
+def test_stream_renders_once(app):
+    view = QtWidgets.QTextBrowser()
+    stream(ChatRenderer(view, max_blocks=50), PARTS)
+    text = view.toPlainText()
+    assert text.count("第一句话") == 1
+    assert text.rstrip().endswith("最后一段。")
+
+
+def test_stream_after_scrollback_is_full(app):
+    # 文档已达到段落上限，每次重新渲染都会从顶部删除旧段落
+    view = QtWidgets.QTextBrowser()
+    renderer = ChatRenderer(view, max_blocks=50)
+    for i in range(80):
+        renderer.append_block(f"<b>You:</b><br/>message {i}<hr/>")
+    assert view.document().blockCount() == 50
+
+    stream(renderer, PARTS)
+    text = view.toPlainText()
+    assert text.count("第一句话") == 1
+    assert text.count("最后一段") == 1
+    assert text.rstrip().endswith("第一句话。\n第二句话。\n第三句话。\n最后一段。")
+
+    # 下一条消息同样只渲染一次，上一条保持不变
+    stream(renderer, ["第二条回复。"])
+    text = view.toPlainText()
+    assert text.count("第一句话") == 1
+    assert text.count("第二条回复") == 1
@@ -0,0 +1,58 @@
+# tests/test_llm_router.py
+import asyncio
+from types import SimpleNamespace
+
+from core.llm_client import LLMRouter
+
+
+class FakeEndpoint:
+    """只实现 LLMRouter 用到的属性；create 等 gate 打开后返回一个记录关闭情况的流"""
+
+    def __init__(self, name: str, gate: asyncio.Event, closed: list):
+        self.name = name
+        self.purposes = ("chat",)
+        self.gate = gate
+        self.closed = closed
+        self.streams = []   # 保留引用，确保流是被显式关闭的，而不是被垃圾回收时关闭
+        self.client = SimpleNamespace(create=self.create)
+
+    def model_for(self, purpose: str) -> str:
+        return "model"
+
+    async def create(self, **request):
+        await self.gate.wait()
+
+        async def stream():
+            try:
+                for token in ("hello", " world"):
+                    yield f"{self.name}:{token}"
+            finally:
+                self.closed.append(self.name)
+
+        self.streams.append(stream())
+        return self.streams[-1]
+
+
+def test_hedge_loser_stream_is_closed_when_both_finish_in_the_same_round():
+    async def main():
+        gate, closed = asyncio.Event(), []
+        a, b = FakeEndpoint("a", gate, closed), FakeEndpoint("b", gate, closed)
+        router = LLMRouter([a, b], hedge=True, hedge_min_delay=0.01, explore=0.0)
+
+        async def open_gate():
+            await asyncio.sleep(0.05)   # 对冲请求已经发出后，两个端点同时返回
+            gate.set()
+
+        opener = asyncio.ensure_future(open_gate())
+        stream = await router.create(messages=[], stream=True)
+        await opener
+        chunks = [chunk async for chunk in stream]
+        await stream.aclose()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+        winner = chunks[0].split(":")[0]
+        assert chunks == [f"{winner}:hello", f"{winner}: world"]
+        assert sorted(closed) == ["a", "b"]
+
+    asyncio.run(main())
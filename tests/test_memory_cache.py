@@ -0,0 +1,41 @@
+# tests/test_memory_cache.py
+import asyncio
+
+from core.memory_manager import EmbeddedMemoryManager
+
+
+def edge(subject, relation, obj):
+    return {"subject": subject, "relation": relation, "object": obj}
+
+
+def texts(facts):
+    return [text for _, text in facts]
+
+
+def test_write_next_to_a_neighbor_invalidates_two_hop_cache():
+    async def main():
+        mm = EmbeddedMemoryManager(path=None)
+        mm.vector_path = None
+        await mm.store_triplets([edge("Alice", "knows", "Bob"), edge("Bob", "lives in", "Paris")])
+
+        facts = (await mm.fetch_neighborhoods(["Alice"], 8))["Alice"]
+        assert "Bob lives in Paris." in texts(facts)   # 第二跳
+
+        # 与 Alice 无直接关系、但经过其一跳邻居 Bob 的新边
+        await mm.store_triplets([edge("Bob", "works at", "Acme")])
+        facts = (await mm.fetch_neighborhoods(["Alice"], 8))["Alice"]
+        assert "Bob works at Acme." in texts(facts)
+
+        # 与 Alice 的邻域无关的写入不影响缓存
+        hits = mm.neighborhood_cache.stats["hits"]
+        await mm.store_triplets([edge("Carol", "likes", "Tea")])
+        await mm.fetch_neighborhoods(["Alice"], 8)
+        assert mm.neighborhood_cache.stats["hits"] == hits + 1
+
+        # 没有邻居的实体被负缓存，新边写入后失效
+        assert (await mm.fetch_neighborhoods(["Dave"], 8))["Dave"] == []
+        await mm.store_triplets([edge("Dave", "owns", "Car")])
+        assert texts((await mm.fetch_neighborhoods(["Dave"], 8))["Dave"]) == ["Dave owns Car."]
+        await mm.close()
+
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+# tests/test_memory_entity_index.py
+import asyncio
+
+from core.config import settings
+from core.memory_manager import EmbeddedMemoryManager
+
+
+class FlakyMemoryManager(EmbeddedMemoryManager):
+    """前 failures 次读取实体名时失败，模拟启动时图谱暂时不可用"""
+
+    def __init__(self, failures: int):
+        super().__init__(path=None)
+        self.vector_path = None
+        self.failures = failures
+        self.llm_prompts = []
+
+    async def _entity_names(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("graph unavailable")
+        return await super()._entity_names()
+
+    async def _extract_entities_with_llm(self, prompt):
+        self.llm_prompts.append(prompt)
+        return [name for name in ("Alice", "Bob") if name in prompt]
+
+
+async def settle(mm):
+    if mm._entity_index_task is not None:
+        await mm._entity_index_task
+
+
+def test_index_loads_in_background_after_startup_failure(monkeypatch):
+    monkeypatch.setattr(settings, "MEMORY_ENTITY_RETRY_SECONDS", 0.0)
+    monkeypatch.setattr(settings, "MEMORY_LLM_ENTITY_FALLBACK", False)
+
+    async def main():
+        mm = FlakyMemoryManager(failures=2)
+        await mm.store_triplets([{"subject": "Alice", "relation": "works at", "object": "Acme"}])
+        mm.entity_index = type(mm.entity_index)()   # 模拟另一个 worker：本地索引为空
+
+        try:
+            await mm.load_entity_index()
+        except ConnectionError:
+            pass
+        assert mm.entity_index_snapshot()["loaded"] is False
+
+        # 索引未加载：改用 LLM 抽取实体，仍然能检索到事实，同时在后台重试加载
+        facts = await mm._graph_facts("Where does Alice work?")
+        assert any("Acme" in text for _, text in facts)
+        assert mm.llm_prompts == ["Where does Alice work?"]
+        await settle(mm)   # 第二次失败
+        assert mm.entity_index_snapshot()["failures"] == 2
+
+        await mm._graph_facts("Alice?")
+        await settle(mm)
+        stats = mm.entity_index_snapshot()
+        assert stats["loaded"] is True and stats["size"] == 2
+
+        # 加载成功后不再调用 LLM
+        calls = len(mm.llm_prompts)
+        facts = await mm._graph_facts("Where does Alice work?")
+        assert any("Acme" in text for _, text in facts)
+        assert len(mm.llm_prompts) == calls
+        await mm.close()
+
+    asyncio.run(main())
+
+
+def test_periodic_refresh_picks_up_other_writers(monkeypatch):
+    monkeypatch.setattr(settings, "MEMORY_ENTITY_REFRESH_SECONDS", 0.01)
+
+    async def main():
+        mm = FlakyMemoryManager(failures=0)
+        await mm.load_entity_index()
+        # 另一个 worker 写入的实体：只进了共享的存储，没进本进程的索引
+        await mm.store_triplets([{"subject": "Bob", "relation": "lives in", "object": "Paris"}])
+        mm.entity_index = type(mm.entity_index)()
+        await asyncio.sleep(0.02)
+        await mm._graph_facts("hello")
+        await settle(mm)
+        assert "Bob" in mm.entity_index
+        await mm.close()
+
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+# tests/test_session_store.py
+import asyncio
+
+import pytest
+
+from bench.fake_redis import FakeRedisServer
+from core.session_store import (
+    InMemorySessionBackend, RedisSessionBackend, SessionStore, SQLiteSessionBackend,
+)
+
+
+def turn(i: int):
+    return [{"role": "user", "content": f"question {i}"}, {"role": "assistant", "content": f"answer {i}"}]
+
+
+async def run_turn(store: SessionStore, session_id: str, i: int):
+    messages = await store.load(session_id)
+    messages.extend(turn(i))
+    await store.save(session_id, messages)
+
+
+def contents(messages):
+    return [m["content"] for m in messages if m["role"] != "system"]
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backends(request, tmp_path):
+    """返回一个工厂：每次调用创建一个连接到同一份数据的后端实例（模拟多个 worker）"""
+
+    async def make():
+        if request.param == "memory":
+            shared = InMemorySessionBackend()
+            return lambda: shared, None
+        if request.param == "sqlite":
+            path = str(tmp_path / "sessions.db")
+            return lambda: SQLiteSessionBackend(path), None
+        server = FakeRedisServer()
+        port = await server.start()
+        return lambda: RedisSessionBackend(f"redis://127.0.0.1:{port}/0", idle_ttl=60), server
+
+    return make
+
+
+def test_versions_and_compare_and_set(backends):
+    async def main():
+        factory, server = await backends()
+        backend = factory()
+        record = {"summary": "", "messages": [], "tokens": 0, "last_access": 0.0}
+        assert await backend.put("s", dict(record), expected_version=1) is False
+        assert await backend.put("s", dict(record), expected_version=0) is True
+        assert (await backend.get("s"))["version"] == 1
+        assert await backend.put("s", dict(record), expected_version=0) is False
+        assert await backend.put("s", dict(record), expected_version=1) is True
+        assert (await backend.get("s"))["version"] == 2
+        await backend.close()
+        if server is not None:
+            await server.close()
+
+    asyncio.run(main())
+
+
+def test_concurrent_workers_keep_every_turn(backends):
+    async def main():
+        factory, server = await backends()
+        a, b = SessionStore("sys", backend=factory()), SessionStore("sys", backend=factory())
+        await run_turn(a, "s", 0)
+
+        # 两个 worker 都在对方保存之前读取了会话
+        ma, mb = await a.load("s"), await b.load("s")
+        ma.extend(turn(1))
+        mb.extend(turn(2))
+        await a.save("s", ma)
+        await b.save("s", mb)
+
+        history = contents(await a.load("s"))
+        assert history == ["question 0", "answer 0", "question 1", "answer 1", "question 2", "answer 2"]
+        assert b.stats["write_conflicts"] == 0   # 版本不同时先合并再写，不必等到冲突
+
+        # 大量并发保存：每一轮都保留
+        await asyncio.gather(*(run_turn(store, "t", i) for i, store in enumerate([a, b] * 5)))
+        history = contents(await b.load("t"))
+        assert sorted(history) == sorted(c for i in range(10) for c in (f"question {i}", f"answer {i}"))
+
+        await a.close()
+        await b.close()
+        if server is not None:
+            await server.close()
+
+    asyncio.run(main())
+
+
+def test_summary_write_back_keeps_turns_saved_meanwhile(backends):
+    async def main():
+        factory, server = await backends()
+        release = asyncio.Event()
+        calls = []
+
+        async def summarizer(previous, dropped):
+            calls.append(previous)
+            await release.wait()
+            return (previous + " " + " ".join(contents(dropped))).strip()
+
+        a = SessionStore("sys", backend=factory(), token_budget=40, summarizer=summarizer)
+        b = SessionStore("sys", backend=factory(), token_budget=40)
+        for i in range(4):
+            await run_turn(a, "s", i)   # 超出预算，开始在后台摘要
+
+        # 摘要期间另一个 worker 保存了新的一轮
+        await run_turn(b, "s", 99)
+        release.set()
+        await asyncio.gather(*a._summary_tasks)
+
+        record = await factory().get("s")
+        assert "question 99" in contents(record["messages"])
+        assert "question 0" in record["summary"]
+        await a.close()
+        await b.close()
+        if server is not None:
+            await server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+# tests/test_tool_runtime.py
+import asyncio
+import threading
+
+from core.tool_runtime import ToolRuntime
+
+
+def test_timed_out_thread_call_keeps_its_concurrency_slot():
+    release, started = threading.Event(), []
+
+    def slow_lookup(query: str) -> str:
+        started.append(query)
+        release.wait(5)
+        return f"result for {query}"
+
+    runtime = ToolRuntime(
+        {"slow_lookup": slow_lookup},
+        {"slow_lookup": {"executor": "thread", "timeout": 0.05, "max_concurrency": 1}},
+    )
+
+    async def main():
+        first = await runtime.run("slow_lookup", {"query": "a"})
+        assert "timed out" in first
+        # 第一次调用仍在线程中运行，第二次拿不到名额，不会再占用一个线程
+        second = await runtime.run("slow_lookup", {"query": "b"})
+        assert "timed out" in second
+        assert started == ["a"]
+
+        release.set()
+        await asyncio.sleep(0.05)   # 第一次调用真正结束后归还名额
+        assert await runtime.run("slow_lookup", {"query": "c"}) == "result for c"
+        assert started == ["a", "c"]
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        runtime.shutdown()
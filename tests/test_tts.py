@@ -0,0 +1,154 @@
+# tests/test_tts.py
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from core import voice_handler
+
+
+class StubTextToSpeech:
+    """与 elevenlabs 2.x 的 client.text_to_speech.stream 签名一致"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = []
+
+    def stream(self, voice_id, *, text, model_id=None, output_format=None, **options):
+        self.calls.append({"voice_id": voice_id, "text": text, "model_id": model_id, "output_format": output_format})
+        return iter(self.chunks)
+
+
+class StubVoices:
+    def __init__(self, voices):
+        self.voices = voices
+        self.searches = []
+
+    def search(self, *, search=None, **options):
+        self.searches.append(search)
+        matches = [v for v in self.voices if search is None or search.lower() in v.name.lower()]
+        return SimpleNamespace(voices=matches)
+
+
+class StubClient:
+    def __init__(self, chunks=(b"aa", b"bb")):
+        self.text_to_speech = StubTextToSpeech(list(chunks))
+        self.voices = StubVoices([
+            SimpleNamespace(name="Rachel", voice_id="21m00Tcm4TlvDq8ikWAM"),
+            SimpleNamespace(name="Adam", voice_id="pNInz6obpgDQGcFmaJgB"),
+        ])
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    stub = StubClient()
+    monkeypatch.setattr(voice_handler, "get_tts_client", lambda: stub)
+    monkeypatch.setattr(voice_handler, "audio_cache", voice_handler.AudioCache(str(tmp_path), max_bytes=1 << 20))
+    voice_handler.resolve_voice_id.cache_clear()
+    yield stub
+    voice_handler.resolve_voice_id.cache_clear()
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_synthesize_uses_text_to_speech_stream(client):
+    chunks = asyncio.run(collect(voice_handler.synthesize_speech_bytes(
+        "你好", voice="Rachel", model="eleven_multilingual_v2", output_format="mp3_44100_128"
+    )))
+    assert chunks == [b"aa", b"bb"]
+    assert client.text_to_speech.calls == [{
+        "voice_id": "21m00Tcm4TlvDq8ikWAM",
+        "text": "你好",
+        "model_id": "eleven_multilingual_v2",
+        "output_format": "mp3_44100_128",
+    }]
+
+    # 第二次命中磁盘缓存，不再调用 TTS
+    chunks = asyncio.run(collect(voice_handler.synthesize_speech_bytes(
+        "你好", voice="Rachel", model="eleven_multilingual_v2", output_format="mp3_44100_128"
+    )))
+    assert b"".join(chunks) == b"aabb"
+    assert len(client.text_to_speech.calls) == 1
+
+
+def test_resolve_voice_id(client):
+    assert voice_handler.resolve_voice_id("adam") == "pNInz6obpgDQGcFmaJgB"
+    assert voice_handler.resolve_voice_id("adam") == "pNInz6obpgDQGcFmaJgB"
+    assert client.voices.searches == ["adam"]
+    # 已经是 voice_id 时不查询声音库
+    assert voice_handler.resolve_voice_id("pNInz6obpgDQGcFmaJgB") == "pNInz6obpgDQGcFmaJgB"
+    assert client.voices.searches == ["adam"]
+    with pytest.raises(ValueError):
+        voice_handler.resolve_voice_id("Nobody")
+
+
+def test_call_matches_installed_sdk(client):
+    # 用真实 SDK 的签名校验调用方式，防止 SDK 升级后接口再次失配
+    elevenlabs = pytest.importorskip("elevenlabs.client")
+    import inspect
+
+    real = elevenlabs.ElevenLabs(api_key="test")
+    voice_handler.tts_stream("你好", "Rachel", "eleven_multilingual_v2", "pcm_22050")
+    call = client.text_to_speech.calls[-1]
+    inspect.signature(real.text_to_speech.stream).bind(
+        call["voice_id"], text=call["text"], model_id=call["model_id"], output_format=call["output_format"]
+    )
+    inspect.signature(real.voices.search).bind(search="Rachel")
+
+
+class StubOutputStream:
+    def __init__(self, written, **options):
+        self.written = written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        self.written.append(data.tobytes())
+
+
+def test_speech_pipeline_plays_synthesized_segments(client, monkeypatch):
+    written = []
+    sounddevice = SimpleNamespace(OutputStream=lambda **options: StubOutputStream(written, **options))
+    monkeypatch.setitem(__import__("sys").modules, "sounddevice", sounddevice)
+    client.text_to_speech.chunks = [b"\x01\x00\x02", b"\x00"]   # 分片在采样中间断开
+
+    speech = voice_handler.SpeechPipeline(sample_rate=16000)
+    speech.feed("第一句话。第二句")
+    speech.finish()
+    speech.wait(timeout=5)
+
+    assert [c["text"] for c in client.text_to_speech.calls] == ["第一句话。", "第二句"]
+    assert {c["output_format"] for c in client.text_to_speech.calls} == {"pcm_16000"}
+    assert b"".join(written) == b"\x01\x00\x02\x00" * 2
+
+
+def test_slow_consumer_bounds_buffer_and_disconnect_stops_producer(client):
+    import threading
+
+    produced, closed = [], threading.Event()
+
+    def endless():
+        try:
+            while True:
+                produced.append(1)
+                yield b"x" * 16
+        finally:
+            closed.set()
+
+    client.text_to_speech.stream = lambda voice_id, **options: endless()
+
+    async def main():
+        stream = voice_handler.synthesize_speech_bytes("很长的一段话", voice="Rachel")
+        assert await stream.__anext__() == b"x" * 16
+        await asyncio.sleep(0.1)   # 客户端读得慢：生产线程只能提前拉取有限的分片
+        assert len(produced) <= 10
+        await stream.aclose()      # 客户端断开
+        assert await asyncio.to_thread(closed.wait, 2)
+
+    asyncio.run(main())